@@ -8,6 +8,9 @@ from requests import HTTPError
 
 from tda.client import Client
 
+from eventlog import log
+import chainarchive
+
 
 def get_history(client, symbol):
     """Returns today's minute-by-minute OHCLV history for the requested symbol."""
@@ -26,7 +29,7 @@ def get_history(client, symbol):
             resp.raise_for_status()
             break
         except HTTPError as http_error:
-            print(http_error)
+            log("http_retry", "warning", request="price_history", symbol=symbol, error=str(http_error))
             time.sleep(0.5)
 
     history = resp.json()
@@ -72,27 +75,45 @@ def get_option_chain(
     symbol,
     strike_count,
     dte,
+    contract_type=None,
+    strike_range=None,
+    from_dte=0,
 ):
     """
     Returns the option chain of the requested symbol.
     Returned as-is. It's nested in a way that can be inconvenient.
     See flatten() for extraction of the contracts.
+
+    Only expiries from from_dte to dte days out are asked for.
+    contract_type ("CALL" or "PUT") and strike_range ("ITM" or "OTM")
+    narrow the request further, both kinds of contract and every strike
+    by default.
     """
+    narrowing = {}
+    if contract_type:
+        narrowing["contract_type"] = Client.Options.ContractType(contract_type)
+    if strike_range:
+        narrowing["strike_range"] = Client.Options.StrikeRange(strike_range)
     while True:
         try:
             resp = client.get_option_chain(
                 symbol,
                 strike_count=strike_count,
-                from_date=datetime.datetime.today(),
+                from_date=datetime.datetime.today() + datetime.timedelta(days=from_dte),
                 to_date=datetime.datetime.today() + datetime.timedelta(days=dte),
+                **narrowing,
             )
             resp.raise_for_status()
             break
         except HTTPError as http_error:
-            print(http_error)
+            log("http_retry", "warning", request="option_chain", symbol=symbol, error=str(http_error))
             time.sleep(0.5)
 
     chain = resp.json()
+    chainarchive.record(symbol, chain, {
+        "strike_count": strike_count, "contract_type": contract_type,
+        "strike_range": strike_range, "from_dte": from_dte, "to_dte": dte,
+    })
     return chain
 
 
@@ -154,6 +175,7 @@ class AccountActivityXMLParse:
             "OrderInstructions",
             "OriginalQuantity",
             "LastUpdated",
+            "ExecutionPrice",
         ]
 
     def update_tags(self, new_tags):
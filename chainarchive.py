@@ -0,0 +1,329 @@
+"""
+Archive of option chain snapshots for research and backtesting.
+
+When configured, every chain fetched by botutils.get_option_chain (and
+any scheduled snapshots, see ChainArchive.start_snapshots) is handed to a
+writer thread through a queue, so recording costs trading code a put on
+the queue. The writer stores each snapshot column by column (one array
+per contract field) at directory/SYMBOL/YYYY-MM-DD/<epoch milliseconds>.npyz,
+written under a temporary name and renamed, so the archive can be read
+while it's being added to. Days and times are UTC. A snapshot file is
+one zlib stream of .npy arrays, the column names first and then each
+column: compressing the columns together makes files half the size of
+an .npz of the same arrays, and they load about twice as fast.
+
+The bot asks for narrowed chains (only calls or puts, only ITM or OTM
+strikes) as well as full ones, so the parameters of the request a chain
+came from are stored with it as chain level values (see REQUEST_FIELDS)
+and load_slice can leave the narrowed ones out.
+
+load_slice reads the snapshots of a symbol between two times back into
+OptionChainIndex objects, ready to pass to
+OrderManager.get_contract_from_chain(..., index=...). Only the file names
+are looked at to pick the snapshots, and each column is decoded in one
+go rather than field by field as JSON would be.
+"""
+import datetime
+import io
+import os
+import queue
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from chainindex import OptionChainIndex
+from eventlog import log
+
+
+# Chain level values (ie. underlyingPrice) are stored with this prefix,
+# contract fields under their own names.
+CHAIN_PREFIX = "_"
+# Request parameters are stored as chain level values under
+# REQUEST_PREFIX + field, "" for parameters not given.
+REQUEST_PREFIX = CHAIN_PREFIX + "request_"
+REQUEST_FIELDS = ["strike_count", "contract_type", "strike_range", "from_dte", "to_dte"]
+# Requests with any of these set return only part of the chain.
+NARROWING_FIELDS = ["contract_type", "strike_range"]
+SUFFIX = ".npyz"
+
+
+def chain_contracts(chain):
+    """The contracts of a nested chain from get_option_chain, in one list."""
+    return [
+        contract
+        for key in ["callExpDateMap", "putExpDateMap"]
+        for date in chain.get(key, {})
+        for strike in chain[key][date]
+        for contract in chain[key][date][strike]
+    ]
+
+
+def column(values):
+    """
+    An array of values (one field of every contract), or None if the
+    field doesn't fit in one (lists, dicts, nothing but None).
+    Numbers with a None among them become floats with NaN for the Nones.
+    """
+    present = [value for value in values if value is not None]
+    if not present or any(isinstance(value, (list, dict)) for value in present):
+        return None
+    if all(isinstance(value, bool) for value in present):
+        return np.array([bool(value) for value in values])
+    if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+        if len(present) == len(values) and all(isinstance(value, int) for value in values):
+            return np.array(values, dtype=np.int64)
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    return np.array(["" if value is None else str(value) for value in values])
+
+
+def chain_columns(chain, request=None):
+    """
+    {name: array} for a chain, see column. request is {field: value} of
+    the REQUEST_FIELDS the chain was asked for with.
+    """
+    contracts = chain_contracts(chain)
+    fields = {}
+    for contract in contracts:
+        for field in contract:
+            fields.setdefault(field, None)
+    columns = {}
+    for field in fields:
+        array = column([contract.get(field) for contract in contracts])
+        if array is not None:
+            columns[field] = array
+    for key, value in chain.items():
+        if isinstance(value, (bool, int, float, str)):
+            columns[CHAIN_PREFIX + key] = np.array(value)
+    for field in REQUEST_FIELDS:
+        value = (request or {}).get(field)
+        columns[REQUEST_PREFIX + field] = np.array("" if value is None else value)
+    return columns
+
+
+def request_from_columns(columns):
+    """
+    {field: value} of the request a snapshot came from, None for the
+    parameters not given. Empty for snapshots archived without it.
+    """
+    request = {}
+    for field in REQUEST_FIELDS:
+        array = columns.get(REQUEST_PREFIX + field)
+        if array is not None:
+            value = array.item()
+            request[field] = None if value == "" else value
+    return request
+
+
+def is_narrowed(request):
+    """Whether a request (see request_from_columns) returned only part of the chain."""
+    return any(request.get(field) for field in NARROWING_FIELDS)
+
+
+def contracts_from_columns(columns):
+    """Contract dicts back from chain_columns, NaN read back as None."""
+    fields = {}
+    for name, array in columns.items():
+        if name.startswith(CHAIN_PREFIX):
+            continue
+        values = array.tolist()
+        if array.dtype.kind == "f" and np.isnan(array).any():
+            values = [None if value != value else value for value in values]
+        fields[name] = values
+    names = list(fields)
+    return [dict(zip(names, row)) for row in zip(*fields.values())]
+
+
+def snapshot_path(directory, symbol, timestamp):
+    """Where the snapshot of symbol taken at timestamp (epoch seconds) goes."""
+    day = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date().isoformat()
+    return os.path.join(directory, symbol, day, f"{int(timestamp * 1000)}{SUFFIX}")
+
+
+def _epoch(moment):
+    if isinstance(moment, datetime.datetime):
+        return moment.timestamp()
+    return moment
+
+
+def snapshot_paths(directory, symbol, start=None, end=None):
+    """
+    [(timestamp, path),...] of the snapshots of symbol taken from start
+    to end (datetimes or epoch seconds, either can be None), oldest first.
+    """
+    start, end = _epoch(start), _epoch(end)
+    symbol_directory = os.path.join(directory, symbol)
+    if not os.path.isdir(symbol_directory):
+        return []
+    first_day = last_day = None
+    if start is not None:
+        first_day = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).date().isoformat()
+    if end is not None:
+        last_day = datetime.datetime.fromtimestamp(end, datetime.timezone.utc).date().isoformat()
+
+    snapshots = []
+    for day in sorted(os.listdir(symbol_directory)):
+        if (first_day and day < first_day) or (last_day and day > last_day):
+            continue
+        day_directory = os.path.join(symbol_directory, day)
+        for name in os.listdir(day_directory):
+            stem, extension = os.path.splitext(name)
+            if extension != SUFFIX or not stem.isdigit():
+                continue
+            timestamp = int(stem) / 1000
+            if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                continue
+            snapshots.append((timestamp, os.path.join(day_directory, name)))
+    snapshots.sort()
+    return snapshots
+
+
+def dump_columns(columns):
+    """The compressed bytes of a snapshot file holding columns ({name: array})."""
+    buffer = io.BytesIO()
+    np.save(buffer, np.array(list(columns)), allow_pickle=False)
+    for array in columns.values():
+        np.save(buffer, array, allow_pickle=False)
+    return zlib.compress(buffer.getbuffer())
+
+
+def load_columns(path):
+    """{name: array} of one snapshot file."""
+    with open(path, "rb") as snapshot_file:
+        buffer = io.BytesIO(zlib.decompress(snapshot_file.read()))
+    names = np.load(buffer, allow_pickle=False).tolist()
+    return {name: np.load(buffer, allow_pickle=False) for name in names}
+
+
+def load_contracts(path):
+    """The contracts of one snapshot file, as dicts like those in a chain."""
+    return contracts_from_columns(load_columns(path))
+
+
+def load_slice(directory, symbol, start=None, end=None, narrowed=False):
+    """
+    [(timestamp, OptionChainIndex),...] for the snapshots of symbol
+    taken from start to end, see snapshot_paths. Chains from narrowed
+    requests (only calls, only OTM strikes...) are left out unless
+    narrowed is True.
+    """
+    chains = []
+    for timestamp, path in snapshot_paths(directory, symbol, start, end):
+        columns = load_columns(path)
+        if not narrowed and is_narrowed(request_from_columns(columns)):
+            continue
+        chains.append((timestamp, OptionChainIndex(contracts_from_columns(columns))))
+    return chains
+
+
+class ChainArchive:
+    """
+    Writes option chain snapshots from a background thread.
+
+    Fields:
+    directory
+    max_queue
+    dropped
+    """
+
+    def __init__(self, directory="chains", max_queue=100, snapshot_interval=0):
+        """
+        Snapshots are written under directory. At most max_queue chains
+        wait to be written, more are dropped (and counted) rather than
+        held up. snapshot_interval is used by start_snapshots.
+        """
+        self.directory = directory
+        self.max_queue = max_queue
+        self.snapshot_interval = snapshot_interval
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self._write_loop, name="chainarchive-writer", daemon=True)
+        self.writer.start()
+
+    def record(self, symbol, chain, timestamp=None, request=None):
+        """
+        Queue a chain as returned by get_option_chain, and the request
+        parameters it was asked for with (see REQUEST_FIELDS). Never blocks.
+        """
+        try:
+            self.queue.put_nowait((timestamp or time.time(), symbol, chain, request))
+        except queue.Full:
+            self.dropped += 1
+            log("chain_archive", "warning", dropped=self.dropped, symbol=symbol)
+            return False
+        return True
+
+    def write(self, symbol, chain, timestamp, request=None):
+        """Write one snapshot now. Returns its path."""
+        path = snapshot_path(self.directory, symbol, timestamp)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as snapshot_file:
+            snapshot_file.write(dump_columns(chain_columns(chain, request)))
+        os.replace(temporary, path)
+        return path
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, symbol, chain, request = item
+            try:
+                self.write(symbol, chain, timestamp, request)
+            except (OSError, ValueError, TypeError) as err:
+                log("chain_archive", "error", symbol=symbol, error=str(err))
+
+    def start_snapshots(self, fetch, symbols, interval=None):
+        """
+        Call fetch(symbol) for each of symbols every interval seconds
+        (self.snapshot_interval by default) from a separate thread.
+        fetch is expected to get a chain with get_option_chain, which
+        records it. Does nothing if the interval is 0.
+        """
+        interval = interval or self.snapshot_interval
+        if not interval:
+            return None
+
+        def take_snapshots():
+            while not self.stopped.is_set():
+                for symbol in symbols:
+                    try:
+                        fetch(symbol)
+                    except Exception as err:
+                        log("chain_archive", "error", symbol=symbol, snapshot=True, error=str(err))
+                self.stopped.wait(interval)
+
+        thread = threading.Thread(target=take_snapshots, name="chainarchive-snapshots", daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        """Stop the snapshots, write everything still queued and stop the writer."""
+        self.stopped.set()
+        self.queue.put(None)
+        self.writer.join()
+
+
+_archive = None
+
+
+def configure(archive_config=None):
+    """
+    Set up the ChainArchive used by record() from the "chain_archive"
+    config section. No section means nothing is recorded.
+    """
+    global _archive
+    if _archive is not None:
+        _archive.close()
+    _archive = ChainArchive(**archive_config) if archive_config is not None else None
+    return _archive
+
+
+def record(symbol, chain, request=None):
+    """Record a chain in the configured ChainArchive, if there is one."""
+    if _archive is None:
+        return False
+    return _archive.record(symbol, chain, request=request)
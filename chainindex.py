@@ -0,0 +1,120 @@
+"""
+An index over an option chain for fast contract selection.
+
+Contracts are partitioned by putCall and days to expiration and sorted by
+strike within each partition. Since the absolute delta of a contract moves
+monotonically with strike, a query for contracts whose delta fits a
+stop distance only has to bisect into each partition instead of scanning
+the whole chain.
+"""
+from bisect import bisect_left
+import heapq
+
+
+def highest_delta(contract):
+    """Default scoring function: prefer the contract with the highest absolute delta."""
+    return abs(contract["delta"])
+
+
+class ChainPartition:
+    """
+    Contracts of one putCall type and expiry, sorted by strike.
+
+    Fields:
+    contracts
+    by_delta
+    """
+
+    def __init__(self, contracts):
+        """
+        Sort contracts by strike and keep a view of them in order of
+        increasing absolute delta if the deltas are monotonic in strike.
+        Otherwise (ie. bad greeks like -999.0 in the data) by_delta is None
+        and queries fall back to a scan of the partition.
+        """
+        self.contracts = sorted(contracts, key=lambda contract: contract["strikePrice"])
+
+        abs_deltas = [abs(contract["delta"]) for contract in self.contracts]
+        pairs = list(zip(abs_deltas, abs_deltas[1:]))
+        if all(low <= high for low, high in pairs):
+            self.by_delta = self.contracts
+        elif all(low >= high for low, high in pairs):
+            self.by_delta = self.contracts[::-1]
+        else:
+            self.by_delta = None
+
+    def __len__(self):
+        return len(self.contracts)
+
+    def delta_slice(self, move, min_loss, max_loss):
+        """
+        Contracts for which min_loss <= abs(delta) * move < max_loss,
+        ie. the loss on the contract if the underlying moves by move.
+        """
+        def loss(contract):
+            return abs(contract["delta"]) * move
+
+        if self.by_delta is None:
+            return [
+                contract
+                for contract in self.contracts
+                if min_loss <= loss(contract) < max_loss
+            ]
+        start = bisect_left(self.by_delta, min_loss, key=loss)
+        end = bisect_left(self.by_delta, max_loss, key=loss)
+        return self.by_delta[start:end]
+
+
+class OptionChainIndex:
+    """
+    Option chain partitioned by (putCall, daysToExpiration).
+
+    Fields:
+    partitions
+    """
+
+    def __init__(self, contracts):
+        """Build the index from a list of contracts as returned by botutils.flatten()."""
+        grouped = {}  # (putCall, daysToExpiration): [contract,...]
+        for contract in contracts:
+            key = (contract["putCall"], contract["daysToExpiration"])
+            grouped.setdefault(key, []).append(contract)
+
+        self.partitions = {key: ChainPartition(group) for key, group in grouped.items()}
+
+    @classmethod
+    def from_chain(cls, chain):
+        """Build the index from the nested output of botutils.get_option_chain()."""
+        return cls(
+            contract
+            for key in ["callExpDateMap", "putExpDateMap"]
+            for date in chain[key]
+            for strike in chain[key][date]
+            for contract in chain[key][date][strike]
+        )
+
+    def __len__(self):
+        return sum(len(partition) for partition in self.partitions.values())
+
+    def candidates(
+        self, put_call, mindte, maxdte, move_to_stop, min_loss, max_loss, predicate=None,
+    ):
+        """
+        Yields contracts of the given putCall type expiring within
+        [mindte, maxdte] days whose loss on a move of move_to_stop in the
+        underlying lies within [min_loss, max_loss).
+        predicate is an optional further filter taking a contract.
+        """
+        for (partition_put_call, dte), partition in self.partitions.items():
+            if partition_put_call != put_call or not mindte <= dte <= maxdte:
+                continue
+            for contract in partition.delta_slice(move_to_stop, min_loss, max_loss):
+                if predicate is None or predicate(contract):
+                    yield contract
+
+    def top_k(self, k, score=highest_delta, **query):
+        """
+        The k best candidates (see candidates()) according to score,
+        best first. Uses a heap so the candidates are never fully sorted.
+        """
+        return heapq.nlargest(k, self.candidates(**query), key=score)
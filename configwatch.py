@@ -0,0 +1,167 @@
+"""
+Reloads config.json while the bot is running.
+
+ConfigWatcher checks the file's modification time on an interval. A
+changed file is validated in full before anything is applied, so a
+half-saved or mistyped file leaves the running settings alone. Valid
+changes are applied between messages: the OrderManager gets a new
+OrderManagerConfig in one assignment, and the Signaler is only reseeded
+(from the minute closes it already has) when the EMA lengths or the
+timeframe change.
+"""
+import asyncio
+import json
+import os
+
+from ordermanager import OrderManagerConfig
+
+
+# Sections only read at startup.
+RESTART_SECTIONS = ("broker", "pipeline", "ledger", "memory", "stream", "profiler", "clouds",
+                    "chain_archive", "indicators", "average_range_indicator")
+
+
+def validate_config(config_json):
+    """
+    Checks a parsed config and returns the OrderManagerConfig for it.
+    Raises ValueError listing every problem found.
+    """
+    problems = []
+    for key in ("ordermanager", "short_ema", "long_ema"):
+        if key not in config_json:
+            problems.append(f"missing {key}")
+    if problems:
+        raise ValueError("Invalid config: " + ", ".join(problems))
+
+    for key in ("short_ema", "long_ema"):
+        if not isinstance(config_json[key], int) or config_json[key] < 1:
+            problems.append(f"{key} must be a positive integer")
+
+    ordermanager_configs = config_json["ordermanager"]
+    for key, value in ordermanager_configs.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            problems.append(f"ordermanager.{key} must be a number")
+    try:
+        ordermanager_config = OrderManagerConfig(**ordermanager_configs)
+    except TypeError as err:
+        raise ValueError(f"Invalid config: {err}") from err
+    if problems:
+        raise ValueError("Invalid config: " + ", ".join(problems))
+
+    if not isinstance(ordermanager_config.timeframe_minutes, int) \
+            or ordermanager_config.timeframe_minutes < 1:
+        problems.append("timeframe_minutes must be a positive integer")
+    if ordermanager_config.mindte > ordermanager_config.maxdte:
+        problems.append("mindte is greater than maxdte")
+    if ordermanager_config.min_contract_price >= ordermanager_config.max_contract_price:
+        problems.append("min_contract_price is not less than max_contract_price")
+    if ordermanager_config.min_loss > ordermanager_config.max_loss:
+        problems.append("min_loss is greater than max_loss")
+    if ordermanager_config.contract_candidates < 1:
+        problems.append("contract_candidates must be at least 1")
+    if problems:
+        raise ValueError("Invalid config: " + ", ".join(problems))
+    return ordermanager_config
+
+
+class ConfigChange:
+    """
+    A validated change to the config, ready to apply.
+
+    Fields:
+    config_json
+    ordermanager_config
+    reseed
+    restart_sections
+    """
+
+    def __init__(self, old_json, new_json, ordermanager_config):
+        self.config_json = new_json
+        self.ordermanager_config = ordermanager_config
+
+        # (short, long, timeframe) if the Signaler needs reseeding, else None
+        self.reseed = None
+        new_ema = (
+            new_json["short_ema"], new_json["long_ema"], ordermanager_config.timeframe_minutes)
+        old_ema = (
+            old_json["short_ema"], old_json["long_ema"],
+            old_json["ordermanager"]["timeframe_minutes"])
+        if new_ema != old_ema:
+            self.reseed = new_ema
+
+        self.restart_sections = [
+            section for section in RESTART_SECTIONS
+            if old_json.get(section) != new_json.get(section)
+        ]
+
+    def apply_to_signaler(self, signaler, ui):
+        if self.reseed:
+            signaler.reseed(*self.reseed)
+            ui.messages.append(
+                f"Config reloaded: EMAs reseeded with lengths {self.reseed[0]}/{self.reseed[1]} "
+                f"on {self.reseed[2]} minute candles.")
+
+    def apply_to_order_manager(self, ordmngr, ui):
+        ordmngr.config = self.ordermanager_config
+        ui.messages.append("Config reloaded: order manager settings updated.")
+        if self.restart_sections:
+            ui.messages.append(
+                "Config changes to " + ", ".join(self.restart_sections)
+                + " take effect after a restart.")
+
+    def apply(self, signaler, ordmngr, ui):
+        self.apply_to_signaler(signaler, ui)
+        self.apply_to_order_manager(ordmngr, ui)
+
+
+class ConfigWatcher:
+    """
+    Polls a config file for changes.
+
+    Fields:
+    path
+    config_json
+    interval
+    """
+
+    def __init__(self, path, config_json, ui, interval=2.0):
+        """config_json is the config the bot was started with."""
+        self.path = path
+        self.config_json = config_json
+        self.ui = ui
+        self.interval = interval
+        self.mtime = self._mtime()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self):
+        """A ConfigChange if the file changed to a valid new config, otherwise None."""
+        mtime = self._mtime()
+        if mtime is None or mtime == self.mtime:
+            return None
+        self.mtime = mtime
+        try:
+            with open(self.path) as config_file:
+                new_json = json.load(config_file)
+            ordermanager_config = validate_config(new_json)
+        except (OSError, ValueError) as err:
+            # json.JSONDecodeError is a ValueError.
+            self.ui.messages.append(f"Config not reloaded: {err}")
+            return None
+        if new_json == self.config_json:
+            return None
+        change = ConfigChange(self.config_json, new_json, ordermanager_config)
+        self.config_json = new_json
+        return change
+
+    async def watch(self, apply):
+        """Check every self.interval seconds, awaiting apply(change) for each change."""
+        while True:
+            await asyncio.sleep(self.interval)
+            change = self.check()
+            if change:
+                await apply(change)
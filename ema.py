@@ -4,6 +4,8 @@ Uses a list as input and assumes evenly spaced data.
 """
 from enum import Enum
 
+import numpy as np
+
 
 def exp_mov_avg(input_list, period, k=0):
     """
@@ -65,6 +67,51 @@ def determine_cloud_status(currentprice, short_ema, long_ema):
     return (color, location)
 
 
+# Integer codes used by the array functions below.
+# A code is the index of the enum member in these tuples.
+CLOUD_COLORS = (CloudColor.GREEN, CloudColor.RED)
+CLOUD_PRICE_LOCATIONS = (
+    CloudPriceLocation.ABOVE,
+    CloudPriceLocation.INSIDE,
+    CloudPriceLocation.BELOW,
+)
+
+
+def encode_cloud_status(status):
+    """Turn a (CloudColor, CloudPriceLocation) status into (color_code, location_code)."""
+    color, location = status
+    return CLOUD_COLORS.index(color), CLOUD_PRICE_LOCATIONS.index(location)
+
+
+def decode_cloud_status(color_code, location_code):
+    """Inverse of encode_cloud_status."""
+    return CLOUD_COLORS[color_code], CLOUD_PRICE_LOCATIONS[location_code]
+
+
+def determine_cloud_status_array(prices, short_emas, long_emas):
+    """
+    Array version of determine_cloud_status for a whole series.
+    Takes equal length sequences of prices and EMA values and returns
+    (color_codes, location_codes), two int8 arrays indexing CLOUD_COLORS
+    and CLOUD_PRICE_LOCATIONS.
+    Uses the same comparisons as the scalar version so the results match
+    it element for element.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    short_emas = np.asarray(short_emas, dtype=np.float64)
+    long_emas = np.asarray(long_emas, dtype=np.float64)
+
+    color_codes = np.where(short_emas >= long_emas, 0, 1).astype(np.int8)
+
+    above = (prices > short_emas) & (prices > long_emas)
+    below = (prices < short_emas) & (prices < long_emas)
+    location_codes = np.ones(prices.shape, dtype=np.int8)  # INSIDE
+    location_codes[above] = 0
+    location_codes[below] = 2
+
+    return color_codes, location_codes
+
+
 class Cloud:
     """
     A class to hold the values of the moving averages along with the
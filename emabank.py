@@ -0,0 +1,157 @@
+"""
+EMAs of several lengths and timeframes for one symbol, updated together.
+
+Running more clouds (5/13, 34/50, 8/9 on different timeframes...) with a
+Signaler each would mean an exp_mov_avg call per EMA per quote. EmaBank
+instead keeps every distinct (length, timeframe) EMA in one array, so a
+quote updates all of them, and the status of every cloud, in a few numpy
+operations whatever the number of clouds. The arithmetic is the same as
+exp_mov_avg's, so the values match it exactly.
+
+Configured with a "clouds" section in config.json, see clouds_from_config.
+"""
+import numpy as np
+
+from ema import Cloud, decode_cloud_status
+
+
+def clouds_from_config(clouds_config, timeframe_minutes):
+    """
+    {name: (short length, long length, timeframe)} from the "clouds" config
+    section, {name: {"short_ema":..., "long_ema":..., "timeframe_minutes":...}}.
+    timeframe_minutes is used where an entry doesn't give one.
+    """
+    return {
+        name: (
+            entry["short_ema"], entry["long_ema"],
+            entry.get("timeframe_minutes", timeframe_minutes),
+        )
+        for name, entry in (clouds_config or {}).items()
+    }
+
+
+class EmaBank:
+    """
+    Every EMA needed by a set of clouds, in arrays indexed the same way.
+
+    Fields:
+    names
+    lengths
+    timeframes
+    historical
+    current
+    color_codes
+    location_codes
+    """
+
+    def __init__(self, minute_candles, clouds):
+        """
+        clouds is {name: (short length, long length, timeframe minutes)}.
+        An EMA shared by several clouds is only held (and updated) once.
+        Seeded from minute_candles like Signaler, see seed.
+        """
+        self.names = list(clouds)
+        keys = sorted({
+            (length, timeframe)
+            for short, long, timeframe in clouds.values() for length in (short, long)
+        })
+        index = {key: position for position, key in enumerate(keys)}
+        self.lengths = np.array([length for length, _ in keys], dtype=np.int64)
+        self.timeframes = np.array([timeframe for _, timeframe in keys], dtype=np.int64)
+        self.alphas = 2 / (1 + self.lengths)
+        self.decays = 1 - self.alphas
+        self.short_index = np.array(
+            [index[(short, timeframe)] for short, _, timeframe in clouds.values()], dtype=np.intp)
+        self.long_index = np.array(
+            [index[(long, timeframe)] for _, long, timeframe in clouds.values()], dtype=np.intp)
+        self.seed(minute_candles)
+
+    def seed(self, minute_candles):
+        """
+        Calculate every EMA from minute candles, taking every timeframe'th
+        close like Signaler does. As in Signaler, the next timeframe
+        candle is completed timeframe minute candles later.
+        """
+        closes = np.array([candle["close"] for candle in minute_candles], dtype=np.float64)
+        self.historical = np.empty(len(self.lengths), dtype=np.float64)
+        for timeframe in np.unique(self.timeframes):
+            rows = self.timeframes == timeframe
+            timeframe_closes = closes[timeframe - 1::timeframe]
+            if not len(timeframe_closes):
+                timeframe_closes = closes[-1:]
+            alphas = self.alphas[rows]
+            emas = np.full(alphas.shape, timeframe_closes[0])
+            for close in timeframe_closes[1:]:
+                emas = close * alphas + emas * (1 - alphas)
+            self.historical[rows] = emas
+        self.counters = np.zeros(len(self.lengths), dtype=np.int64)
+        self.current = self.historical.copy()
+        # Scratch space so update doesn't allocate.
+        self.decayed = np.empty_like(self.historical)
+        self.price = closes[-1]
+        self.color_codes, self.location_codes = self.status_codes(self.price)
+
+    def add_candle(self, close):
+        """
+        Count a completed minute candle, updating the historical EMAs of
+        every timeframe it completes a candle of.
+        """
+        self.counters += 1
+        done = self.counters >= self.timeframes
+        if done.any():
+            alphas = self.alphas[done]
+            self.historical[done] = close * alphas + self.historical[done] * self.decays[done]
+            self.counters[done] = 0
+
+    def status_codes(self, price):
+        """
+        (color_codes, location_codes) of every cloud with self.current EMAs
+        at price, coded like ema.determine_cloud_status_array.
+        """
+        short = self.current[self.short_index]
+        long = self.current[self.long_index]
+        color_codes = (short < long).view(np.int8)
+        above = (price > short) & (price > long)
+        below = (price < short) & (price < long)
+        # INSIDE (1) unless above (0) or below (2).
+        location_codes = 1 + below.view(np.int8) - above.view(np.int8)
+        return color_codes, location_codes
+
+    def update(self, price):
+        """
+        Update every EMA and cloud with a new price.
+        Returns [(name, old status, new status),...] for the clouds whose
+        status changed.
+        """
+        self.price = price
+        # Same operations as exp_mov_avg([historical, price]), for every EMA at once.
+        np.multiply(self.historical, self.decays, out=self.decayed)
+        np.multiply(self.alphas, price, out=self.current)
+        self.current += self.decayed
+        color_codes, location_codes = self.status_codes(price)
+        changed = (color_codes != self.color_codes) | (location_codes != self.location_codes)
+        if not changed.any():
+            return []
+        changes = [
+            (
+                self.names[row],
+                decode_cloud_status(self.color_codes[row], self.location_codes[row]),
+                decode_cloud_status(color_codes[row], location_codes[row]),
+            )
+            for row in np.flatnonzero(changed)
+        ]
+        self.color_codes, self.location_codes = color_codes, location_codes
+        return changes
+
+    def cloud(self, name):
+        """A Cloud with the current EMAs and status of the cloud called name."""
+        row = self.names.index(name)
+        cloud = Cloud(
+            float(self.current[self.short_index[row]]), float(self.current[self.long_index[row]]),
+            self.price)
+        cloud.status = decode_cloud_status(self.color_codes[row], self.location_codes[row])
+        return cloud
+
+    def clouds(self):
+        """{name: Cloud} for every cloud."""
+        return {name: self.cloud(name) for name in self.names}
@@ -0,0 +1,192 @@
+"""
+Structured event log.
+
+Events are dicts with a category, a level and any other fields. They're
+handed to a writer thread through a queue, so logging from trading code
+costs an enqueue, and written as JSON lines to a file that's rotated when
+it gets too big. Noisy categories (retries, stream gaps and reconnects)
+are rate limited (a token bucket), so a retry loop can't flood the log.
+Events dropped by a limit are counted and the count is written with the
+next event that gets through. Other categories, like orders, account
+activity and signals, are never dropped: they're the record of what the
+bot did.
+
+Code logs through the module level log(), which goes to the EventLog set
+with configure() (or a default one created on first use).
+"""
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+
+# category: (burst, events per second) for the categories that can come
+# in floods. Categories not listed aren't limited.
+DEFAULT_RATE_LIMITS = {
+    "http_retry": (5, 1.0),
+    "order_retry": (5, 1.0),
+    "stream_gap": (20, 5.0),
+    "stream_disconnect": (10, 1.0),
+    "stream_reconnect": (10, 1.0),
+    "chain_archive": (20, 5.0),
+    "exposure_limit": (20, 5.0),
+}
+
+
+class RateLimiter:
+    """Token bucket per limited category."""
+
+    def __init__(self, limits=None):
+        """limits is {category: (burst, events per second)}, other categories always pass."""
+        self.limits = limits or {}
+        # category: [tokens, last refill time, dropped since the last allowed event]
+        self.buckets = {}
+
+    def allow(self, category):
+        """Returns (allowed, number dropped before this one)."""
+        limit = self.limits.get(category)
+        if limit is None:
+            return True, 0
+        burst, rate = limit
+        now = time.monotonic()
+        bucket = self.buckets.get(category)
+        if bucket is None:
+            bucket = self.buckets[category] = [burst, now, 0]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False, 0
+        bucket[0] -= 1
+        dropped, bucket[2] = bucket[2], 0
+        return True, dropped
+
+
+class EventLog:
+    """
+    Writes events to rotating JSON lines files from a background thread.
+
+    Fields:
+    path
+    max_bytes
+    backup_count
+    limiter
+    """
+
+    def __init__(
+        self, path="philbot.log.jsonl", max_bytes=10_000_000, backup_count=5,
+        rate_limits=None, flush_interval=0.5,
+    ):
+        """
+        When the file passes max_bytes it's renamed to path.1 (path.1 to
+        path.2 and so on, keeping backup_count of them) and a new one started.
+        rate_limits is {category: (burst, events per second)}, added to
+        (or replacing) DEFAULT_RATE_LIMITS.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        limits = dict(DEFAULT_RATE_LIMITS)
+        limits.update({category: tuple(limit) for category, limit in (rate_limits or {}).items()})
+        self.limiter = RateLimiter(limits)
+        self.lock = threading.Lock()
+
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, name="eventlog-writer", daemon=True)
+        self.writer.start()
+
+    def log(self, category, level="info", **fields):
+        """Queue an event unless its category is over its rate limit."""
+        with self.lock:
+            allowed, dropped = self.limiter.allow(category)
+        if not allowed:
+            return False
+        event = {
+            "ts": time.time(),
+            "category": category,
+            "level": level,
+        }
+        if dropped:
+            event["dropped_before"] = dropped
+        event.update(fields)
+        self.queue.put(event)
+        return True
+
+    def _rotate(self, log_file):
+        log_file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backup_count:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        return open(self.path, "a", encoding="utf-8")
+
+    def _write_loop(self):
+        log_file = open(self.path, "a", encoding="utf-8")
+        stop = False
+        while not stop:
+            event = self.queue.get()
+            if event is None:
+                break
+            events = [event]
+            # Collect whatever else is waiting so it's written in one go.
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                try:
+                    event = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if event is None:
+                    stop = True
+                    break
+                events.append(event)
+            log_file.write("".join(
+                json.dumps(event, default=str) + "\n" for event in events))
+            log_file.flush()
+            if log_file.tell() > self.max_bytes:
+                log_file = self._rotate(log_file)
+        log_file.close()
+
+    def close(self):
+        """Write everything still queued and stop the writer."""
+        self.queue.put(None)
+        self.writer.join()
+
+
+def read_events(path, category=None, since=None):
+    """Events from a log file, optionally one category and only after since (a datetime)."""
+    since = since.timestamp() if isinstance(since, datetime.datetime) else since
+    events = []
+    with open(path, encoding="utf-8") as log_file:
+        for line in log_file:
+            event = json.loads(line)
+            if category is not None and event["category"] != category:
+                continue
+            if since is not None and event["ts"] < since:
+                continue
+            events.append(event)
+    return events
+
+
+_event_log = None
+
+
+def configure(log_config=None):
+    """Set up the EventLog used by log() from the "logging" config section."""
+    global _event_log
+    if _event_log is not None:
+        _event_log.close()
+    _event_log = EventLog(**(log_config or {}))
+    return _event_log
+
+
+def log(category, level="info", **fields):
+    """Log an event to the configured EventLog."""
+    if _event_log is None:
+        configure()
+    return _event_log.log(category, level, **fields)
@@ -0,0 +1,162 @@
+"""
+Execution of opening limit orders.
+A LimitRepricer starts a buy limit below the ask and walks it up on a
+short schedule, replacing the working order each step, until it fills
+or reaches the maximum slippage allowed over the ask at the time of the
+decision. ExecutionStats keeps fill latency and slippage per contract,
+and how long each step of opening a position took.
+"""
+import time
+from collections import deque
+from statistics import mean
+
+
+# Order statuses (including account activity message types)
+# after which an order is no longer working.
+DONE_STATUSES = {
+    "OrderFill",
+    "OrderRejection",
+    "OrderCancelRequest",
+    "UROUT",
+    "TooLateToCancel",
+    "PENDING_CANCEL",
+    "CANCELED",
+    "FILLED",
+    "REPLACED",
+    "EXPIRED",
+}
+
+
+def round_to_tick(price, tick=0.01):
+    """Round a price to the nearest tick."""
+    return round(round(price / tick) * tick, 2)
+
+
+class LimitRepricer:
+    """
+    Schedule for stepping a buy limit toward (and past) the ask.
+
+    Fields:
+    contract
+    quantity
+    reference_ask
+    limit
+    max_limit
+    step_size
+    step_interval
+    order_ids
+    sent_time
+    last_step_time
+    steps
+    """
+
+    def __init__(
+        self, contract, quantity, bid, ask, max_slippage, step_size, step_interval,
+    ):
+        """
+        Start at the mid of bid and ask, never go above ask + max_slippage.
+        step_interval is in seconds.
+        """
+        self.contract = contract
+        self.quantity = quantity
+        self.reference_ask = ask
+        self.max_limit = round_to_tick(ask + max_slippage)
+        self.limit = min(round_to_tick((bid + ask) / 2), self.max_limit)
+        self.step_size = step_size
+        self.step_interval = step_interval
+
+        self.order_ids = []  # every order id this limit has had, newest last
+        self.sent_time = None
+        self.last_step_time = None
+        self.steps = 0
+
+    @property
+    def order_id(self):
+        """Id of the currently working order."""
+        return self.order_ids[-1] if self.order_ids else None
+
+    def sent(self, order_id):
+        """To be called with the id of each order sent (or replaced) for this limit."""
+        now = time.monotonic()
+        if self.sent_time is None:
+            self.sent_time = now
+        self.last_step_time = now
+        self.order_ids.append(order_id)
+
+    def exhausted(self):
+        """True once the limit can't be raised any further."""
+        return self.limit >= self.max_limit
+
+    def due(self, now=None):
+        """True if it's time for the next step."""
+        if self.order_id is None or self.exhausted():
+            return False
+        now = now or time.monotonic()
+        return now - self.last_step_time >= self.step_interval
+
+    def next_limit(self, live_ask=None):
+        """
+        The next limit to step to. Moves by step_size, but jumps straight
+        to a streamed ask that is already above the current limit if one
+        is given, capped at max_limit either way.
+        """
+        new_limit = self.limit + self.step_size
+        if live_ask is not None:
+            new_limit = max(new_limit, live_ask)
+        return min(round_to_tick(new_limit), self.max_limit)
+
+
+class ExecutionStats:
+    """
+    Fill latency (seconds from first send to fill) and slippage
+    (fill price - ask at the time of the decision) per contract.
+    """
+
+    def __init__(self, max_opens=500):
+        """
+        self.fills is {contract: [(latency, slippage, steps),...]}
+        self.opens is [(symbol, {step: seconds}),...] for the last max_opens open attempts.
+        """
+        self.fills = {}
+        self.opens = deque(maxlen=max_opens)
+
+    def record_fill(self, repricer, fill_price=None):
+        """
+        Record a fill for the order worked by repricer.
+        Uses the working limit if the fill price isn't known.
+        """
+        if fill_price is None:
+            fill_price = repricer.limit
+        latency = time.monotonic() - repricer.sent_time
+        slippage = fill_price - repricer.reference_ask
+        self.fills.setdefault(repricer.contract, []).append(
+            (latency, slippage, repricer.steps))
+        return latency, slippage
+
+    def record_open(self, symbol, timings):
+        """Record the latency breakdown ({step: seconds}) of an attempt to open a position."""
+        self.opens.append((symbol, timings))
+
+    def open_summary(self):
+        """Mean seconds per step over the recorded open attempts."""
+        steps = {}
+        for _, timings in self.opens:
+            for step, seconds in timings.items():
+                steps.setdefault(step, []).append(seconds)
+        return {step: mean(seconds) for step, seconds in steps.items()}
+
+    def summary(self, contract):
+        """Returns a dict of fill count, mean/max latency and mean/max slippage for contract."""
+        fills = self.fills.get(contract)
+        if not fills:
+            return {"fills": 0}
+        latencies = [latency for latency, _, _ in fills]
+        slippages = [slippage for _, slippage, _ in fills]
+        return {
+            "fills": len(fills),
+            "mean_latency": mean(latencies),
+            "max_latency": max(latencies),
+            "mean_slippage": mean(slippages),
+            "max_slippage": max(slippages),
+            "mean_steps": mean(steps for _, _, steps in fills),
+        }
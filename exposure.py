@@ -0,0 +1,148 @@
+"""
+Running totals of the bot's option exposure.
+
+ExposureAggregator keeps, for every contract held or being bought, the
+filled quantity and the quantity in working buy orders of each holder
+(the order managers of strategies sharing an account share one
+aggregator) and the latest mark and delta. Every change to one contract
+(a fill, a new order, a quote)
+takes its old contribution out of the totals and puts the new one in, so
+the net delta, notional and premium at risk per underlying and overall
+are always current without walking the positions. Limit checks against
+them cost the same however many positions there are.
+"""
+
+# Shares per option contract.
+MULTIPLIER = 100
+
+
+class Totals:
+    """
+    Exposure summed over some contracts.
+
+    Fields:
+    delta
+    notional
+    risk
+    """
+
+    def __init__(self):
+        # Share equivalent delta.
+        self.delta = 0.0
+        # Market value of the filled contracts.
+        self.notional = 0.0
+        # Premium that can be lost, filled and working buys.
+        self.risk = 0.0
+
+    def add(self, contribution, sign=1):
+        delta, notional, risk = contribution
+        self.delta += sign * delta
+        self.notional += sign * notional
+        self.risk += sign * risk
+
+    def as_dict(self):
+        return {"delta": self.delta, "notional": self.notional, "risk": self.risk}
+
+
+class ExposureAggregator:
+    """
+    Exposure per contract, per underlying and overall.
+
+    Fields:
+    contracts
+    by_underlying
+    total
+    """
+
+    def __init__(self, multiplier=MULTIPLIER):
+        self.multiplier = multiplier
+        # contract: [mark, delta, {holder: [filled quantity, working buy quantity]}]
+        self.contracts = {}
+        # underlying symbol: Totals
+        self.by_underlying = {}
+        self.total = Totals()
+
+    def contribution(self, contract):
+        """(delta, notional, risk) of one contract, over every holder."""
+        mark, delta, holdings = self.contracts[contract]
+        quantity = sum(held for held, _ in holdings.values())
+        return (
+            quantity * delta * self.multiplier,
+            sum(abs(held) for held, _ in holdings.values()) * mark * self.multiplier,
+            sum(max(held + pending, 0) for held, pending in holdings.values())
+            * mark * self.multiplier,
+        )
+
+    def _change(self, contract, holder=None, holding=None, mark=None, delta=None):
+        underlying = contract.split("_")[0]
+        totals = self.by_underlying.setdefault(underlying, Totals())
+        entry = self.contracts.get(contract)
+        if entry is None:
+            entry = self.contracts[contract] = [0.0, 0.0, {}]
+        else:
+            old = self.contribution(contract)
+            totals.add(old, -1)
+            self.total.add(old, -1)
+
+        if mark is not None:
+            entry[0] = mark
+        if delta is not None:
+            entry[1] = delta
+        if holding is not None:
+            if any(holding):
+                entry[2][holder] = holding
+            else:
+                entry[2].pop(holder, None)
+
+        if not entry[2]:
+            # Nothing held or working, stop tracking it.
+            del self.contracts[contract]
+            return
+        new = self.contribution(contract)
+        totals.add(new)
+        self.total.add(new)
+
+    def set_holding(self, contract, quantity, pending, mark=None, delta=None, holder=None):
+        """
+        Set holder's filled and working buy quantities of contract, and its
+        mark and delta if known (ie. from the chain when it's first bought).
+        """
+        self._change(contract, holder, [quantity, pending], mark, delta)
+
+    def update_quote(self, contract, mark=None, delta=None):
+        """New mark and/or delta for contract. Returns False if it isn't tracked."""
+        if contract not in self.contracts:
+            return False
+        self._change(contract, mark=mark, delta=delta)
+        return True
+
+    def quote(self, contract):
+        """(mark, delta) of a tracked contract, or None."""
+        entry = self.contracts.get(contract)
+        return (entry[0], entry[1]) if entry else None
+
+    def totals(self, underlying=None):
+        """Totals for underlying, or overall."""
+        if underlying is None:
+            return self.total
+        return self.by_underlying.get(underlying) or Totals()
+
+    def check(self, underlying, config, quantity=0, mark=0.0, delta=0.0):
+        """
+        Why buying quantity more contracts of underlying (at mark, with
+        delta) would break a limit in config (an OrderManagerConfig), or
+        None if it wouldn't. A limit of 0 is no limit.
+        """
+        added_delta = quantity * delta * self.multiplier
+        added_risk = quantity * mark * self.multiplier
+        symbol_totals = self.totals(underlying)
+        limits = (
+            ("net delta", self.total.delta + added_delta, config.max_net_delta),
+            (f"{underlying} net delta", symbol_totals.delta + added_delta, config.max_symbol_delta),
+            ("premium at risk", self.total.risk + added_risk, config.max_risk),
+            (f"{underlying} premium at risk", symbol_totals.risk + added_risk, config.max_symbol_risk),
+        )
+        for name, value, limit in limits:
+            if limit and abs(value) > limit:
+                return f"{name} would be {value:.0f}, limit {limit:.0f}"
+        return None
@@ -0,0 +1,301 @@
+"""
+Runs several strategies off one stream connection.
+
+Every strategy has its own config, Signaler, OrderManager and account id,
+but they all share one StreamClient login, one subscription per service
+and one MessageHandler. A message is parsed once; the stored data is then
+handed to each strategy trading that symbol through a read-only view, so
+one strategy can't change what the next one sees.
+
+Configured with a "strategies" list in config.json, see StrategyHub.from_config.
+"""
+import asyncio
+import time
+import types
+
+from msghandler import MessageHandler
+from signaler import Signaler
+from ordermanager import OrderManager, OrderManagerConfig
+from optionstream import OptionSubscriptions
+from ledger import Ledger
+from indicators import indicators_from_config
+from emabank import clouds_from_config
+from exposure import ExposureAggregator
+from reconnect import StreamSession
+from reconcile import GapDetector, Reconciler, apply_account_state
+from qos import qos_from_config
+from botutils import get_history
+from eventlog import log
+
+
+class Strategy:
+    """
+    One independent strategy instance.
+
+    Fields:
+    name
+    account_id
+    signaler
+    ordmngr
+    """
+
+    def __init__(self, name, account_id, signaler, ordmngr):
+        self.name = name
+        self.account_id = account_id
+        self.signaler = signaler
+        self.ordmngr = ordmngr
+
+    @property
+    def symbol(self):
+        return self.signaler.symbol
+
+    def handles_activity(self, account, symbol, data):
+        """
+        True if an account activity message is about one of this strategy's
+        orders. Only the order id is matched: strategies can hold the same
+        contract, and each fill must only be applied by the one that sent it.
+        """
+        if account is not None and str(account) != str(self.account_id):
+            return False
+        position = self.ordmngr.current_positions.get(symbol)
+        if position is None or "OrderKey" not in data:
+            return False
+        return int(data["OrderKey"]) in position.associated_orders
+
+    def update(self, client, service, data, ui):
+        """Run the signaler and order manager on new data for self.symbol."""
+        signal, newprice = self.signaler.update(service, data, ui)
+        return self.ordmngr.update_from_quote(
+            client, self.account_id, self.signaler.cloud, self.symbol, signal, newprice, ui)
+
+
+class StrategyHub:
+    """
+    Parses each stream message once and fans it out to the strategies.
+
+    Fields:
+    client
+    msghandler
+    strategies
+    ledger
+    """
+
+    def __init__(self, client, msghandler, strategies, ui, ledger=None):
+        """ledger is the Ledger shared by the strategies, if any."""
+        self.client = client
+        self.msghandler = msghandler
+        self.strategies = strategies
+        self.ui = ui
+        self.ledger = ledger
+        # symbol: [Strategy,...]
+        self.by_symbol = {}
+        for strategy in strategies:
+            self.by_symbol.setdefault(strategy.symbol, []).append(strategy)
+
+    @classmethod
+    def from_config(cls, client, config_json, account_id, ui, msghandler=None):
+        """
+        Builds the strategies from config_json["strategies"], a list of
+        {"name":..., "symbol":..., "account_id":..., "short_ema":...,
+        "long_ema":..., "ordermanager": {...}, "indicators": {...}, "clouds": {...}}.
+        Missing keys come from the top level of the config, and the
+        "ordermanager" entries override the top level "ordermanager" ones.
+        With a "ledger" section each strategy records under its own name,
+        all through one Ledger.
+        """
+        strategy_configs = config_json["strategies"]
+        symbols = {entry.get("symbol", "SPY") for entry in strategy_configs}
+        msghandler = msghandler or MessageHandler(symbols=symbols)
+
+        strategies = []
+        ledger = None
+        if "ledger" in config_json:
+            ledger = Ledger(
+                config_json["ledger"].get("path", "ledger.db"),
+                config_json["ledger"].get("strategy", "default"))
+        # account id: ExposureAggregator, so the limits cover the whole account.
+        exposures = {}
+        for index, entry in enumerate(strategy_configs):
+            name = entry.get("name", f"strategy{index}")
+            ordermanager_configs = config_json.get("ordermanager", {}) | entry.get("ordermanager", {})
+            signaler = Signaler(
+                client, entry.get("symbol", "SPY"),
+                entry.get("short_ema", config_json.get("short_ema")),
+                entry.get("long_ema", config_json.get("long_ema")),
+                ordermanager_configs["timeframe_minutes"],
+                indicators_from_config(entry.get("indicators", config_json.get("indicators", {}))),
+                clouds_from_config(
+                    entry.get("clouds", config_json.get("clouds")),
+                    ordermanager_configs["timeframe_minutes"]),
+            )
+            strategy_account_id = entry.get("account_id", account_id)
+            range_indicator = signaler.indicator(
+                entry.get("average_range_indicator", config_json.get("average_range_indicator")))
+            ordmngr = OrderManager(
+                OrderManagerConfig(**ordermanager_configs), quotes=msghandler,
+                ledger=ledger.for_strategy(name) if ledger else None,
+                exposure=exposures.setdefault(strategy_account_id, ExposureAggregator()),
+                range_indicators={signaler.symbol: range_indicator} if range_indicator else None)
+            strategies.append(Strategy(name, strategy_account_id, signaler, ordmngr))
+        return cls(client, msghandler, strategies, ui, ledger)
+
+    @property
+    def symbols(self):
+        return sorted(self.by_symbol)
+
+    def handle(self, msg):
+        """Stream handler: parse msg once and pass the result to the strategies it concerns."""
+        try:
+            newdatafor = self.msghandler.handle(msg)
+        except KeyError as err:
+            self.ui.messages.append(err)
+            return None
+
+        if newdatafor and newdatafor[0][1] == "OPTION":
+            # Option quotes are stored for pricing orders and update the exposure totals.
+            for symbol, _ in newdatafor:
+                for strategy in self.strategies:
+                    strategy.ordmngr.update_from_option_quote(
+                        symbol, self.msghandler.last_messages[symbol])
+            return None
+
+        if newdatafor and newdatafor[0][1] == "ACCT_ACTIVITY":
+            for (symbol, msg_type, msg_data), _ in newdatafor:
+                account = msg_data.get("Account")
+                for strategy in self.strategies:
+                    if strategy.handles_activity(account, symbol, msg_data):
+                        strategy.ordmngr.update_from_account_activity(
+                            symbol, msg_type, msg_data, self.ui)
+            self.render()
+            return None
+
+        for symbol, service in newdatafor:
+            data = types.MappingProxyType(self.msghandler.last_messages[symbol])
+            for strategy in self.by_symbol.get(symbol, ()):
+                strategy.update(self.client, service, data, self.ui)
+        self.render()
+
+    def display_state(self):
+        """(msghandler, clouds, positions) for the UI."""
+        # The UI shows one cloud per symbol, the first strategy's.
+        clouds = {
+            symbol: strategies[0].signaler.cloud for symbol, strategies in self.by_symbol.items()
+        }
+        positions = [
+            position for strategy in self.strategies
+            for position in strategy.ordmngr.current_positions.values()
+        ]
+        return self.msghandler, clouds, positions
+
+    def render(self):
+        self.ui.interface_clear()
+        self.ui.dispatch_display(*self.display_state())
+
+    def backfill(self, candles_for):
+        """Backfill the signalers of the strategies trading the symbols in candles_for, {symbol: history candles}."""
+        for strategy in self.strategies:
+            if strategy.symbol in candles_for:
+                strategy.signaler.backfill(candles_for[strategy.symbol], self.ui)
+
+    def held_candles(self, symbol):
+        """Number of streamed candles of symbol held for a backfill."""
+        return sum(
+            len(strategy.signaler.held_candles)
+            for strategy in self.strategies if strategy.symbol == symbol
+        )
+
+    async def read_stream(self, stream_client, stream_config=None, tasks=()):
+        """
+        Subscribes once for every symbol any strategy trades and
+        handles messages as they arrive, reconnecting if the connection
+        drops (see reconnect.StreamSession). Every account is reconciled
+        after a reconnect or a gap in the stream, see reconcile.py.
+        The QoS level is adjusted to how long handling takes, see qos.py.
+        tasks are background tasks to stop along with the stream.
+        """
+        stream_config = stream_config or {}
+        qos = qos_from_config(stream_client, stream_config)
+
+        # One detector per account, so each account's Reconciler sees every gap.
+        ordmngrs_for = {}
+        for strategy in self.strategies:
+            ordmngrs_for.setdefault(strategy.account_id, []).append(strategy.ordmngr)
+        gap_detectors = {account_id: GapDetector() for account_id in ordmngrs_for}
+
+        def handler(msg):
+            for gap_detector in gap_detectors.values():
+                gap_detector.observe(msg)
+            start = time.perf_counter()
+            self.handle(msg)
+            if qos:
+                qos.record(time.perf_counter() - start)
+
+        stream_client.add_chart_equity_handler(handler)
+        stream_client.add_level_one_equity_handler(handler)
+        stream_client.add_account_activity_handler(handler)
+        stream_client.add_level_one_option_handler(handler)
+        option_subscriptions = OptionSubscriptions()
+
+        async def subscribe():
+            if qos:
+                await qos.apply()
+            await stream_client.chart_equity_subs(self.symbols)
+            await stream_client.level_one_equity_subs(self.symbols)
+            await stream_client.account_activity_sub()
+            option_subscriptions.reset()
+            await option_subscriptions.sync(stream_client)
+
+        async def apply_state(ordmngr, state):
+            apply_account_state(ordmngr, state, self.ui)
+        reconcilers = [
+            Reconciler(self.client, account_id, ordmngrs, self.ui, gap_detectors[account_id])
+            for account_id, ordmngrs in ordmngrs_for.items()
+        ]
+
+        # symbol: candles held for it when fetching its history last
+        # failed, for the symbols whose backfill is due a retry.
+        retry_backfill_after = {}
+
+        async def backfill(symbols):
+            # One history request per symbol, shared by its strategies.
+            candles_for = {}
+            for symbol in symbols:
+                retry_backfill_after.pop(symbol, None)
+                try:
+                    candles_for[symbol] = await asyncio.to_thread(get_history, self.client, symbol)
+                except Exception as err:
+                    retry_backfill_after[symbol] = self.held_candles(symbol)
+                    log("backfill", "error", symbol=symbol, error=str(err))
+                    self.ui.messages.append(f"Couldn't backfill {symbol}, retrying on the next candle.")
+            self.backfill(candles_for)
+
+        async def on_reconnect():
+            self.ui.messages.append("Stream reconnected.")
+            # Account activity may have been missed while disconnected.
+            for reconciler in reconcilers:
+                reconciler.detector.reset()
+                reconciler.request()
+            for strategy in self.strategies:
+                strategy.signaler.expect_backfill()
+            await backfill(self.symbols)
+
+        async def after_message():
+            due = [
+                symbol for symbol, held in retry_backfill_after.items()
+                if self.held_candles(symbol) > held
+            ]
+            if due:
+                await backfill(due)
+
+        session = StreamSession(
+            stream_client, subscribe, on_reconnect,
+            initial_delay=stream_config.get("reconnect_initial_delay", 1.0),
+            max_delay=stream_config.get("reconnect_max_delay", 60.0),
+        )
+        await session.connect()
+        tasks = list(tasks) + [asyncio.create_task(option_subscriptions.maintain(
+            stream_client, *(strategy.ordmngr for strategy in self.strategies)))]
+        tasks.extend(asyncio.create_task(reconciler.run(apply_state)) for reconciler in reconcilers)
+        if qos:
+            tasks.append(asyncio.create_task(qos.run(self.ui)))
+        await session.run(after_message, tasks)
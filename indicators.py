@@ -0,0 +1,264 @@
+"""
+Streaming indicators calculated from candles.
+
+Every indicator can be seeded from a list of candles in one go and then
+updated one candle at a time without looking back at old candles. Each
+declares how many numbers it keeps (state_size) so its memory use is
+known up front.
+
+Candles are dicts in the format of the price history endpoint:
+{"open":..., "high":..., "low":..., "close":..., "volume":..., "datetime": ms}
+"""
+import abc
+import datetime
+import math
+from collections import deque
+
+
+class Indicator(abc.ABC):
+    """
+    Base class for streaming indicators.
+
+    Fields:
+    name
+    value
+    """
+
+    def __init__(self, name=None):
+        self.name = name or type(self).__name__.lower()
+        self.value = None
+
+    def reset(self):
+        """Forget everything seen so far."""
+        self.value = None
+
+    def seed(self, candles):
+        """Start over from a list of candles, oldest first. Returns the value."""
+        self.reset()
+        for candle in candles:
+            self.update(candle)
+        return self.value
+
+    @abc.abstractmethod
+    def update(self, candle):
+        """Add one completed candle. Returns the new value."""
+
+    @property
+    @abc.abstractmethod
+    def state_size(self):
+        """How many numbers the indicator keeps between updates."""
+
+
+class EMA(Indicator):
+    """Exponential moving average of closes, the same recursion as ema.exp_mov_avg."""
+
+    def __init__(self, length, name=None):
+        super().__init__(name or f"ema{length}")
+        self.length = length
+        self.k = 2 / (1 + length)
+
+    def update(self, candle):
+        close = candle["close"]
+        self.value = close if self.value is None else close * self.k + self.value * (1 - self.k)
+        return self.value
+
+    @property
+    def state_size(self):
+        return 1
+
+
+class SMA(Indicator):
+    """Simple moving average of the last length closes."""
+
+    def __init__(self, length, name=None):
+        super().__init__(name or f"sma{length}")
+        self.length = length
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.window = deque(maxlen=self.length)
+        self.total = 0.0
+
+    def seed(self, candles):
+        # Only the last length candles matter.
+        self.reset()
+        for candle in candles[-self.length:]:
+            self.update(candle)
+        return self.value
+
+    def update(self, candle):
+        close = candle["close"]
+        if len(self.window) == self.length:
+            self.total -= self.window[0]
+        self.window.append(close)
+        self.total += close
+        self.value = self.total / len(self.window)
+        return self.value
+
+    @property
+    def state_size(self):
+        return self.length + 1
+
+
+class Stdev(Indicator):
+    """
+    Sample standard deviation of the last length closes, kept with
+    Welford's method so each update is O(1) and numerically stable.
+    Matches botutils.get_std_dev_for_symbol over the same candles.
+    """
+
+    def __init__(self, length, name=None):
+        super().__init__(name or f"stdev{length}")
+        self.length = length
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.window = deque(maxlen=self.length)
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared differences from the mean
+
+    def seed(self, candles):
+        self.reset()
+        for candle in candles[-self.length:]:
+            self.update(candle)
+        return self.value
+
+    def update(self, candle):
+        close = candle["close"]
+        if len(self.window) == self.length:
+            # Swap the oldest close for the new one.
+            oldest = self.window[0]
+            old_mean = self.mean
+            self.mean += (close - oldest) / self.length
+            self.m2 += (close - oldest) * (close - self.mean + oldest - old_mean)
+        else:
+            count = len(self.window) + 1
+            delta = close - self.mean
+            self.mean += delta / count
+            self.m2 += delta * (close - self.mean)
+        self.window.append(close)
+        count = len(self.window)
+        self.value = math.sqrt(max(self.m2, 0.0) / (count - 1)) if count > 1 else None
+        return self.value
+
+    @property
+    def state_size(self):
+        return self.length + 2
+
+
+class ATR(Indicator):
+    """Average true range with Wilder's smoothing."""
+
+    def __init__(self, length, name=None):
+        super().__init__(name or f"atr{length}")
+        self.length = length
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.previous_close = None
+        self.count = 0
+
+    def update(self, candle):
+        high, low = candle["high"], candle["low"]
+        true_range = high - low
+        if self.previous_close is not None:
+            true_range = max(
+                true_range, abs(high - self.previous_close), abs(low - self.previous_close))
+        self.previous_close = candle["close"]
+        self.count += 1
+        if self.value is None:
+            self.value = true_range
+        else:
+            # A plain average until there are length ranges.
+            weight = min(self.count, self.length)
+            self.value += (true_range - self.value) / weight
+        return self.value
+
+    @property
+    def state_size(self):
+        return 3
+
+
+class VWAP(Indicator):
+    """Volume weighted average of the typical price, starting over each day."""
+
+    def __init__(self, name=None):
+        super().__init__(name)
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.day = None
+        self.price_volume = 0.0
+        self.volume = 0.0
+
+    def update(self, candle):
+        day = None
+        if "datetime" in candle:
+            day = datetime.date.fromtimestamp(candle["datetime"] / 1000)
+        if day != self.day:
+            self.day = day
+            self.price_volume = 0.0
+            self.volume = 0.0
+        typical = (candle["high"] + candle["low"] + candle["close"]) / 3
+        volume = candle.get("volume") or 0
+        self.price_volume += typical * volume
+        self.volume += volume
+        self.value = self.price_volume / self.volume if self.volume else typical
+        return self.value
+
+    @property
+    def state_size(self):
+        return 3
+
+
+INDICATOR_TYPES = {
+    "ema": EMA,
+    "sma": SMA,
+    "stdev": Stdev,
+    "atr": ATR,
+    "vwap": VWAP,
+}
+
+
+def indicators_from_config(indicator_configs):
+    """
+    Builds indicators from the "indicators" config section,
+    {name: {"type": "stdev", "length": 20}, ...}.
+    """
+    indicators = []
+    for name, settings in indicator_configs.items():
+        settings = dict(settings)
+        indicator_type = settings.pop("type", name)
+        if indicator_type not in INDICATOR_TYPES:
+            raise ValueError(f"Unknown indicator type for {name}: {indicator_type}")
+        indicators.append(INDICATOR_TYPES[indicator_type](name=name, **settings))
+    return indicators
+
+
+def combine_candles(candles):
+    """One candle spanning a list of consecutive candles."""
+    combined = {
+        "open": candles[0]["open"],
+        "high": max(candle["high"] for candle in candles),
+        "low": min(candle["low"] for candle in candles),
+        "close": candles[-1]["close"],
+        "volume": sum(candle.get("volume") or 0 for candle in candles),
+    }
+    if "datetime" in candles[0]:
+        combined["datetime"] = candles[0]["datetime"]
+    return combined
+
+
+def timeframe_candles(minute_candles, timeframe_minutes):
+    """
+    Minute candles combined into complete timeframe_minutes candles,
+    grouped the same way as the [tf-1::tf] slicing of closes in Signaler.
+    """
+    return [
+        combine_candles(minute_candles[start:start + timeframe_minutes])
+        for start in range(0, len(minute_candles) - timeframe_minutes + 1, timeframe_minutes)
+    ]
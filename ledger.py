@@ -0,0 +1,282 @@
+"""
+An append-only ledger of orders, fills, stops and realized P&L.
+
+Backed by SQLite in WAL mode. Records are handed to a writer thread
+through a queue and inserted in batches, so trading code only pays for a
+put on the queue and never waits on disk. Queries open their own
+connection and can run while the writer is busy.
+"""
+import datetime
+import queue
+import sqlite3
+import threading
+import time
+
+from eventlog import log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    strategy TEXT NOT NULL,
+    contract TEXT NOT NULL,
+    order_id INTEGER,
+    action TEXT NOT NULL,
+    instruction TEXT,
+    quantity INTEGER,
+    order_type TEXT,
+    price REAL,
+    replaces INTEGER
+);
+CREATE TABLE IF NOT EXISTS fills (
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    strategy TEXT NOT NULL,
+    contract TEXT NOT NULL,
+    order_id INTEGER,
+    instruction TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    price REAL
+);
+CREATE TABLE IF NOT EXISTS stops (
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    strategy TEXT NOT NULL,
+    contract TEXT NOT NULL,
+    stop TEXT NOT NULL,
+    take_profit REAL,
+    reason TEXT
+);
+CREATE TABLE IF NOT EXISTS pnl (
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    strategy TEXT NOT NULL,
+    contract TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    realized REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_contract ON orders (contract);
+CREATE INDEX IF NOT EXISTS orders_day_strategy ON orders (day, strategy);
+CREATE INDEX IF NOT EXISTS fills_contract ON fills (contract);
+CREATE INDEX IF NOT EXISTS fills_day_strategy ON fills (day, strategy);
+CREATE INDEX IF NOT EXISTS stops_contract ON stops (contract);
+CREATE INDEX IF NOT EXISTS stops_day_strategy ON stops (day, strategy);
+CREATE INDEX IF NOT EXISTS pnl_contract ON pnl (contract);
+CREATE INDEX IF NOT EXISTS pnl_day_strategy ON pnl (day, strategy);
+"""
+
+COLUMNS = {
+    "orders": ("ts", "day", "strategy", "contract", "order_id", "action",
+               "instruction", "quantity", "order_type", "price", "replaces"),
+    "fills": ("ts", "day", "strategy", "contract", "order_id", "instruction", "quantity", "price"),
+    "stops": ("ts", "day", "strategy", "contract", "stop", "take_profit", "reason"),
+    "pnl": ("ts", "day", "strategy", "contract", "quantity", "realized"),
+}
+
+# Option prices are per share, contracts are for 100 shares.
+CONTRACT_MULTIPLIER = 100
+
+
+class Ledger:
+    """
+    Records trading activity to SQLite from a background writer thread.
+
+    Fields:
+    path
+    strategy
+    costs
+    """
+
+    def __init__(self, path="ledger.db", strategy="default", batch_size=200, flush_interval=0.5):
+        """
+        strategy is stored with every record unless one is given to the
+        record_* method (see for_strategy).
+        The writer commits when batch_size records are waiting or
+        flush_interval seconds after the first one arrived.
+        """
+        self.path = path
+        self.strategy = strategy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # (strategy, contract): (net quantity, average cost) for realized P&L.
+        self.costs = {}
+
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, name="ledger-writer", daemon=True)
+        self.ready = threading.Event()
+        # Set by the writer if it can't open the database.
+        self.setup_error = None
+        self.writer.start()
+        self.ready.wait()
+        if self.setup_error is not None:
+            raise self.setup_error
+
+    def _record(self, table, strategy, contract, *values):
+        now = time.time()
+        day = datetime.date.fromtimestamp(now).isoformat()
+        self.queue.put((table, (now, day, strategy or self.strategy, contract) + values))
+
+    def record_order(
+        self, contract, order_id, action, instruction=None, quantity=None,
+        order_type=None, price=None, replaces=None, strategy=None,
+    ):
+        """action is PLACE, REPLACE or CANCEL."""
+        self._record(
+            "orders", strategy, contract, order_id, action, instruction, quantity,
+            order_type, price, replaces)
+
+    def record_fill(self, contract, order_id, instruction, quantity, price, strategy=None):
+        """
+        Records a fill, and the realized P&L when it reduces a position.
+        instruction is "Buy" or "Sell" as in account activity messages.
+        """
+        self._record("fills", strategy, contract, order_id, instruction, quantity, price)
+        if price is None:
+            return
+        key = (strategy or self.strategy, contract)
+        held, cost = self.costs.get(key, (0, 0.0))
+        if instruction == "Buy":
+            total = held + quantity
+            self.costs[key] = (total, (held * cost + quantity * price) / total)
+            return
+        closed = min(quantity, held)
+        if closed:
+            realized = (price - cost) * closed * CONTRACT_MULTIPLIER
+            self._record("pnl", strategy, contract, closed, realized)
+        self.costs[key] = (held - closed, cost if held - closed else 0.0)
+
+    def record_stop(self, contract, stop, take_profit, reason, strategy=None):
+        """stop is stored as text since it may be a (StopType, offset) tuple."""
+        self._record("stops", strategy, contract, str(stop), take_profit, reason)
+
+    def for_strategy(self, strategy):
+        """A StrategyLedger recording to this ledger under strategy."""
+        return StrategyLedger(self, strategy)
+
+    def _write_loop(self):
+        try:
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            connection.commit()
+        except sqlite3.Error as err:
+            # Raised again by __init__, so startup fails instead of hanging.
+            self.setup_error = err
+            return
+        finally:
+            self.ready.set()
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._write_batch(connection, batch)
+            except sqlite3.Error as err:
+                # The batch is lost (and logged) but the writer keeps going.
+                log("ledger", "error", rows=len(batch), error=str(err))
+            if stop:
+                break
+        connection.close()
+
+    def _write_batch(self, connection, batch):
+        by_table = {}
+        for table, row in batch:
+            by_table.setdefault(table, []).append(row)
+        with connection:
+            for table, rows in by_table.items():
+                columns = COLUMNS[table]
+                connection.executemany(
+                    f"INSERT INTO {table} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))})",
+                    rows,
+                )
+
+    def close(self):
+        """Write everything still queued and stop the writer."""
+        self.queue.put(None)
+        self.writer.join()
+
+    def query(self, sql, parameters=()):
+        """Run a read query on a separate connection, returning rows as dicts."""
+        connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        connection.row_factory = sqlite3.Row
+        try:
+            return [dict(row) for row in connection.execute(sql, parameters)]
+        finally:
+            connection.close()
+
+    def for_contract(self, table, contract):
+        """All records in table for contract, oldest first."""
+        return self.query(
+            f"SELECT * FROM {table} WHERE contract = ? ORDER BY ts", (contract,))
+
+    def for_day(self, table, day=None, strategy=None):
+        """All records in table for day (a date or ISO string, default today), optionally one strategy."""
+        day = (day or datetime.date.today())
+        day = day.isoformat() if hasattr(day, "isoformat") else day
+        if strategy is None:
+            return self.query(f"SELECT * FROM {table} WHERE day = ? ORDER BY ts", (day,))
+        return self.query(
+            f"SELECT * FROM {table} WHERE day = ? AND strategy = ? ORDER BY ts", (day, strategy))
+
+    def daily_report(self, day=None):
+        """Per strategy and contract: orders sent, fills and realized P&L for day."""
+        day = (day or datetime.date.today())
+        day = day.isoformat() if hasattr(day, "isoformat") else day
+        return self.query(
+            """
+            SELECT strategy, contract,
+                (SELECT COUNT(*) FROM orders o
+                    WHERE o.day = c.day AND o.strategy = c.strategy AND o.contract = c.contract
+                    AND o.action = 'PLACE') AS orders,
+                (SELECT COUNT(*) FROM fills f
+                    WHERE f.day = c.day AND f.strategy = c.strategy AND f.contract = c.contract) AS fills,
+                (SELECT COALESCE(SUM(realized), 0) FROM pnl p
+                    WHERE p.day = c.day AND p.strategy = c.strategy AND p.contract = c.contract) AS realized
+            FROM (SELECT DISTINCT day, strategy, contract FROM orders WHERE day = ?) c
+            ORDER BY strategy, contract
+            """,
+            (day,),
+        )
+
+
+class StrategyLedger:
+    """
+    One strategy's view of a shared Ledger: the record_* methods pass the
+    strategy name on, so strategies share a single writer and connection.
+
+    Fields:
+    ledger
+    strategy
+    """
+
+    def __init__(self, ledger, strategy):
+        self.ledger = ledger
+        self.strategy = strategy
+
+    def record_order(self, *args, **kwargs):
+        self.ledger.record_order(*args, strategy=self.strategy, **kwargs)
+
+    def record_fill(self, *args, **kwargs):
+        self.ledger.record_fill(*args, strategy=self.strategy, **kwargs)
+
+    def record_stop(self, *args, **kwargs):
+        self.ledger.record_stop(*args, strategy=self.strategy, **kwargs)
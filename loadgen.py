@@ -0,0 +1,329 @@
+"""
+Synthetic market data load generator.
+
+Drives main.read_stream (and through it message_handling or the staged
+pipeline) with CHART_EQUITY, QUOTE and ACCT_ACTIVITY messages at a
+controlled rate, against the simulated broker. The rate is ramped up step
+by step until message latency passes a threshold, then the sustained
+messages-per-second ceiling and where it saturated are reported.
+
+Example:
+python loadgen.py --symbols 5 --start-rate 50 --threshold 0.25 --pipeline
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import random
+import time
+from statistics import mean, quantiles
+
+from main import read_stream
+from msghandler import MessageHandler
+from signaler import Signaler, Signals
+from ordermanager import OrderManager, OrderManagerConfig, Position
+from philui import PhilbotUI
+from pipeline import build_pipeline
+from simbroker import make_sim_clients, SimOrder, account_activity_xml, option_symbol
+
+
+def percentile(values, percent):
+    """percent-th percentile of values (linear interpolation)."""
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+class LoadStreamClient:
+    """
+    Stands in for the StreamClient, sending synthetic messages on a schedule.
+    Message i is due at start + i / rate; the latency of a message is the
+    time from when it was due until its handlers return, so it includes
+    any time spent waiting behind earlier messages. With the staged
+    pipeline the handlers return as soon as the message is queued, so
+    handled() is called instead once the pipeline has finished with it
+    (see pipeline.build_pipeline's on_done).
+    """
+
+    def __init__(self, client, symbols, mix, rate=100.0, seed=None, pipelined=False):
+        """
+        mix is {service: weight} for CHART_EQUITY, QUOTE and ACCT_ACTIVITY.
+        pipelined is True when messages go through the staged pipeline.
+        """
+        self.client = client
+        self.symbols = symbols
+        self.services = list(mix)
+        self.weights = [mix[service] for service in self.services]
+        self.random = random.Random(seed)
+        self.handlers = {}
+        self.prices = {symbol: 450.0 + index for index, symbol in enumerate(symbols)}
+        # Stream seq numbers count up per service.
+        self.sequences = collections.defaultdict(itertools.count)
+        self.order_ids = itertools.count(1)
+        self.pipelined = pipelined
+
+        self.latencies = {}  # service: [seconds,...] for the current step
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Change the rate, starting a new schedule and a new set of latencies."""
+        self.rate = rate
+        self.start = time.monotonic()
+        self.sent = 0
+        self.latencies = {service: [] for service in self.services}
+        # due time: service, for the messages still in the pipeline.
+        self.in_flight = {}
+
+    async def login(self):
+        pass
+
+    async def quality_of_service(self, qos_level):
+        pass
+
+    def add_chart_equity_handler(self, handler):
+        self.handlers["CHART_EQUITY"] = handler
+
+    def add_level_one_equity_handler(self, handler):
+        self.handlers["QUOTE"] = handler
+
+    def add_account_activity_handler(self, handler):
+        self.handlers["ACCT_ACTIVITY"] = handler
+
+    def add_level_one_option_handler(self, handler):
+        self.handlers["OPTION"] = handler
+
+    async def chart_equity_subs(self, symbols, *, fields=None):
+        pass
+
+    async def level_one_equity_subs(self, symbols, *, fields=None):
+        pass
+
+    async def account_activity_sub(self):
+        pass
+
+    async def level_one_option_subs(self, symbols, *, fields=None):
+        pass
+
+    async def level_one_option_unsubs(self, symbols):
+        pass
+
+    def make_message(self, service):
+        symbol = self.random.choice(self.symbols)
+        price = self.prices[symbol] = round(
+            self.prices[symbol] + self.random.choice((-0.01, 0, 0.01)), 2)
+        content = {"seq": next(self.sequences[service]), "key": symbol}
+        if service == "QUOTE":
+            content |= {"BID_PRICE": price - 0.01, "ASK_PRICE": price + 0.01, "LAST_PRICE": price}
+        elif service == "CHART_EQUITY":
+            content |= {
+                "OPEN_PRICE": price, "HIGH_PRICE": price + 0.05, "LOW_PRICE": price - 0.05,
+                "CLOSE_PRICE": price, "VOLUME": 1000, "CHART_TIME": int(time.time() * 1000),
+            }
+        else:
+            order = SimOrder(next(self.order_ids), self.client.account_id,
+                             {"orderType": "MARKET", "orderLegCollection": [{
+                                 "instruction": "BUY_TO_OPEN", "quantity": 1,
+                                 "instrument": {"symbol": held_contract(symbol)}}]})
+            content |= {
+                "ACCOUNT": str(self.client.account_id),
+                "MESSAGE_TYPE": "OrderEntryRequest",
+                "MESSAGE_DATA": account_activity_xml("OrderEntryRequest", order),
+            }
+        return {"service": service, "timestamp": int(time.time() * 1000),
+                "command": "SUBS", "content": [content]}
+
+    async def handle_message(self):
+        due = self.start + self.sent / self.rate
+        delay = due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            # Let other tasks (pipeline stages) run even when behind.
+            await asyncio.sleep(0)
+        service = self.random.choices(self.services, self.weights)[0]
+        msg = self.make_message(service)
+        self.sent += 1
+        if self.pipelined:
+            msg["due"] = due
+            self.in_flight[due] = service
+            self.handlers[service](msg)
+            return
+        self.handlers[service](msg)
+        self.latencies[service].append(time.monotonic() - due)
+
+    def handled(self, due):
+        """Record the latency of the message due at due, which the pipeline has finished with."""
+        service = self.in_flight.pop(due, None)
+        if service is not None:
+            self.latencies[service].append(time.monotonic() - due)
+
+
+def held_contract(symbol):
+    """The option contract the load generator pretends is held for symbol."""
+    return option_symbol(symbol, datetime.date.today(), "CALL", 450)
+
+
+class NullTerminal:
+    """Enough of a blessed Terminal for PhilbotUI, with no escape sequences."""
+    height = 40
+    width = 120
+    home = clear = normal = reverse = ""
+    black_on_green = white_on_red = white_on_blue = ""
+
+    def move_y(self, y):
+        return ""
+
+
+async def ramp(
+    stream_client, pipeline, start_rate, factor, step_seconds, threshold, max_rate,
+):
+    """
+    Raise the rate by factor every step_seconds until the 99th percentile
+    latency passes threshold or the achieved rate falls below 90% of the
+    target. Returns a list of per-step results.
+    """
+    results = []
+    rate = start_rate
+    while rate <= max_rate:
+        stream_client.set_rate(rate)
+        await asyncio.sleep(step_seconds)
+        elapsed = time.monotonic() - stream_client.start
+        latencies = [
+            latency for service_latencies in stream_client.latencies.values()
+            for latency in service_latencies
+        ]
+        if stream_client.pipelined:
+            # Messages still in the pipeline are at least this late already.
+            now = time.monotonic()
+            latencies += [now - due for due in list(stream_client.in_flight)]
+        step = {
+            "target_rate": rate,
+            "achieved_rate": stream_client.sent / elapsed,
+            "p50_latency": percentile(latencies, 50),
+            "p99_latency": percentile(latencies, 99),
+            "by_service": {
+                service: mean(service_latencies)
+                for service, service_latencies in stream_client.latencies.items()
+                if service_latencies
+            },
+        }
+        if pipeline:
+            step["stages"] = {
+                name: stats["depth"] for name, stats in pipeline.stats().items()
+            }
+        results.append(step)
+        if step["p99_latency"] > threshold or step["achieved_rate"] < 0.9 * rate:
+            break
+        rate *= factor
+    return results
+
+
+def report(results, threshold):
+    """Text report of the ramp results."""
+    lines = ["target/s  achieved/s  p50 ms  p99 ms"]
+    for step in results:
+        lines.append(
+            f"{step['target_rate']:8.0f}  {step['achieved_rate']:10.1f}  "
+            f"{step['p50_latency'] * 1000:6.1f}  {step['p99_latency'] * 1000:6.1f}")
+    passed = [
+        step for step in results
+        if step["p99_latency"] <= threshold and step["achieved_rate"] >= 0.9 * step["target_rate"]
+    ]
+    if passed:
+        lines.append(f"Sustained ceiling: {passed[-1]['achieved_rate']:.1f} messages/s")
+    else:
+        lines.append("Saturated at the starting rate.")
+
+    last = results[-1]
+    if last in passed:
+        lines.append("Reached the maximum rate without saturating.")
+    else:
+        slowest = max(last["by_service"], key=last["by_service"].get)
+        lines.append(
+            f"Saturated at {last['target_rate']:.0f}/s: slowest service {slowest} "
+            f"({last['by_service'][slowest] * 1000:.1f} ms mean latency).")
+        if "stages" in last:
+            deepest = max(last["stages"], key=last["stages"].get)
+            lines.append(f"Deepest pipeline queue: {deepest} ({last['stages'][deepest]} items).")
+    return "\n".join(lines)
+
+
+async def run(args):
+    symbols = ["SPY"] + [f"SYM{index}" for index in range(1, args.symbols)]
+    client, _ = make_sim_clients({"latency": args.rest_latency, "seed": args.seed}, 123, symbols)
+    stream_client = LoadStreamClient(
+        client, symbols,
+        {"QUOTE": args.quote_weight, "CHART_EQUITY": args.chart_weight,
+         "ACCT_ACTIVITY": args.activity_weight},
+        seed=args.seed, pipelined=args.pipeline,
+    )
+
+    with open(args.config) as config_file:
+        config_json = json.load(config_file)
+    ordermanager_configs = config_json["ordermanager"]
+    signaler = Signaler(
+        client, "SPY", config_json["short_ema"], config_json["long_ema"],
+        ordermanager_configs["timeframe_minutes"])
+    msghandler = MessageHandler(symbols=set(symbols))
+    ordmngr = OrderManager(OrderManagerConfig(**ordermanager_configs), quotes=msghandler)
+    # Somewhere for the account activity messages to go. Marked as exited so
+    # quotes run the position checks (including the average range fetch)
+    # without ever sending orders.
+    for symbol in symbols:
+        ordmngr.current_positions[symbol] = Position(
+            held_contract(symbol), 0, (0, 0), Signals.EXIT)
+
+    ui = PhilbotUI(NullTerminal())
+
+    pipeline = None
+    if args.pipeline:
+        pipeline = build_pipeline(
+            client, client.account_id, signaler, msghandler, ordmngr, ui,
+            config_json.get("pipeline", {}),
+            # Latency runs from when each message was due until it's handled.
+            received_time=lambda msg: msg["due"], on_done=stream_client.handled,
+        )
+
+    with contextlib.redirect_stdout(io.StringIO()) if not args.show_ui else contextlib.nullcontext():
+        reader = asyncio.create_task(read_stream(
+            client, stream_client, client.account_id, msghandler, signaler, ordmngr, ui,
+            pipeline=pipeline,
+        ))
+        try:
+            results = await ramp(
+                stream_client, pipeline, args.start_rate, args.factor,
+                args.step_seconds, args.threshold, args.max_rate,
+            )
+        finally:
+            reader.cancel()
+    print(report(results, args.threshold))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--symbols", type=int, default=1, help="Number of symbols to send data for.")
+    parser.add_argument("--start-rate", type=float, default=50, help="Messages per second to start at.")
+    parser.add_argument("--factor", type=float, default=1.5, help="Rate multiplier per step.")
+    parser.add_argument("--max-rate", type=float, default=100000)
+    parser.add_argument("--step-seconds", type=float, default=5)
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="99th percentile latency (seconds) counted as saturated.")
+    parser.add_argument("--quote-weight", type=float, default=0.9)
+    parser.add_argument("--chart-weight", type=float, default=0.05)
+    parser.add_argument("--activity-weight", type=float, default=0.05)
+    parser.add_argument("--rest-latency", type=float, default=0.0,
+                        help="Latency of the simulated REST calls in seconds.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Use the staged pipeline instead of message_handling.")
+    parser.add_argument("--show-ui", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import os
 import asyncio
 import json
+import time
 
 from dotenv import load_dotenv
 from blessed import Terminal
@@ -12,21 +13,48 @@ from tda.streaming import StreamClient
 from msghandler import MessageHandler
 from signaler import Signaler
 from ordermanager import OrderManager, OrderManagerConfig
-from philui import PhilbotUI
+from philui import PhilbotUI, HeadlessUI
+from optionstream import OptionSubscriptions
+from pipeline import build_pipeline
+from simbroker import make_sim_clients
+from memmonitor import MemoryMonitor, bot_structures, hub_structures
+from ledger import Ledger
+from configwatch import ConfigWatcher
+from fanout import StrategyHub
+from indicators import indicators_from_config
+from emabank import clouds_from_config
+from uiprocess import SnapshotPublisher, DEFAULT_ADDRESS
+import eventlog
+import chainarchive
+from reconcile import GapDetector, Reconciler, apply_account_state
+from reconnect import StreamSession
+from qos import qos_from_config
+from profiler import SamplingProfiler
+from botutils import get_history, get_option_chain
 
 load_dotenv()
 
-client = easy_client(
-    api_key=os.getenv("client_id"),
-    redirect_uri="https://localhost",
-    token_path="token.json",
-)
-stream_client = StreamClient(
-    client, account_id=int(
-        os.getenv("account_number")))
+
+def make_clients(broker_config, account_id, symbols=("SPY",)):
+    """
+    Returns (client, stream_client) for the "broker" config section.
+    {"type": "simulated", ...} gives the local stand-ins from simbroker
+    (with a market for each of symbols), anything else (or no broker
+    section) the live TD Ameritrade clients.
+    """
+    if broker_config.get("type") == "simulated":
+        return make_sim_clients(broker_config, account_id, symbols)
+
+    client = easy_client(
+        api_key=os.getenv("client_id"),
+        redirect_uri="https://localhost",
+        token_path="token.json",
+    )
+    stream_client = StreamClient(client, account_id=account_id)
+    return client, stream_client
 
 
-def message_handling(msg, signaler, msghandler, ordmngr, ui):
+def message_handling(msg, client, account_id, signaler, msghandler, ordmngr, ui):
     """
     The main logic for handling new information from TDA.
     """
@@ -38,6 +66,12 @@ def message_handling(msg, signaler, msghandler, ordmngr, ui):
         ui.messages.append(err)
         return None
 
+    if newdatafor and newdatafor[0][1] == "OPTION":
+        # Option quotes are stored for pricing orders and update the exposure totals.
+        for symbol, _ in newdatafor:
+            ordmngr.update_from_option_quote(symbol, msghandler.last_messages[symbol])
+        return None
+
     if newdatafor and newdatafor[0][1] == "ACCT_ACTIVITY":
         return [
             ordmngr.update_from_account_activity(symbol, msg_type, msg_data, ui)
@@ -54,61 +88,281 @@ def message_handling(msg, signaler, msghandler, ordmngr, ui):
     ]
     ordermngupdate = [
         ordmngr.update_from_quote(
-            client, int(
-                os.getenv("account_number")), signaler.cloud, symbol, signal, newprice, ui)
+            client, account_id, signaler.cloud, symbol, signal, newprice, ui)
         for (symbol, (signal, newprice)) in updates
     ]
     ui.interface_clear()
     ui.dispatch_display(msghandler, {"SPY":signaler.cloud}, ordmngr.current_positions.values())
 
-async def read_stream(msghandler, signaler, ordmngr, ui):
-    await stream_client.login()
-    # await stream_client.quality_of_service(StreamClient.QOSLevel.EXPRESS)
+async def read_stream(
+    client, stream_client, account_id, msghandler, signaler, ordmngr, ui, pipeline_settings=None,
+    pipeline=None, config_watcher=None, stream_config=None, tasks=(),
+):
+    """
+    Subscribes to the streams and handles messages as they arrive.
+    If pipeline_settings is given (see pipeline.build_pipeline) or an
+    already built pipeline is passed, messages are handled by the staged
+    pipeline, otherwise by message_handling directly.
+    Config changes found by config_watcher are applied between messages.
+    If the connection drops it's reconnected (see reconnect.StreamSession,
+    stream_config is the "stream" config section), the candles missed in
+    the meantime are backfilled and orders reconciled.
+    The QoS level is adjusted to how far behind handling is, see qos.py.
+    tasks are background tasks to stop along with the stream.
+    """
+    stream_config = stream_config or {}
+    if pipeline is None and pipeline_settings is not None:
+        pipeline = build_pipeline(
+            client, account_id, signaler, msghandler, ordmngr, ui, pipeline_settings,
+        )
+
+    gap_detector = GapDetector()
+    if pipeline is None:
+        qos = qos_from_config(stream_client, stream_config)
+
+        def handler(msg):
+            gap_detector.observe(msg)
+            start = time.perf_counter()
+            result = message_handling(
+                msg, client, account_id, signaler, msghandler, ordmngr, ui)
+            if qos:
+                qos.record(time.perf_counter() - start)
+            return result
+        received = None
+    else:
+        pipeline.start()
+        # Messages are collected here and put into the pipeline by the loop
+        # below, so a full ingest queue holds up reading the stream.
+        received = []
+
+        def pipeline_load():
+            stage_totals, queued = pipeline.load()
+            return stage_totals, queued + len(received)
+        qos = qos_from_config(stream_client, stream_config, pipeline_load)
+
+        def handler(msg):
+            gap_detector.observe(msg)
+            received.append(msg)
 
     # Always add handlers before subscribing because many streams start sending
     # data immediately after success, and messages with no handlers are
-    # dropped.
-    stream_client.add_chart_equity_handler(
-        lambda msg: message_handling(msg, signaler, msghandler, ordmngr, ui)
-    )
-    await stream_client.chart_equity_subs(["SPY"])
+    # dropped. Handlers stay in place across reconnects.
+    stream_client.add_chart_equity_handler(handler)
+    stream_client.add_level_one_equity_handler(handler)
+    stream_client.add_account_activity_handler(handler)
+    # Option contracts are subscribed to as they are held or become candidates.
+    stream_client.add_level_one_option_handler(handler)
+    option_subscriptions = OptionSubscriptions()
 
-    stream_client.add_level_one_equity_handler(
-        lambda msg: message_handling(msg, signaler, msghandler, ordmngr, ui)
-    )
-    await stream_client.level_one_equity_subs(["SPY"])
+    async def subscribe():
+        if qos:
+            await qos.apply()
+        await stream_client.chart_equity_subs(["SPY"])
+        await stream_client.level_one_equity_subs(["SPY"])
+        await stream_client.account_activity_sub()
+        option_subscriptions.reset()
+        await option_subscriptions.sync(stream_client)
+
+    async def apply_state(ordmngr, state):
+        if pipeline is None:
+            apply_account_state(ordmngr, state, ui)
+        else:
+            # Applied by the execute stage so it doesn't race order handling.
+            await pipeline["execute"].put(("reconcile", state))
+    reconciler = Reconciler(client, account_id, [ordmngr], ui, gap_detector)
+
+    # Candles held by the signaler when fetching the history for a
+    # backfill last failed, None unless a retry is due.
+    retry_backfill_after = None
 
-    stream_client.add_account_activity_handler(
-        lambda msg: message_handling(msg, signaler, msghandler, ordmngr, ui)
+    async def backfill():
+        """Backfill the signaler, or leave it for the next candle if the history can't be fetched."""
+        nonlocal retry_backfill_after
+        retry_backfill_after = None
+        try:
+            candles = await asyncio.to_thread(get_history, client, signaler.symbol)
+        except Exception as err:
+            retry_backfill_after = len(signaler.held_candles)
+            eventlog.log("backfill", "error", symbol=signaler.symbol, error=str(err))
+            ui.messages.append(f"Couldn't backfill {signaler.symbol}, retrying on the next candle.")
+            return
+        if pipeline is None:
+            signaler.backfill(candles, ui)
+        else:
+            # Applied by the signal stage, before the quotes received since.
+            await pipeline["signal"].put(("backfill", candles))
+
+    async def on_reconnect():
+        ui.messages.append("Stream reconnected.")
+        gap_detector.reset()
+        # Account activity may have been missed while disconnected.
+        reconciler.request()
+        signaler.expect_backfill()
+        await backfill()
+
+    session = StreamSession(
+        stream_client, subscribe, on_reconnect,
+        initial_delay=stream_config.get("reconnect_initial_delay", 1.0),
+        max_delay=stream_config.get("reconnect_max_delay", 60.0),
     )
-    await stream_client.account_activity_sub()
+    await session.connect()
 
-    while True:
-        await stream_client.handle_message()
+    # Stopped along with the session.
+    tasks = list(tasks) + [
+        asyncio.create_task(option_subscriptions.maintain(stream_client, ordmngr)),
+        asyncio.create_task(reconciler.run(apply_state)),
+    ]
+    if pipeline is not None:
+        tasks.extend(pipeline.tasks)
+    if qos:
+        tasks.append(asyncio.create_task(qos.run(ui)))
 
+    if config_watcher:
+        async def apply_change(change):
+            if pipeline is None:
+                # Messages are handled synchronously so this is between two of them.
+                change.apply(signaler, ordmngr, ui)
+            else:
+                # Queued behind the messages already parsed.
+                await pipeline["signal"].put(("config", change))
+        tasks.append(asyncio.create_task(config_watcher.watch(apply_change)))
 
-async def main():
+    async def after_message():
+        while received:
+            await pipeline.put(received.pop(0))
+        if retry_backfill_after is not None and len(signaler.held_candles) > retry_backfill_after:
+            await backfill()
+
+    await session.run(after_message, tasks)
+
+
+def start_chain_snapshots(archive, client, config_json, symbols):
     """
-    Main function where all the modules are configured and instantiated.
+    Scheduled chain snapshots for the archive (if there is one), of the
+    section of the chain the top level ordermanager config asks for.
     """
-    term = Terminal()
-    ui = PhilbotUI(term)
-    msghandler = MessageHandler()
+    if archive is None:
+        return None
+    ordermanager_configs = config_json["ordermanager"]
+    return archive.start_snapshots(
+        lambda symbol: get_option_chain(
+            client, symbol, ordermanager_configs["strike_count"], ordermanager_configs["maxdte"] + 1,
+            from_dte=ordermanager_configs["mindte"]),
+        sorted(symbols),
+    )
 
 
+async def main():
+    """
+    Main function where all the modules are configured and instantiated.
+    """
     with open("config.json") as config_file:
         config_json = json.load(config_file)
 
-    ordermanager_configs = config_json['ordermanager']
-    short_ema_length = config_json['short_ema']
-    long_ema_length = config_json['long_ema']
+    event_log = eventlog.configure(config_json.get("logging"))
+    # Every option chain fetched is recorded when configured, see chainarchive.py.
+    archive = chainarchive.configure(config_json.get("chain_archive"))
+
+    # Closed on the way out, so everything queued is written. The event
+    # log is closed last, after anything that may still log.
+    closing = [archive.close] if archive is not None else []
+    try:
+        # kill -USR1 <pid> profiles the running bot, see profiler.py.
+        profiler = SamplingProfiler(**config_json.get("profiler", {}))
+        profiler.install()
+
+        # In headless mode the UI runs in its own process, see uiprocess.py.
+        ui_config = config_json.get("ui", {})
+        headless = ui_config.get("mode") == "headless"
+        ui = HeadlessUI() if headless else PhilbotUI(Terminal())
+        msghandler = MessageHandler()
+
+        def publish_snapshots(state):
+            publisher = SnapshotPublisher(
+                state, ui,
+                (ui_config.get("host", DEFAULT_ADDRESS[0]), ui_config.get("port", DEFAULT_ADDRESS[1])),
+                ui_config.get("interval", 0.25),
+            )
+            return asyncio.create_task(publisher.run())
+
+        def monitor_memory(structures):
+            memory_config = config_json["memory"]
+            monitor = MemoryMonitor(
+                structures,
+                budgets=memory_config.get("budgets"),
+                interval=memory_config.get("interval", 300),
+                trace=memory_config.get("trace", False),
+                on_warning=ui.messages.append,
+            )
+            return asyncio.create_task(monitor.run())
+
+        account_id = int(os.getenv("account_number", 0))
+        # Background tasks, stopped when the stream is.
+        tasks = [profiler.watch_task] if profiler.watch_task else []
+
+        if "strategies" in config_json:
+            # Several strategies sharing one stream, see fanout.py.
+            symbols = {entry.get("symbol", "SPY") for entry in config_json["strategies"]}
+            client, stream_client = make_clients(config_json.get("broker", {}), account_id, symbols)
+            start_chain_snapshots(archive, client, config_json, symbols)
+            hub = StrategyHub.from_config(client, config_json, account_id, ui)
+            if hub.ledger is not None:
+                closing.append(hub.ledger.close)
+            if "memory" in config_json:
+                tasks.append(monitor_memory(hub_structures(ui, hub)))
+            if headless:
+                tasks.append(publish_snapshots(hub.display_state))
+            await hub.read_stream(stream_client, config_json.get("stream"), tasks)
+            return
+
+        client, stream_client = make_clients(config_json.get("broker", {}), account_id)
+        start_chain_snapshots(archive, client, config_json, ["SPY"])
+
+        ordermanager_configs = config_json['ordermanager']
+        short_ema_length = config_json['short_ema']
+        long_ema_length = config_json['long_ema']
+
+        timeframe_minutes = ordermanager_configs['timeframe_minutes']
+
+        signaler = Signaler(
+            client, "SPY", short_ema_length, long_ema_length, timeframe_minutes,
+            indicators_from_config(config_json.get("indicators", {})),
+            clouds_from_config(config_json.get("clouds"), timeframe_minutes),
+        )
+        ordermanager_config = OrderManagerConfig(**ordermanager_configs)
+        ledger = None
+        if "ledger" in config_json:
+            ledger = Ledger(
+                config_json["ledger"].get("path", "ledger.db"),
+                config_json["ledger"].get("strategy", "default"),
+            )
+            closing.append(ledger.close)
+        # Opt in only: a streamed indicator replacing the average range used
+        # for stops and take profits, see OrderManager.average_range.
+        range_indicator = signaler.indicator(config_json.get("average_range_indicator"))
+        ordmngr = OrderManager(
+            ordermanager_config, quotes=msghandler, ledger=ledger,
+            range_indicators={signaler.symbol: range_indicator} if range_indicator else None)
+
+        if "memory" in config_json:
+            tasks.append(monitor_memory(bot_structures(ui, msghandler, ordmngr, signaler)))
 
-    timeframe_minutes = ordermanager_configs['timeframe_minutes']
+        if headless:
+            tasks.append(publish_snapshots(
+                lambda: (msghandler, {"SPY": signaler.cloud}, ordmngr.visible_positions())))
 
-    signaler = Signaler(client, "SPY", short_ema_length, long_ema_length, timeframe_minutes)
-    ordermanager_config = OrderManagerConfig(**ordermanager_configs)
-    ordmngr = OrderManager(ordermanager_config)
-    await read_stream(msghandler, signaler, ordmngr, ui)
+        await read_stream(
+            client, stream_client, account_id, msghandler, signaler, ordmngr, ui,
+            config_json.get("pipeline"),
+            config_watcher=ConfigWatcher("config.json", config_json, ui),
+            stream_config=config_json.get("stream"),
+            tasks=tasks,
+        )
+    finally:
+        for close in closing:
+            close()
+        event_log.close()
 
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,219 @@
+"""
+Memory accounting for long sessions.
+
+The bot runs all day and some of its structures only grow (ui.messages,
+Position.associated_orders, MessageHandler.last_messages...). MemoryMonitor
+periodically measures those structures and, optionally, takes tracemalloc
+snapshots, then writes sizes, growth rates and the lines allocating the
+most new memory to the event log. It warns when a configured budget is
+exceeded.
+
+Sizes of structures are estimated from a sample of their items so a
+measurement costs about the same however large they get.
+"""
+import asyncio
+import sys
+import time
+import tracemalloc
+from itertools import islice
+
+from eventlog import log
+
+
+def approx_size(obj, sample=32):
+    """
+    Estimated size in bytes of a container and the items in it, one level deep.
+    Measures at most sample items and scales up by the length.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        items = list(islice(obj.items(), sample))
+        if not items:
+            return size
+        item_size = sum(_shallow_size(key) + _shallow_size(value) for key, value in items) / len(items)
+        return size + int(item_size * len(obj))
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        items = list(islice(obj, sample))
+        if not items:
+            return size
+        item_size = sum(_shallow_size(item) for item in items) / len(items)
+        return size + int(item_size * len(obj))
+    return size + _shallow_size(getattr(obj, "__dict__", {}))
+
+
+def _shallow_size(obj):
+    """Size of obj plus the size of its attributes or items (not recursive)."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        obj = vars(obj)
+    if isinstance(obj, dict):
+        size += sum(sys.getsizeof(value) for value in obj.values())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(sys.getsizeof(item) for item in obj)
+    return size
+
+
+class MemoryMonitor:
+    """
+    Measures named structures on an interval.
+
+    Fields:
+    structures
+    budgets
+    interval
+    trace
+    history
+    """
+
+    def __init__(
+        self, structures, budgets=None, interval=300, trace=False, trace_frames=1,
+        top_lines=5, on_warning=print,
+    ):
+        """
+        structures: {name: function returning the object to measure}
+        budgets: {name: max bytes}, the name "traced" applies to the total
+        memory traced by tracemalloc.
+        interval is in seconds. trace turns tracemalloc on, keeping
+        trace_frames frames per allocation (more frames cost more, and
+        tracing slows every allocation down, so it's off by default).
+        on_warning is called with the text of each budget warning.
+        """
+        self.structures = structures
+        self.budgets = budgets or {}
+        self.interval = interval
+        self.trace = trace
+        self.top_lines = top_lines
+        self.on_warning = on_warning
+
+        # [(time, {name: (length, bytes)}), ...] the previous and current samples
+        self.history = []
+        # {"current": bytes, "peak": bytes} traced by tracemalloc at the
+        # latest sample, empty when not tracing.
+        self.traced = {}
+        self.snapshot = None
+        self.top_growth = []
+
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start(trace_frames)
+
+    def measure(self):
+        """{name: (length, estimated bytes)} for every structure."""
+        sizes = {}
+        for name, get in self.structures.items():
+            obj = get()
+            sizes[name] = (len(obj) if hasattr(obj, "__len__") else 1, approx_size(obj))
+        return sizes
+
+    def measure_traced(self):
+        """{"current": bytes, "peak": bytes} traced by tracemalloc, empty when not tracing."""
+        if not self.trace:
+            return {}
+        current, peak = tracemalloc.get_traced_memory()
+        return {"current": current, "peak": peak}
+
+    def take_snapshot(self):
+        """Snapshot allocations and keep the lines that grew the most since the last one."""
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        if self.snapshot is not None:
+            self.top_growth = snapshot.compare_to(self.snapshot, "lineno")[:self.top_lines]
+        self.snapshot = snapshot
+
+    def sample(self):
+        """Take a measurement (and snapshot), check budgets and return the warnings."""
+        now = time.monotonic()
+        sizes = self.measure()
+        self.traced = self.measure_traced()
+        if self.trace:
+            self.take_snapshot()
+        self.history = (self.history + [(now, sizes)])[-2:]
+
+        warnings = []
+        for name, budget in self.budgets.items():
+            if name == "traced":
+                used = self.traced.get("current")
+            else:
+                used = sizes[name][1] if name in sizes else None
+            if used is not None and used > budget:
+                warnings.append(
+                    f"Memory budget exceeded for {name}: "
+                    f"{used / 1e6:.1f} MB > {budget / 1e6:.1f} MB.")
+        for warning in warnings:
+            self.on_warning(warning)
+        return warnings
+
+    def growth_rates(self):
+        """{name: (items per hour, bytes per hour)} between the last two samples."""
+        if len(self.history) < 2:
+            return {}
+        (then, before), (now, after) = self.history
+        hours = (now - then) / 3600
+        return {
+            name: (
+                (after[name][0] - before[name][0]) / hours,
+                (after[name][1] - before[name][1]) / hours,
+            )
+            for name in after if name in before
+        }
+
+    def report(self):
+        """Lines describing the latest sample."""
+        if not self.history:
+            return []
+        _, sizes = self.history[-1]
+        rates = self.growth_rates()
+        lines = []
+        for name, (length, size) in sizes.items():
+            line = f"{name}: {length} items, ~{size / 1e3:.1f} kB"
+            if name in rates:
+                line += f" ({rates[name][0]:+.0f} items/h, {rates[name][1] / 1e3:+.1f} kB/h)"
+            lines.append(line)
+        if self.traced:
+            lines.append(
+                f"traced: {self.traced['current'] / 1e6:.1f} MB "
+                f"(peak {self.traced['peak'] / 1e6:.1f} MB)")
+        for stat in self.top_growth:
+            lines.append(f"  {stat}")
+        return lines
+
+    async def run(self):
+        """Sample every self.interval seconds and log the report."""
+        while True:
+            await asyncio.sleep(self.interval)
+            self.sample()
+            log("memory", report=self.report())
+
+
+def bot_structures(ui, msghandler, ordmngr, signaler):
+    """The structures known to grow over a session, for MemoryMonitor."""
+    return {
+        "ui.messages": lambda: ui.messages,
+        "msghandler.last_messages": lambda: msghandler.last_messages,
+        "ordmngr.current_positions": lambda: ordmngr.current_positions,
+        "associated_orders": lambda: [
+            order for position in ordmngr.visible_positions()
+            for order in position.associated_orders.items()
+        ],
+        "execution_stats.fills": lambda: ordmngr.execution_stats.fills,
+        "fallback_contracts": lambda: ordmngr.fallback_contracts,
+        "signaler.minute_candles": lambda: signaler.minute_candles,
+    }
+
+
+def hub_structures(ui, hub):
+    """
+    bot_structures for a fanout.StrategyHub, those of each strategy
+    prefixed with its name.
+    """
+    structures = {
+        "ui.messages": lambda: ui.messages,
+        "msghandler.last_messages": lambda: hub.msghandler.last_messages,
+    }
+    for strategy in hub.strategies:
+        for name, measure in bot_structures(
+                ui, hub.msghandler, strategy.ordmngr, strategy.signaler).items():
+            if name not in structures:
+                structures[f"{strategy.name}.{name}"] = measure
+    return structures
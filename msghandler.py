@@ -5,6 +5,8 @@ Stores price data for example, so even if no new price data
 was received from the last message in the stream, the most recent
 data will still be available.
 """
+import time
+
 from botutils import AccountActivityXMLParse
 
 
@@ -34,11 +36,17 @@ class MessageHandler:
             "OPEN_PRICE",
             "CLOSE_PRICE",
             "HIGH_PRICE",
-            "LOW_PRICE"}
+            "LOW_PRICE",
+            "VOLUME",
+            "CHART_TIME",
+            "MARK",
+            "DELTA"}
 
         symbols = symbols or {"SPY"}
         # symbol: {service: fields}
         self.last_messages = {symbol: {} for symbol in symbols}
+        # symbol: time.monotonic() of the last message with data for it
+        self.received_at = {}
 
     def handle(self, msg):
         """Catch-all function for handling messages from TD Ameritrade."""
@@ -52,6 +60,8 @@ class MessageHandler:
                     continue
                 msg_data = AccountActivityXMLParse().parse(
                     content["MESSAGE_DATA"])
+                # For telling accounts apart when several share the stream.
+                msg_data["Account"] = content.get("ACCOUNT")
                 # Because msg_data["Symbol"] is the contract symbol:
                 symbol = msg_data["Symbol"].split("_")[0]
                 new_data_for.append(
@@ -59,6 +69,7 @@ class MessageHandler:
             return new_data_for
 
         # should be one content for each symbol
+        received_at = time.monotonic()
         for content in msg["content"]:
             symbol = content["key"]
             relevantdata = {
@@ -67,8 +78,27 @@ class MessageHandler:
                 if field in self.fields
             }
 
+            # Option contracts are subscribed to on the fly,
+            # so they won't be in last_messages yet.
+            if service == "OPTION":
+                self.last_messages.setdefault(symbol, {})
+
             # dict update operator
             self.last_messages[symbol] |= relevantdata
+            self.received_at[symbol] = received_at
             new_data_for.append((symbol, service))
 
         return new_data_for
+
+    def option_quote(self, contract, max_age=None):
+        """
+        Returns (bid, ask) for an option contract symbol from the
+        level one option stream, or None if there is no quote
+        (or it is older than max_age seconds).
+        """
+        data = self.last_messages.get(contract)
+        if not data or "BID_PRICE" not in data or "ASK_PRICE" not in data:
+            return None
+        if max_age is not None and time.monotonic() - self.received_at[contract] > max_age:
+            return None
+        return data["BID_PRICE"], data["ASK_PRICE"]
@@ -0,0 +1,105 @@
+"""
+Keeps a level one option stream subscription for the contracts the bot
+holds and a rolling set of contracts it might buy next.
+The quotes themselves end up in the MessageHandler store like any other
+stream data, see MessageHandler.option_quote.
+"""
+import asyncio
+from collections import deque
+
+from tda.streaming import StreamClient
+
+from eventlog import log
+
+
+OPTION_FIELDS = [
+    StreamClient.LevelOneOptionFields.SYMBOL,
+    StreamClient.LevelOneOptionFields.BID_PRICE,
+    StreamClient.LevelOneOptionFields.ASK_PRICE,
+    StreamClient.LevelOneOptionFields.LAST_PRICE,
+    # For the exposure totals, see exposure.py.
+    StreamClient.LevelOneOptionFields.MARK,
+    StreamClient.LevelOneOptionFields.DELTA,
+]
+
+
+class OptionSubscriptions:
+    """
+    Tracks which option symbols should be streamed and brings the
+    stream subscription in line with that.
+
+    Fields:
+    held
+    candidates
+    subscribed
+    """
+
+    def __init__(self, max_candidates=10):
+        """max_candidates: how many of the most recent candidate contracts to keep streaming."""
+        self.held = set()
+        self.candidates = deque(maxlen=max_candidates)
+        self.subscribed = set()
+
+    def set_held(self, contracts):
+        """Replace the set of held contract symbols."""
+        self.held = set(contracts)
+
+    def add_candidates(self, contracts):
+        """Add candidate contract symbols, pushing out the oldest ones."""
+        for contract in contracts:
+            if contract in self.candidates:
+                self.candidates.remove(contract)
+            self.candidates.append(contract)
+
+    def wanted(self):
+        """All symbols that should currently be streamed."""
+        return self.held | set(self.candidates)
+
+    def update_from_order_manager(self, *ordmngrs):
+        """Pick up held contracts and fallback candidates from one or more OrderManagers."""
+        # Read through copies: with the staged pipeline the order managers
+        # are changed from the execute stage's thread.
+        self.set_held(
+            position.contract for ordmngr in ordmngrs
+            for position in ordmngr.visible_positions())
+        self.add_candidates(
+            contract["symbol"]
+            for ordmngr in ordmngrs
+            for contracts in list(ordmngr.fallback_contracts.values())
+            for contract in list(contracts)
+        )
+
+    async def sync(self, stream_client):
+        """
+        Resubscribe if the wanted symbols changed.
+        A SUBS request replaces the previous subscription for the service,
+        so the full set is sent every time.
+        """
+        wanted = self.wanted()
+        if wanted == self.subscribed:
+            return False
+
+        if wanted:
+            await stream_client.level_one_option_subs(sorted(wanted), fields=OPTION_FIELDS.copy())
+        else:
+            await stream_client.level_one_option_unsubs(sorted(self.subscribed))
+        self.subscribed = wanted
+        return True
+
+    def reset(self):
+        """Forget the current subscription, ie. after the stream reconnects."""
+        self.subscribed = set()
+
+    async def maintain(self, stream_client, *ordmngrs, interval=1.0):
+        """
+        Keep the subscription in line with the ordmngrs every interval seconds.
+        A failed request (the stream is down) is tried again next time.
+        """
+        while True:
+            self.update_from_order_manager(*ordmngrs)
+            try:
+                await self.sync(stream_client)
+            except Exception as e:
+                log("option_subs", "warning", error=str(e))
+                self.reset()
+            await asyncio.sleep(interval)
@@ -6,6 +6,8 @@ https://tda-api.readthedocs.io/en/latest/client.html#orders
 
 from enum import Enum
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import time
 
 from tda.orders.options import option_buy_to_open_limit, option_sell_to_close_limit, \
@@ -13,8 +15,13 @@ from tda.orders.options import option_buy_to_open_limit, option_sell_to_close_li
 from tda.utils import Utils
 
 from signaler import Signals
+from execution import LimitRepricer, ExecutionStats, DONE_STATUSES
 from ema import CloudColor, CloudPriceLocation
-from botutils import get_avg_range_for_symbol, get_flattened_chain
+from botutils import get_avg_range_for_symbol, get_option_chain
+from chainindex import OptionChainIndex, highest_delta
+from eventlog import log
+from ordersubmit import submit_order
+from exposure import ExposureAggregator
 
 
 class StopType(Enum):
@@ -108,6 +115,97 @@ def level_set(
     return stop, take_profit
 
 
+def put_call_for(cloud_color):
+    """The contract type ("CALL" or "PUT") traded on a cloud of cloud_color."""
+    if cloud_color == CloudColor.GREEN:
+        return "CALL"
+    if cloud_color == CloudColor.RED:
+        return "PUT"
+    return None
+
+
+# Deltas below/above which a contract is taken to be out/in the money
+# when narrowing chain requests. Kept away from 0.5 since a contract
+# just either side of the money can have a delta either side of 0.5, and
+# the move to the stop may be estimated from an older average range.
+OTM_MAX_DELTA = 0.4
+ITM_MIN_DELTA = 0.6
+# Seconds an average range is trusted for narrowing chain requests. An
+# older one could be from a much calmer or wilder part of the day.
+AVERAGE_RANGE_MAX_AGE = 300
+
+
+def chain_strike_range(move_to_stop, min_loss, max_loss):
+    """
+    "OTM" or "ITM" if every contract with min_loss <= abs(delta) * move_to_stop < max_loss
+    is out of or in the money, so the chain request can leave out the
+    other side. None if it can't be narrowed.
+    """
+    if not move_to_stop:
+        return None
+    if max_loss / move_to_stop <= OTM_MAX_DELTA:
+        return "OTM"
+    if min_loss / move_to_stop >= ITM_MIN_DELTA:
+        return "ITM"
+    return None
+
+
+def next_opening_status(cloud):
+    """
+    The EMA price would have to cross for the next opening signal,
+    and the cloud status right after it does: (level, (CloudColor, CloudPriceLocation)).
+    None if price is already past the cloud in the direction of the trend.
+    """
+    match cloud.status:
+        case (CloudColor.GREEN, CloudPriceLocation.BELOW):
+            return cloud.long_ema, (CloudColor.GREEN, CloudPriceLocation.INSIDE)
+        case (CloudColor.GREEN, CloudPriceLocation.INSIDE):
+            return cloud.short_ema, (CloudColor.GREEN, CloudPriceLocation.ABOVE)
+        case (CloudColor.RED, CloudPriceLocation.ABOVE):
+            return cloud.long_ema, (CloudColor.RED, CloudPriceLocation.INSIDE)
+        case (CloudColor.RED, CloudPriceLocation.INSIDE):
+            return cloud.short_ema, (CloudColor.RED, CloudPriceLocation.BELOW)
+    return None
+
+
+class Preselection:
+    """
+    Levels and contracts worked out ahead of an expected signal.
+
+    Fields:
+    status
+    level
+    stop
+    take_profit
+    contracts
+    created
+    """
+
+    def __init__(self, status, level, stop, take_profit, contracts):
+        self.status = status  # cloud status the signal would leave behind
+        self.level = level  # EMA price is expected to cross
+        self.stop = stop
+        self.take_profit = take_profit
+        self.contracts = contracts  # best first
+        self.created = time.monotonic()
+
+    def age(self):
+        return time.monotonic() - self.created
+
+
+_limit_padding_warned = False
+
+
+def warn_deprecated_limit_padding():
+    """Log (once per run) that ordermanager.limit_padding is set but ignored."""
+    global _limit_padding_warned
+    if _limit_padding_warned:
+        return
+    _limit_padding_warned = True
+    log("config", "warning", setting="ordermanager.limit_padding", deprecated=True,
+        reason="ignored, opening limits follow max_slippage and the reprice schedule")
+
+
 class OrderManagerConfig:
     """To hold settings relevant to the OrderManager."""
 
@@ -123,7 +221,6 @@ class OrderManagerConfig:
         min_loss,
         min_risk_reward_ratio,
         strike_count,
-        limit_padding,
         time_btwn_positions,  # This and order_timeout_length in seconds.
         order_timeout_length,
         min_cloud_width,
@@ -132,7 +229,23 @@ class OrderManagerConfig:
         take_profit_mod,
         trail_stop_mod,
         profit_step_mod,
+        contract_candidates=3,
+        max_quote_age=5,
+        max_slippage=0.05,
+        reprice_step=0.01,
+        reprice_interval=2,
+        preselect_distance=0,
+        preselect_max_age=60,
+        max_net_delta=0,
+        max_symbol_delta=0,
+        max_risk=0,
+        max_symbol_risk=0,
+        limit_padding=None,
     ):
+        # limit_padding is no longer used (opening limits are worked by a
+        # LimitRepricer) but still accepted so older configs load.
+        if limit_padding is not None:
+            warn_deprecated_limit_padding()
         self.stdev_period = (
             stdev_period  # Period of calculation of the standard deviation.
         )
@@ -149,8 +262,6 @@ class OrderManagerConfig:
         self.min_risk_reward_ratio = min_risk_reward_ratio
         self.strike_count = strike_count  # Number of strikes to ask the API for.
 
-        # If set to 0.01 the limit buy will be set at ask+.01
-        self.limit_padding = limit_padding
         self.time_btwn_positions = time_btwn_positions
         self.order_timeout_length = order_timeout_length
         self.min_cloud_width = min_cloud_width
@@ -164,6 +275,34 @@ class OrderManagerConfig:
         self.trail_stop_mod = trail_stop_mod
         self.profit_step_mod = profit_step_mod
 
+        # Number of contracts kept from each chain query. The ones not
+        # used are fallbacks in case the first choice gets rejected.
+        self.contract_candidates = contract_candidates
+        # Streamed option quotes older than this (in seconds) aren't used
+        # for limit prices.
+        self.max_quote_age = max_quote_age
+
+        # Opening limits start at the mid and are stepped up by reprice_step
+        # every reprice_interval seconds to at most the ask + max_slippage.
+        self.max_slippage = max_slippage
+        self.reprice_step = reprice_step
+        self.reprice_interval = reprice_interval
+
+        # When price comes within preselect_distance of the EMA it has to
+        # cross for an opening signal, the levels and contract are worked
+        # out ahead of time and used for preselect_max_age seconds.
+        # 0 turns it off.
+        self.preselect_distance = preselect_distance
+        self.preselect_max_age = preselect_max_age
+
+        # Limits on the totals kept by exposure.ExposureAggregator, checked
+        # before buying. Delta in shares, risk in dollars of premium.
+        # 0 means no limit.
+        self.max_net_delta = max_net_delta
+        self.max_symbol_delta = max_symbol_delta
+        self.max_risk = max_risk
+        self.max_symbol_risk = max_symbol_risk
+
 
 class Position:
     """
@@ -174,16 +313,22 @@ class Position:
     state
     net_pos
     associated_orders
+    working_buys
+    order_times
+    cancel_pending
     stop
     take_profit
     opened_time
     closed_time
+    repricer
+    ledger
     """
 
-    def __init__(self, contract, take_profit, stop, state):
+    def __init__(self, contract, take_profit, stop, state, ledger=None):
         """
         A position object initializer. This method doesn't
         actually send any orders, ie open the position.
+        ledger is an optional ledger.Ledger to record orders, fills and stops to.
         """
         self.contract = contract  # contract symbol
 
@@ -192,6 +337,12 @@ class Position:
 
         self.net_pos = 0
         self.associated_orders = {}  # {id:status} id should be int
+        # {id: quantity} of buy orders not yet filled, canceled or rejected.
+        self.working_buys = {}
+        # {id: datetime} each order was placed, for check_timeouts.
+        self.order_times = {}
+        # Ids of orders a cancel has been sent for, so it's only sent once.
+        self.cancel_pending = set()
 
         self.stop = stop  # (StopType, offset)
         self.take_profit = take_profit
@@ -199,39 +350,97 @@ class Position:
         self.opened_time = datetime.now()
         self.closed_time = None
 
+        # execution.LimitRepricer for the working buy limit, if any.
+        self.repricer = None
+
+        self.ledger = ledger
+        if ledger:
+            ledger.record_stop(contract, stop, take_profit, "initial")
+
     def __str__(self):
         return f"{self.contract}: Net position: {self.net_pos}."
 
     def open(
-        self, client, account_id, limit, ui
+        self, client, account_id, limit, ui, repricer=None,
     ):
         """
         For opening a position on the first valid buy signal.
+        If a LimitRepricer is given its starting limit is used instead of
+        limit and the order is then worked by reprice.
 
         This method should not be used to add to a position, for
         that use update_position_from_quote and increase.
         """
-        while True:
-            try:
-                response = client.place_order(account_id,
-                                              option_buy_to_open_limit(
-                                                  self.contract, 1, limit)
-                                              .build()
-                                              )
-                response.raise_for_status()
-                break
-            except Exception as e:
-                print(e)
-                time.sleep(0.5)
-
-        order_id = Utils(client, account_id).extract_order_id(response)
+        if repricer:
+            limit = repricer.limit
+        order_id = submit_order(
+            client, account_id, option_buy_to_open_limit(self.contract, 1, limit).build())
         ui.messages.append(f"Sent opening order for {self.contract}.")
+        log("order", action="open", contract=self.contract, order_id=order_id, limit=limit)
         # Since order_id is potentially None:
         if not order_id:
             return 0
 
         order_id = int(order_id)
         self.associated_orders[order_id] = "OPEN"
+        self.working_buys[order_id] = 1
+        self.order_times[order_id] = datetime.now()
+        if self.ledger:
+            self.ledger.record_order(
+                self.contract, order_id, "PLACE", "BUY_TO_OPEN", 1, "LIMIT", limit)
+        if repricer:
+            repricer.sent(order_id)
+            self.repricer = repricer
+        return order_id
+
+    def reprice(self, client, account_id, ui, live_ask=None):
+        """
+        Steps the working buy limit toward the ask if it's due,
+        replacing the order rather than canceling and resubmitting.
+        Returns the new order id or 0.
+        """
+        repricer = self.repricer
+        if not repricer:
+            return 0
+        if self.associated_orders.get(repricer.order_id) in DONE_STATUSES:
+            self.repricer = None
+            return 0
+        if not repricer.due():
+            return 0
+
+        new_limit = repricer.next_limit(live_ask)
+        try:
+            response = client.replace_order(account_id, repricer.order_id,
+                                            option_buy_to_open_limit(
+                                                self.contract, repricer.quantity, new_limit)
+                                            .build()
+                                            )
+            response.raise_for_status()
+            order_id = Utils(client, account_id).extract_order_id(response)
+        except Exception as e:
+            # Most likely filled or canceled in the meantime, try again next step.
+            ui.messages.append(f"Exception replacing order for {self.contract}:\n{e}")
+            log("order_error", "warning", action="replace", contract=self.contract,
+                order_id=repricer.order_id, error=str(e))
+            return 0
+
+        self.associated_orders[repricer.order_id] = "REPLACED"
+        self.working_buys.pop(repricer.order_id, None)
+        repricer.limit = new_limit
+        repricer.steps += 1
+        if not order_id:
+            self.repricer = None
+            return 0
+        order_id = int(order_id)
+        self.associated_orders[order_id] = "OPEN"
+        self.working_buys[order_id] = repricer.quantity
+        self.order_times[order_id] = datetime.now()
+        if self.ledger:
+            self.ledger.record_order(
+                self.contract, order_id, "REPLACE", "BUY_TO_OPEN", repricer.quantity, "LIMIT",
+                new_limit, replaces=repricer.order_id)
+        repricer.sent(order_id)
+        ui.messages.append(f"Repriced {self.contract} to {new_limit:.2f}.")
         return order_id
 
     def close(self, client, account_id, ui):
@@ -243,49 +452,46 @@ class Position:
         self.closed_time = datetime.now()
 
         ui.messages.append(f"Closing position {self.contract}.")
-        print(f"Closing postion {self.contract}")
+        log("position", action="close", contract=self.contract, net_pos=self.net_pos)
         # canceling orders
         for order_id in self.associated_orders:
             if self.associated_orders[order_id] not in {
-                    'PENDING_CANCEL', 'CANCELED', 'FILLED', 'REPLACED', 'EXPIRED'}:
+                    'PENDING_CANCEL', 'CANCELED', 'FILLED', 'REPLACED', 'EXPIRED'} \
+                    and order_id not in self.cancel_pending:
                 try:
                     client.cancel_order(account_id, order_id)
+                    self.cancel_pending.add(order_id)
+                    if self.ledger:
+                        self.ledger.record_order(self.contract, order_id, "CANCEL")
                 except Exception as e:
                     ui.messages.append(
                         f"Exception canceling order "
                         f"(id: {order_id}:{self.associated_orders[order_id]}):\n{e}")
+                    log("order_error", "warning", action="cancel", contract=self.contract,
+                        order_id=order_id, status=self.associated_orders[order_id], error=str(e))
         # selling to close out position (important that this is done
         # after canceling so sell orders don't get canceled)
         if self.net_pos < 1:
             return 0
 
-        while True:
-            try:
-                response = client.place_order(account_id,
-                                              option_sell_to_close_market(
-                                                  self.contract, self.net_pos)
-                                              .build()
-                                              )
-                response.raise_for_status()
-                break
-            except Exception as e:
-                print(e)
-                ui.messages.append(e)
-                time.sleep(0.5)
-
-        order_id = Utils(client, account_id).extract_order_id(response)
+        order_id = submit_order(
+            client, account_id, option_sell_to_close_market(self.contract, self.net_pos).build())
         # order_id is potentially None
         if not order_id:
             return 0
         order_id = int(order_id)
         self.associated_orders[order_id] = "SELL_TO_CLOSE"
+        if self.ledger:
+            self.ledger.record_order(
+                self.contract, order_id, "PLACE", "SELL_TO_CLOSE", self.net_pos, "MARKET")
         return order_id
 
     def increase(
-        self, client, account_id, ui,
+        self, client, account_id, ui, repricer=None,
     ):
         """
         Adds to the position.
+        Sends a limit worked by repricer if one is given, otherwise a market order.
         """
         self.state = Signals.OPEN_OR_INCREASE
 
@@ -295,22 +501,12 @@ class Position:
                 f"Attempted to increase for {self.contract}, but there's already an open order.")
             return 0
 
-        while True:
-            try:
-                response = client.place_order(account_id,
-                                              option_buy_to_open_market(
-                                                  self.contract, 1,)
-                                              .build()
-                                              )
-                response.raise_for_status()
-                break
-            except Exception as e:
-                print(e)
-                ui.messages.append(e)
-                time.sleep(0.5)
-
+        if repricer:
+            order_spec = option_buy_to_open_limit(self.contract, 1, repricer.limit)
+        else:
+            order_spec = option_buy_to_open_market(self.contract, 1,)
+        order_id = submit_order(client, account_id, order_spec.build())
         ui.messages.append(f"Sent increase order for {self.contract}.")
-        order_id = Utils(client, account_id).extract_order_id(response)
         self.move_stop_on_increase()
 
         # order_id is potentially None
@@ -318,6 +514,15 @@ class Position:
             return 0
         order_id = int(order_id)
         self.associated_orders[order_id] = "OPEN"
+        self.working_buys[order_id] = 1
+        self.order_times[order_id] = datetime.now()
+        if self.ledger:
+            self.ledger.record_order(
+                self.contract, order_id, "PLACE", "BUY_TO_OPEN", 1,
+                "LIMIT" if repricer else "MARKET", repricer.limit if repricer else None)
+        if repricer:
+            repricer.sent(order_id)
+            self.repricer = repricer
         return order_id
 
     def move_stop_on_increase(self):
@@ -327,9 +532,12 @@ class Position:
         (stop_type, offset) = self.stop
         offset = offset / 2
         self.stop = (stop_type, offset)
+        if self.ledger:
+            self.ledger.record_stop(self.contract, self.stop, self.take_profit, "increase")
 
     def update_position_from_quote(
-            self, cloud, signal, price, standard_deviation, trail_stop_mod, profit_step_mod, client, account_id, ui
+            self, cloud, signal, price, standard_deviation, trail_stop_mod, profit_step_mod, client, account_id, ui,
+            repricer=None,
     ):
         """
         Handles stop loss, take profit and adding to a position.
@@ -342,7 +550,7 @@ class Position:
             return Signals.EXIT
 
         if signal == Signals.OPEN_OR_INCREASE and self.state == Signals.OPEN:
-            return self.increase(client, account_id, ui)
+            return self.increase(client, account_id, ui, repricer)
 
         cloud_color = cloud.status[0]
 
@@ -359,6 +567,8 @@ class Position:
             self.take_profit += (standard_deviation * profit_step_mod
                 ) if cloud_color == CloudColor.GREEN else (standard_deviation * -1 * profit_step_mod)
             ui.messages.append(f"Moved levels into profit for {self.contract}.")
+            if self.ledger:
+                self.ledger.record_stop(self.contract, self.stop, self.take_profit, "profit step")
             return self.take_profit
 
     def update_from_account_activity(self, message_type, otherdata, ui):
@@ -367,38 +577,283 @@ class Position:
         otherdata argument should be the output of the XML data parser.
         """
         ui.messages.append(f"{message_type} message for {self.contract}.")
+        log("account_activity", message_type=message_type, contract=self.contract,
+            order_id=otherdata.get("OrderKey"))
         self.associated_orders[int(otherdata["OrderKey"])] = message_type
+        if message_type in ("OrderFill", "UROUT", "OrderRejection"):
+            self.working_buys.pop(int(otherdata["OrderKey"]), None)
         match message_type:
             case "OrderFill":
                 original_quantity = int(otherdata["OriginalQuantity"])
                 self.net_pos += original_quantity if otherdata["OrderInstructions"] == "Buy" else \
                     -1 * original_quantity
+                if self.ledger:
+                    self.ledger.record_fill(
+                        self.contract, int(otherdata["OrderKey"]), otherdata["OrderInstructions"],
+                        original_quantity,
+                        float(otherdata["ExecutionPrice"]) if "ExecutionPrice" in otherdata else None)
+
+    def was_rejected(self):
+        """True if every order sent for this position was rejected and nothing was filled."""
+        return (
+            self.net_pos == 0
+            and bool(self.associated_orders)
+            and all(status == "OrderRejection" for status in self.associated_orders.values())
+        )
 
     def check_timeouts(self, client, account_id, timeoutlength):
         """
-        Cancels orders that have been open and unfilled
-        for too long.
+        Cancels orders that have been open and unfilled for too
+        long since they were placed, once each. An order being repriced
+        only times out once the repricer is exhausted.
         """
+        if self.repricer and not self.repricer.exhausted():
+            return
         now = datetime.now()
         for order_id in self.associated_orders:
+            if order_id in self.cancel_pending:
+                continue
+            placed = self.order_times.get(order_id, self.opened_time)
             if self.associated_orders[order_id] == "OPEN" and timedelta.total_seconds(
-                    now - self.opened_time) < timeoutlength:
+                    now - placed) > timeoutlength:
                 try:
                     client.cancel_order(account_id, order_id)
+                    self.cancel_pending.add(order_id)
+                    if self.ledger:
+                        self.ledger.record_order(self.contract, order_id, "CANCEL")
                 except Exception as e:
-                    print(
-                        f"Exception canceling order (id: {order_id}:{self.associated_orders[order_id]}):\n{e}")
+                    log("order_error", "warning", action="timeout_cancel", contract=self.contract,
+                        order_id=order_id, status=self.associated_orders[order_id], error=str(e))
 
 
 class OrderManager:
     """ Manages orders and holds relevant data like current positions. """
 
     def __init__(
-        self, config,
+        self, config, contract_score=highest_delta, quotes=None, ledger=None, exposure=None,
+        range_indicators=None,
     ):
-        """Initialize OrderManager with an OrderManagerConfig and empty current_positions."""
+        """
+        Initialize OrderManager with an OrderManagerConfig and empty current_positions.
+        contract_score takes a contract and returns a value to rank it by
+        when choosing among valid contracts (highest wins).
+        quotes is the MessageHandler holding streamed option quotes, if any.
+        ledger is an optional ledger.Ledger passed on to new positions.
+        exposure is an ExposureAggregator shared with the order managers
+        of other strategies on the same account, if any.
+        range_indicators is {symbol: indicators.Indicator} (ie. an ATR kept
+        by the symbol's Signaler) whose value is used as the average range
+        instead of asking for the price history. This changes the stop and
+        take profit levels (an ATR isn't the mean high-low range), so it's
+        only used when configured.
+        """
+        self.quotes = quotes
+        self.ledger = ledger
         self.config = config  # class OrderManagerConfig
         self.current_positions = {}  # symbol:Position
+        self.contract_score = contract_score
+        # symbol: [contract,...] remaining candidates from the last chain query
+        self.fallback_contracts = {}
+        self.execution_stats = ExecutionStats()
+        # For running the REST requests needed to open a position side by side.
+        self.fetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ordmngr-fetch")
+        # symbol: Preselection
+        self.preselections = {}
+        # Symbols with a preselection being worked out.
+        self.preselecting = set()
+        self.preselect_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ordmngr-preselect")
+        # Net delta, notional and premium at risk, kept up to date on
+        # every order, fill and option quote.
+        self.exposure = exposure or ExposureAggregator()
+        # Counts account activity messages, so a reconciliation can tell
+        # whether any were handled while it was fetching the account.
+        self.activity_seq = 0
+        # symbol: (last average range fetched, time.monotonic() when), to
+        # narrow chain requests made before the current one is known.
+        self.average_ranges = {}
+        self.range_indicators = range_indicators or {}
+        # Copies of the positions for readers on other threads, set by
+        # publish_positions. None while everything runs on one thread.
+        self.positions_view = None
+
+    def publish_positions(self):
+        """
+        Copy the current positions (with their own associated_orders) into
+        positions_view. Called by the thread that changes the positions,
+        ie. the pipeline's execute stage, between two items.
+        """
+        views = []
+        for position in list(self.current_positions.values()):
+            view = copy.copy(position)
+            view.associated_orders = dict(position.associated_orders)
+            views.append(view)
+        self.positions_view = views
+
+    def visible_positions(self):
+        """
+        The positions as of the last publish_positions if they're changed
+        on another thread, otherwise the current positions.
+        """
+        if self.positions_view is not None:
+            return self.positions_view
+        return list(self.current_positions.values())
+
+    def average_range(self, client, symbol):
+        """
+        The average range of symbol's timeframe candles, remembered in
+        self.average_ranges: the value of its range indicator if it has one
+        with a value, otherwise get_avg_range_for_symbol with the config's
+        settings (a price history request).
+        """
+        indicator = self.range_indicators.get(symbol)
+        if indicator is not None and indicator.value is not None:
+            average_range = indicator.value
+        else:
+            average_range = get_avg_range_for_symbol(
+                client, symbol, self.config.stdev_period, self.config.timeframe_minutes)
+        self.average_ranges[symbol] = (average_range, time.monotonic())
+        return average_range
+
+    def recent_average_range(self, symbol):
+        """
+        The last average range of symbol if it's under AVERAGE_RANGE_MAX_AGE
+        seconds old, or the current value of its range indicator, else None.
+        """
+        indicator = self.range_indicators.get(symbol)
+        if indicator is not None and indicator.value is not None:
+            return indicator.value
+        if symbol not in self.average_ranges:
+            return None
+        average_range, fetched = self.average_ranges[symbol]
+        if time.monotonic() - fetched > AVERAGE_RANGE_MAX_AGE:
+            return None
+        return average_range
+
+    def track_exposure(self, position, contract=None):
+        """
+        Update the exposure of position after something changed it.
+        contract (from the chain) gives its mark and delta when there's
+        no streamed quote yet.
+        """
+        pending = sum(position.working_buys.values())
+        mark = delta = None
+        if contract:
+            mark = contract.get("mark", (contract["bid"] + contract["ask"]) / 2)
+            delta = contract["delta"]
+        self.exposure.set_holding(
+            position.contract, position.net_pos, pending, mark, delta, holder=self)
+
+    def update_from_option_quote(self, contract, data):
+        """Streamed option quote data for contract, for the exposure totals."""
+        if "MARK" in data or "DELTA" in data:
+            self.exposure.update_quote(contract, data.get("MARK"), data.get("DELTA"))
+
+    def exposure_limit(self, symbol, contract=None):
+        """
+        Why buying one contract (a chain contract dict, or nothing yet)
+        for symbol would break an exposure limit, or None.
+        """
+        if contract is None:
+            return self.exposure.check(symbol, self.config)
+        return self.exposure.check(
+            symbol, self.config, 1,
+            contract.get("mark", (contract["bid"] + contract["ask"]) / 2), contract["delta"])
+
+    def option_quote(self, contract):
+        """
+        (bid, ask) for contract (a contract dict from the chain):
+        the streamed quote if there is a recent enough one,
+        otherwise the one from the chain snapshot.
+        """
+        if self.quotes:
+            quote = self.quotes.option_quote(contract["symbol"], self.config.max_quote_age)
+            if quote:
+                return quote
+        return contract["bid"], contract["ask"]
+
+    def record_open(self, symbol, timings):
+        """Add the timings of an open to execution_stats and log them with the running means."""
+        self.execution_stats.record_open(symbol, timings)
+        log("execution", symbol=symbol, timings=timings,
+            mean_timings=self.execution_stats.open_summary())
+
+    def new_repricer(self, contract_symbol, bid, ask):
+        """A LimitRepricer for buying one contract_symbol with the configured schedule."""
+        return LimitRepricer(
+            contract_symbol, 1, bid, ask,
+            self.config.max_slippage, self.config.reprice_step, self.config.reprice_interval,
+        )
+
+    def needs_update(self, symbol, signal, cloud=None, price=None):
+        """
+        False if update_from_quote would do nothing for this quote,
+        ie. there's no signal, no position in symbol and no
+        preselection to start.
+        """
+        return bool(signal) or symbol in self.current_positions or (
+            cloud is not None and self.near_opening_level(cloud, price) is not None)
+
+    def near_opening_level(self, cloud, price):
+        """next_opening_status(cloud) if price is within preselect_distance of the level, else None."""
+        if not self.config.preselect_distance or price is None:
+            # Chart candles don't come with a new price.
+            return None
+        upcoming = next_opening_status(cloud)
+        if upcoming is None or abs(price - upcoming[0]) > self.config.preselect_distance:
+            return None
+        return upcoming
+
+    def preselect(self, client, symbol, cloud, price):
+        """
+        Start working out the levels and contracts for the signal price is
+        approaching, in the background, unless there's a fresh enough one.
+        """
+        upcoming = self.near_opening_level(cloud, price)
+        if upcoming is None or symbol in self.preselecting:
+            return None
+        level, status = upcoming
+        current = self.preselections.get(symbol)
+        if current and current.status == status and current.age() < self.config.preselect_max_age \
+                and abs(current.level - level) <= self.config.preselect_distance:
+            return None
+
+        # The cloud as it would be right after the cross, copied since
+        # the live one keeps changing.
+        expected_cloud = copy.copy(cloud)
+        expected_cloud.status = status
+        self.preselecting.add(symbol)
+        return self.preselect_executor.submit(
+            self._preselect, client, symbol, expected_cloud, level)
+
+    def _preselect(self, client, symbol, cloud, level):
+        try:
+            average_range = self.average_range(client, symbol)
+            stop, take_profit = level_set(
+                level, average_range, cloud, self.config.stop_mod, self.config.take_profit_mod)
+            contracts = self.get_contracts_from_chain(
+                client, symbol, take_profit, StopType.stop_tuple_to_level(stop, cloud), level,
+                cloud.status[0], k=self.config.contract_candidates,
+            )
+            self.preselections[symbol] = Preselection(
+                cloud.status, level, stop, take_profit, contracts)
+        finally:
+            self.preselecting.discard(symbol)
+
+    def take_preselection(self, symbol, cloud, price):
+        """
+        The preselection for symbol if it was made for this cloud status,
+        is fresh and price hasn't moved too far from the level since.
+        It's removed either way.
+        """
+        preselection = self.preselections.pop(symbol, None)
+        if (
+            preselection is None
+            or preselection.status != cloud.status
+            or preselection.age() > self.config.preselect_max_age
+            or abs(price - preselection.level) > self.config.preselect_distance
+        ):
+            return None
+        return preselection
 
     def update_from_quote(self, client, account_id, cloud,
                         symbol, signal, newprice, ui):
@@ -408,113 +863,307 @@ class OrderManager:
             now = datetime.now()
             if timedelta.total_seconds(
                     now - self.current_positions[symbol].closed_time) > self.config.time_btwn_positions:
-                ui.messages.append(self.current_positions.pop(symbol))
+                position = self.current_positions.pop(symbol)
+                self.track_exposure(position)
+                ui.messages.append(position)
             # Leave if there is a recently closed position.
             else:
                 return 0
 
         if signal in (Signals.CLOSE, Signals.EXIT) and symbol in self.current_positions:
             self.current_positions[symbol].close(client, account_id, ui)
+            self.track_exposure(self.current_positions[symbol])
+
+        elif symbol in self.current_positions and self.current_positions[symbol].was_rejected():
+            self.open_fallback(symbol, client, account_id, ui)
 
         elif symbol in self.current_positions:
-            self.current_positions[symbol].check_timeouts(
+            position = self.current_positions[symbol]
+            live_quote = self.quotes.option_quote(
+                position.contract, self.config.max_quote_age) if self.quotes else None
+            position.reprice(client, account_id, ui, live_quote[1] if live_quote else None)
+            position.check_timeouts(
                 client, account_id, self.config.order_timeout_length)
-            average_range = get_avg_range_for_symbol(
-                client, symbol, self.config.stdev_period, self.config.timeframe_minutes)
-            self.current_positions[symbol].update_position_from_quote(
+            average_range = self.average_range(client, symbol)
+            # Increases are worked like opening limits when there's a streamed quote.
+            repricer = None
+            if signal == Signals.OPEN_OR_INCREASE:
+                quote = self.exposure.quote(position.contract)
+                limit = quote and self.exposure.check(symbol, self.config, 1, *quote)
+                if limit:
+                    ui.messages.append(f"Not increasing {position.contract}: {limit}.")
+                    log("exposure_limit", symbol=symbol, action="increase", reason=limit)
+                    signal = 0
+                elif live_quote:
+                    repricer = self.new_repricer(position.contract, *live_quote)
+            position.update_position_from_quote(
                 cloud, signal, newprice, average_range,
                 self.config.trail_stop_mod, self.config.profit_step_mod,
-                client, account_id, ui
+                client, account_id, ui, repricer,
             )
+            self.track_exposure(position)
 
         elif signal and signal not in (Signals.CLOSE, Signals.EXIT):
             self.open_position_from_signal(
                 symbol, signal, client, cloud, newprice, account_id, ui,
             )
 
+        elif not signal:
+            self.preselect(client, symbol, cloud, newprice)
+
     def update_from_account_activity(self, symbol, message_type, data, ui):
         """
         Handles new messages from the account activity stream,
         like order fills or cancels.
         """
-        self.current_positions[symbol].update_from_account_activity(
-            message_type, data, ui)
+        self.activity_seq += 1
+        position = self.current_positions.get(symbol)
+        if position is None:
+            # Not ours, or state has drifted until the next reconciliation.
+            log("account_activity", "warning", untracked=True, symbol=symbol,
+                message_type=message_type, order_id=data.get("OrderKey"))
+            return None
+        repricer = position.repricer
+        position.update_from_account_activity(message_type, data, ui)
+        self.track_exposure(position)
+
+        if message_type == "OrderFill" and repricer and \
+                int(data["OrderKey"]) in repricer.order_ids:
+            fill_price = float(data["ExecutionPrice"]) if "ExecutionPrice" in data else None
+            latency, slippage = self.execution_stats.record_fill(repricer, fill_price)
+            log("execution", contract=repricer.contract, latency=latency, slippage=slippage,
+                steps=repricer.steps, **self.execution_stats.summary(repricer.contract))
+            position.repricer = None
+            ui.messages.append(
+                f"Filled {repricer.contract} after {latency:.1f}s, slippage {slippage:+.2f}.")
 
-    def get_contract_from_chain(
-        self, client, symbol, take_profit, stop, current_price, cloud_color
+    def fetch_chain_index(self, client, symbol, put_call=None, move_to_stop=None):
+        """
+        Asks TD Ameritrade for the section of the option chain the config allows:
+        expiries from mindte to maxdte days out, only put_call contracts if
+        given, and only out of (or in) the money strikes if the contracts
+        that could be valid for a move of move_to_stop all are.
+        """
+        strike_range = chain_strike_range(
+            move_to_stop, self.config.min_loss, self.config.max_loss)
+        return OptionChainIndex.from_chain(get_option_chain(
+            client, symbol, self.config.strike_count, self.config.maxdte + 1,
+            contract_type=put_call, strike_range=strike_range, from_dte=self.config.mindte,
+        ))
+
+    def get_contracts_from_chain(
+        self, client, symbol, take_profit, stop, current_price, cloud_color, k=1, index=None,
     ):
         """
-        Asks TD Ameritrade for a section of the option chain.
+        Asks TD Ameritrade for a section of the option chain
+        (unless an already fetched OptionChainIndex is given).
         Then eliminate contracts which do not fit within the settings
-        set in self.config, and return one.
+        set in self.config, and return the k best by self.contract_score,
+        best first.
         """
-        putCall = None
-        if cloud_color == CloudColor.GREEN:
-            putCall = "CALL"
-        elif cloud_color == CloudColor.RED:
-            putCall = "PUT"
+        putCall = put_call_for(cloud_color)
 
         expected_move_to_profit = abs(take_profit - current_price)
         expected_move_to_stop = abs(stop - current_price)
-        contracts = get_flattened_chain(
-            client, symbol, self.config.strike_count, self.config.maxdte + 1,
-        )
+        # risk reward validation, the same for every contract
+        if not expected_move_to_stop or \
+                expected_move_to_profit / expected_move_to_stop <= self.config.min_risk_reward_ratio:
+            return []
+
+        if index is None:
+            index = self.fetch_chain_index(client, symbol, putCall, expected_move_to_stop)
+
         # contract validation
-        contracts = [
-            contract
-            for contract in contracts
-            if contract["ask"] - contract["bid"] <= self.config.max_spread
-            and contract["putCall"] == putCall
-            and contract["daysToExpiration"] >= self.config.mindte
-            and contract["daysToExpiration"] <= self.config.maxdte
-            and contract["ask"] > self.config.min_contract_price
-            and contract["ask"] < self.config.max_contract_price
-        ]
-
-        # risk reward validation
-        contracts = [
-            contract
-            for contract in contracts
-            if abs(contract["delta"]) * expected_move_to_stop < self.config.max_loss
-            and abs(contract["delta"]) * expected_move_to_stop >= self.config.min_loss
-            and expected_move_to_profit / expected_move_to_stop > self.config.min_risk_reward_ratio
-        ]
+        def valid_contract(contract):
+            return (
+                contract["ask"] - contract["bid"] <= self.config.max_spread
+                and contract["ask"] > self.config.min_contract_price
+                and contract["ask"] < self.config.max_contract_price
+            )
+
+        return index.top_k(
+            k,
+            score=self.contract_score,
+            put_call=putCall,
+            mindte=self.config.mindte,
+            maxdte=self.config.maxdte,
+            move_to_stop=expected_move_to_stop,
+            min_loss=self.config.min_loss,
+            max_loss=self.config.max_loss,
+            predicate=valid_contract,
+        )
 
+    def get_contract_from_chain(
+        self, client, symbol, take_profit, stop, current_price, cloud_color, index=None,
+    ):
+        """
+        Returns the best contract from get_contracts_from_chain.
+        Also keeps the next self.config.contract_candidates - 1 contracts
+        in self.fallback_contracts.
+        """
+        contracts = self.get_contracts_from_chain(
+            client, symbol, take_profit, stop, current_price, cloud_color,
+            k=self.config.contract_candidates, index=index,
+        )
         if contracts:
             # there can only be one
-            highest_delta_contract = sorted(
-                contracts, key=lambda contract: abs(contract["delta"])
-            )[-1]
-            return highest_delta_contract
+            self.fallback_contracts[symbol] = contracts[1:]
+            return contracts[0]
         else:
-            return contracts  # None
+            self.fallback_contracts.pop(symbol, None)
+            return None
+
+    def open_fallback(self, symbol, client, account_id, ui):
+        """
+        Replaces a rejected position with the next contract from the
+        last chain query, keeping its levels and signal.
+        """
+        rejected = self.current_positions[symbol]
+        fallbacks = self.fallback_contracts.get(symbol)
+        if not fallbacks:
+            ui.messages.append(f"Orders for {rejected.contract} rejected, no fallback contracts.")
+            rejected.close(client, account_id, ui)
+            return None
+
+        contract = fallbacks.pop(0)
+        self.track_exposure(rejected)
+        exposure_limit = self.exposure_limit(symbol, contract)
+        if exposure_limit:
+            ui.messages.append(
+                f"Orders for {rejected.contract} rejected, "
+                f"not trying {contract['symbol']}: {exposure_limit}.")
+            rejected.close(client, account_id, ui)
+            return None
+        ui.messages.append(
+            f"Orders for {rejected.contract} rejected, trying {contract['symbol']}.")
+        repricer = self.new_repricer(contract["symbol"], *self.option_quote(contract))
+
+        self.current_positions[symbol] = Position(
+            contract["symbol"], rejected.take_profit, rejected.stop, rejected.state, self.ledger
+        )
+        result = self.current_positions[symbol].open(client, account_id, repricer.limit, ui, repricer)
+        self.track_exposure(self.current_positions[symbol], contract)
+        return result
+
+    def open_preselected(self, symbol, signal, client, account_id, preselection, ui):
+        """Opens a position with the levels and contracts from a Preselection."""
+        if not preselection.contracts:
+            ui.messages.append(f"No valid contracts for {symbol} (preselected).")
+            return None
+        start = time.perf_counter()
+        contract = preselection.contracts[0]
+        exposure_limit = self.exposure_limit(symbol, contract)
+        if exposure_limit:
+            ui.messages.append(f"Not opening {symbol}: {exposure_limit}.")
+            log("exposure_limit", symbol=symbol, action="open", reason=exposure_limit)
+            return None
+        self.fallback_contracts[symbol] = preselection.contracts[1:]
+        repricer = self.new_repricer(contract["symbol"], *self.option_quote(contract))
+
+        self.current_positions[symbol] = Position(
+            contract["symbol"], preselection.take_profit, preselection.stop, signal, self.ledger
+        )
+        result = self.current_positions[symbol].open(client, account_id, repricer.limit, ui, repricer)
+        self.track_exposure(self.current_positions[symbol], contract)
+        timings = {"submit": time.perf_counter() - start}
+        timings["total"] = timings["submit"]
+        self.record_open(symbol, timings)
+        ui.messages.append(
+            f"Opened {symbol} from a preselection made {preselection.age():.1f}s earlier "
+            f"in {timings['total'] * 1000:.0f} ms.")
+        return result
 
     def open_position_from_signal(
         self, symbol, signal, client, cloud, price, account_id, ui,
     ):
-        """Opens a position based on a signal."""
+        """
+        Opens a position based on a signal.
+        The average range and the option chain don't depend on each other
+        so they are requested at the same time. How long each step took is
+        recorded in self.execution_stats.
+        """
 
         if abs(cloud.short_ema - cloud.long_ema) < self.config.min_cloud_width:
             ui.messages.append(f"Tried to open position for {symbol} but cloud witdth too small.")
             return None
 
-        average_range = get_avg_range_for_symbol(
-            client, symbol, self.config.stdev_period, self.config.timeframe_minutes)
+        # Already at a limit, don't bother fetching anything.
+        exposure_limit = self.exposure_limit(symbol)
+        if exposure_limit:
+            ui.messages.append(f"Not opening {symbol}: {exposure_limit}.")
+            log("exposure_limit", symbol=symbol, action="open", reason=exposure_limit)
+            return None
+
+        preselection = self.take_preselection(symbol, cloud, price)
+        if preselection:
+            return self.open_preselected(symbol, signal, client, account_id, preselection, ui)
+
+        timings = {}
+        start = time.perf_counter()
+
+        def timed(step, func, *args):
+            step_start = time.perf_counter()
+            result = func(*args)
+            timings[step] = time.perf_counter() - step_start
+            return result
+
+        # The chain is narrowed with levels from a recent average range
+        # for symbol, if there is one.
+        chain_move = None
+        recent_range = self.recent_average_range(symbol)
+        if recent_range is not None:
+            chain_stop, _ = level_set(
+                price, recent_range, cloud,
+                self.config.stop_mod, self.config.take_profit_mod)
+            chain_move = abs(StopType.stop_tuple_to_level(chain_stop, cloud) - price)
+
+        average_range_future = self.fetch_executor.submit(
+            timed, "average_range", self.average_range, client, symbol)
+        index_future = self.fetch_executor.submit(
+            timed, "chain", self.fetch_chain_index,
+            client, symbol, put_call_for(cloud.status[0]), chain_move)
+
+        average_range = average_range_future.result()
         stop, take_profit = level_set(
             price, average_range, cloud, self.config.stop_mod, self.config.take_profit_mod)
         stop_level = StopType.stop_tuple_to_level(stop, cloud)
-        ui.messages.append(
-            f"Calculated levels for {symbol}...\nTake profit = {take_profit}\nStop level: {stop_level}")
 
-        contract = self.get_contract_from_chain(
-            client, symbol, take_profit, stop_level, price, cloud.status[0],
+        index = index_future.result()
+        timings["fetch"] = time.perf_counter() - start
+        contract = timed(
+            "select", self.get_contract_from_chain,
+            client, symbol, take_profit, stop_level, price, cloud.status[0], index,
         )
         if not contract:
+            timings["total"] = time.perf_counter() - start
+            self.record_open(symbol, timings)
+            ui.messages.append(
+                f"Calculated levels for {symbol}...\nTake profit = {take_profit}\nStop level: {stop_level}")
             ui.messages.append(f"No valid contracts for {symbol}.")
             return None
-        limit = contract["ask"] + self.config.limit_padding
+        exposure_limit = self.exposure_limit(symbol, contract)
+        if exposure_limit:
+            ui.messages.append(f"Not opening {contract['symbol']}: {exposure_limit}.")
+            log("exposure_limit", symbol=symbol, action="open", reason=exposure_limit)
+            return None
+        repricer = self.new_repricer(contract["symbol"], *self.option_quote(contract))
 
         self.current_positions[symbol] = Position(
-            contract["symbol"], take_profit, stop, signal
+            contract["symbol"], take_profit, stop, signal, self.ledger
         )
-        self.current_positions[symbol].open(client, account_id, limit, ui)
+        # The order goes out before anything is written to the UI.
+        result = timed(
+            "submit", self.current_positions[symbol].open,
+            client, account_id, repricer.limit, ui, repricer)
+        self.track_exposure(self.current_positions[symbol], contract)
+        timings["total"] = time.perf_counter() - start
+        self.record_open(symbol, timings)
+
+        ui.messages.append(
+            f"Calculated levels for {symbol}...\nTake profit = {take_profit}\nStop level: {stop_level}")
+        ui.messages.append(
+            f"Opening {symbol} took {timings['total'] * 1000:.0f} ms: "
+            + ", ".join(
+                f"{step} {timings[step] * 1000:.0f} ms"
+                for step in ("average_range", "chain", "select", "submit")))
+        return result
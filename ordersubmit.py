@@ -0,0 +1,187 @@
+"""
+Idempotent order submission.
+
+place_order can fail after the broker has accepted the order (a lost
+response, a timeout), so blindly resending can put the same order in
+twice. TD Ameritrade orders have no client order id field, so each
+submission is described by an OrderIntent instead: its key is the
+contract, instruction, quantity, type and price, plus the time it was
+first sent. Before any resend, the account's recent orders are fetched
+with one get_orders_by_path call and searched for an order that matches
+the intent and hasn't been claimed by an earlier submission. If there is
+one it's adopted instead of sending again. The fetch is shared by every
+submission retrying at the same time, which makes fast retries safe.
+"""
+import datetime
+import threading
+import time
+
+from tda.utils import Utils
+
+from eventlog import log
+
+
+class OrderIntent:
+    """
+    What an order is meant to do, for recognizing it among the account's orders.
+
+    Fields:
+    contract
+    instruction
+    quantity
+    order_type
+    price
+    created
+    """
+
+    def __init__(self, order_spec):
+        """order_spec is the built (dict) order."""
+        leg = order_spec["orderLegCollection"][0]
+        self.contract = leg["instrument"]["symbol"]
+        self.instruction = leg["instruction"]
+        self.quantity = int(leg["quantity"])
+        self.order_type = order_spec["orderType"]
+        self.price = float(order_spec["price"]) if "price" in order_spec else None
+        self.created = datetime.datetime.now(datetime.timezone.utc)
+
+    @property
+    def key(self):
+        return (self.contract, self.instruction, self.quantity, self.order_type, self.price,
+                self.created.isoformat())
+
+    def matches(self, order, clock_slack):
+        """True if order (from the orders endpoint) could be the one sent for this intent."""
+        legs = order.get("orderLegCollection") or [{}]
+        leg = legs[0]
+        if leg.get("instrument", {}).get("symbol") != self.contract \
+                or leg.get("instruction") != self.instruction \
+                or int(leg.get("quantity", order.get("quantity", 0))) != self.quantity \
+                or order.get("orderType") != self.order_type:
+            return False
+        if self.price is not None and abs(float(order.get("price", 0)) - self.price) > 0.001:
+            return False
+        entered = order.get("enteredTime")
+        if entered:
+            entered = datetime.datetime.strptime(entered, "%Y-%m-%dT%H:%M:%S%z")
+            if entered < self.created - clock_slack:
+                return False
+        return True
+
+    def __str__(self):
+        return f"{self.instruction} {self.quantity} {self.contract} {self.order_type} {self.price}"
+
+
+class OrderLookup:
+    """
+    Recent orders for one account, shared by concurrent retries,
+    and the order ids already claimed by a submission.
+
+    Fields:
+    orders
+    fetched_at
+    claimed
+    """
+
+    def __init__(self, client, account_id, window=datetime.timedelta(minutes=5)):
+        """Orders entered in the last window are fetched."""
+        self.client = client
+        self.account_id = account_id
+        self.window = window
+        self.lock = threading.Lock()
+        self.orders = []
+        self.fetched_at = 0.0
+        self.claimed = set()
+
+    def recent_orders(self, not_before):
+        """
+        The account's recent orders, fetched no earlier than not_before
+        (time.monotonic()). None if they couldn't be fetched.
+        """
+        with self.lock:
+            if self.fetched_at < not_before:
+                fetched_at = time.monotonic()
+                try:
+                    response = self.client.get_orders_by_path(
+                        self.account_id,
+                        from_entered_datetime=datetime.datetime.now() - self.window)
+                    response.raise_for_status()
+                except Exception as e:
+                    log("order_lookup", "warning", error=str(e))
+                    return None
+                self.orders = response.json()
+                self.fetched_at = fetched_at
+            return self.orders
+
+    def find(self, intent, not_before, clock_slack):
+        """
+        Order id of an unclaimed order matching intent, claiming it.
+        0 if there's none, None if the orders couldn't be fetched.
+        """
+        orders = self.recent_orders(not_before)
+        if orders is None:
+            return None
+        with self.lock:
+            for order in orders:
+                order_id = int(order["orderId"])
+                if order_id not in self.claimed and intent.matches(order, clock_slack):
+                    self.claimed.add(order_id)
+                    return order_id
+        return 0
+
+    def claim(self, order_id):
+        with self.lock:
+            self.claimed.add(int(order_id))
+
+
+# (id(client), account_id): OrderLookup
+_lookups = {}
+
+
+def order_lookup(client, account_id):
+    """The shared OrderLookup for client and account_id."""
+    key = (id(client), account_id)
+    if key not in _lookups:
+        _lookups[key] = OrderLookup(client, account_id)
+    return _lookups[key]
+
+
+def submit_order(
+    client, account_id, order_spec, retry_interval=0.1, max_retry_interval=2.0,
+    clock_slack=datetime.timedelta(seconds=5),
+):
+    """
+    Places order_spec (a built order) until it's known to be in, without
+    ever sending it twice. Returns the order id (None if the response had
+    no usable Location header).
+    Between attempts the wait doubles from retry_interval up to max_retry_interval.
+    """
+    intent = OrderIntent(order_spec)
+    lookup = order_lookup(client, account_id)
+    wait = retry_interval
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            response = client.place_order(account_id, order_spec)
+            response.raise_for_status()
+        except Exception as e:
+            log("order_retry", "warning", intent=str(intent), key=intent.key,
+                attempt=attempts, error=str(e))
+            failed_at = time.monotonic()
+            # The order may have gone in anyway. Only resend once the
+            # account's orders show it didn't.
+            existing = None
+            while existing is None:
+                time.sleep(wait)
+                wait = min(wait * 2, max_retry_interval)
+                existing = lookup.find(intent, failed_at, clock_slack)
+            if existing:
+                log("order", intent=str(intent), key=intent.key, order_id=existing,
+                    adopted=True, attempts=attempts)
+                return existing
+            continue
+
+        order_id = Utils(client, account_id).extract_order_id(response)
+        if order_id:
+            lookup.claim(order_id)
+        return order_id
@@ -13,9 +13,11 @@ class PhilbotUI:
 
         self.messages is a list that should contain any messages
         (error messages, account activity) to be displayed at the bottom.
+        self.status is a line (ie. pipeline stats) shown above the messages.
         """
         self.term = term
         self.messages = []
+        self.status = ""
 
     @property
     def section_heights(self, num_sections=3):
@@ -52,7 +54,7 @@ class PhilbotUI:
         Includes price info for tracked symbols, along with their
         moving averages and EMA cloud information.
         """
-        for symbol in {"SPY"}:  # To be changed for handling multiple symbols.
+        for symbol in sorted(clouds):
             try:
                 last_price = float(msg_handler.last_messages[symbol]["LAST_PRICE"])
                 last_price = f'{last_price:.2f}'
@@ -91,6 +93,9 @@ class PhilbotUI:
         section_height = bottom_height / 2
         print(self.term.move_y(bottom_height), end='')
         line_count = 0
+        if self.status:
+            print(self.term.reverse + self.status[:self.term.width] + self.term.normal)
+            line_count += 1
         for message in reversed(self.messages):
             message = str(message)
             lines = wrap(message, width=self.term.width)
@@ -99,5 +104,21 @@ class PhilbotUI:
                 line_count += 1
 
 
+class HeadlessUI:
+    """
+    Stands in for PhilbotUI when the bot runs without a terminal.
+    Keeps messages and status (for uiprocess snapshots) but draws nothing.
+    """
+    def __init__(self):
+        self.messages = []
+        self.status = ""
+
+    def interface_clear(self):
+        pass
+
+    def dispatch_display(self, msg_handler, clouds, positions):
+        pass
+
+
 if __name__ == '__main__':
     pass
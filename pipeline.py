@@ -0,0 +1,288 @@
+"""
+A staged asyncio pipeline for handling stream messages.
+
+Each stage has its own bounded queue and worker task, so a slow stage
+(usually order execution or drawing the UI) only holds up the stages
+after it. The stages are:
+ingest -> parse -> signal -> decide -> execute -> ui
+
+Items are tuples whose first element is their kind. Items of a kind a
+stage doesn't handle skip its queue and go straight to the next stage.
+"""
+import asyncio
+import copy
+import time
+
+from reconcile import apply_account_state
+
+
+class Stage:
+    """
+    One stage of the pipeline.
+
+    The handler takes an item and returns an iterable of items for the
+    next stage (or None). kinds is the set of item kinds the stage handles,
+    None for all of them. policy decides what happens when the queue is full:
+    "block" waits for room, "drop_newest" drops the incoming item and
+    "drop_oldest" drops the item at the front of the queue to make room.
+    If in_thread is True the handler runs in a worker thread so blocking
+    calls (REST requests) don't hold up the event loop.
+    """
+
+    POLICIES = ("block", "drop_newest", "drop_oldest")
+
+    def __init__(
+        self, name, handler, kinds=None, maxsize=1000, policy="block", in_thread=False,
+        on_error=None,
+    ):
+        """on_error is called with any exception raised by the handler."""
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown backpressure policy for stage {name}: {policy}")
+        self.name = name
+        self.handler = handler
+        self.kinds = kinds
+        self.on_error = on_error
+        self.queue = asyncio.Queue(maxsize)
+        self.policy = policy
+        self.in_thread = in_thread
+        self.next_stage = None
+
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.started_time = time.monotonic()
+
+    async def put(self, item):
+        """Add an item to the queue following the stage's backpressure policy."""
+        if self.kinds is not None and item[0] not in self.kinds:
+            if self.next_stage:
+                await self.next_stage.put(item)
+            return
+        if self.policy == "block":
+            await self.queue.put(item)
+            return
+        if self.queue.full():
+            self.dropped += 1
+            if self.policy == "drop_newest":
+                return
+            self.queue.get_nowait()
+            self.queue.task_done()
+        self.queue.put_nowait(item)
+
+    async def run(self):
+        """Worker loop: handle items and pass the results on."""
+        while True:
+            item = await self.queue.get()
+            start = time.perf_counter()
+            try:
+                if self.in_thread:
+                    results = await asyncio.to_thread(self.handler, item)
+                else:
+                    results = self.handler(item)
+            except Exception as e:
+                # One bad message shouldn't stop the stage.
+                self.errors += 1
+                results = None
+                if self.on_error:
+                    self.on_error(e)
+            self.busy_time += time.perf_counter() - start
+            self.processed += 1
+            self.queue.task_done()
+
+            if results and self.next_stage:
+                for result in results:
+                    await self.next_stage.put(result)
+
+    def stats(self):
+        """Queue depth, throughput (items/s), mean handling time (s) and drop count."""
+        elapsed = time.monotonic() - self.started_time
+        return {
+            "depth": self.queue.qsize(),
+            "maxsize": self.queue.maxsize,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "throughput": self.processed / elapsed if elapsed else 0.0,
+            "mean_handling": self.busy_time / self.processed if self.processed else 0.0,
+        }
+
+
+class Pipeline:
+    """A chain of Stages. Items put into the pipeline go to the first stage."""
+
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+        self.tasks = []
+
+    def __getitem__(self, name):
+        return next(stage for stage in self.stages if stage.name == name)
+
+    def start(self):
+        """Start a worker task for every stage."""
+        self.tasks = [asyncio.create_task(stage.run()) for stage in self.stages]
+        return self.tasks
+
+    async def put(self, item):
+        """Feed an item into the first stage."""
+        await self.stages[0].put(item)
+
+    def stats(self):
+        """{stage name: stage stats}"""
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def load(self, exclude=("ui",)):
+        """
+        ({stage name: (busy seconds, items handled)}, items queued) for
+        the stages not in exclude, as running totals, see qos.QosController.
+        """
+        stages = [stage for stage in self.stages if stage.name not in exclude]
+        return (
+            {stage.name: (stage.busy_time, stage.processed) for stage in stages},
+            sum(stage.queue.qsize() for stage in stages),
+        )
+
+    def format_stats(self):
+        """One line summary of the queue depth and throughput of each stage."""
+        return " | ".join(
+            f"{name}: {stats['depth']}/{stats['maxsize']} {stats['throughput']:.1f}/s"
+            + (f" ({stats['dropped']} dropped)" if stats["dropped"] else "")
+            for name, stats in self.stats().items()
+        )
+
+
+# Default queue size and policy for each stage.
+# The UI only ever needs the latest render request.
+DEFAULT_STAGE_SETTINGS = {
+    "ingest": {"maxsize": 10000, "policy": "block"},
+    "parse": {"maxsize": 1000, "policy": "block"},
+    "signal": {"maxsize": 1000, "policy": "block"},
+    "decide": {"maxsize": 1000, "policy": "block"},
+    "execute": {"maxsize": 100, "policy": "block", "in_thread": True},
+    "ui": {"maxsize": 1, "policy": "drop_oldest"},
+}
+
+
+def build_pipeline(
+    client, account_id, signaler, msghandler, ordmngr, ui, settings=None,
+    received_time=None, on_done=None,
+):
+    """
+    Builds the pipeline for the bot's modules.
+    settings is {stage name: {"maxsize":..., "policy":..., "in_thread":...}},
+    missing entries fall back to DEFAULT_STAGE_SETTINGS.
+    Raw stream messages are put into the returned pipeline with Pipeline.put.
+    Items carry the time their message was received (time.monotonic()
+    at ingest, or received_time(msg) if given) through every stage, and
+    on_done(received) is called once a message's item has been handled
+    in full: by the execute stage, or by the decide stage when there's
+    nothing to execute. It may be called from the execute stage's thread.
+    """
+    settings = settings or {}
+    received_time = received_time or (lambda msg: time.monotonic())
+    on_done = on_done or (lambda received: None)
+
+    def ingest(msg):
+        return [("raw", received_time(msg), msg)]
+
+    def parse(item):
+        _, received, msg = item
+        try:
+            # or [(content, service),...] in the case of account activity
+            # newdatafor in the form of [(symbol, service),...]
+            newdatafor = msghandler.handle(msg)
+        except KeyError as err:
+            ui.messages.append(err)
+            return None
+
+        if newdatafor and newdatafor[0][1] == "ACCT_ACTIVITY":
+            return [("activity", received, content) for (content, service) in newdatafor]
+        if newdatafor and newdatafor[0][1] == "OPTION":
+            # Option quotes are stored for pricing orders. Those for
+            # contracts held or being bought go on to update the exposure
+            # totals in the execute stage.
+            return [
+                ("option", received, symbol, dict(msghandler.last_messages[symbol]))
+                for (symbol, service) in newdatafor if symbol in ordmngr.exposure.contracts
+            ]
+        # Copy the data since later messages update the same store
+        # before the signal stage gets to this one.
+        return [
+            ("data", received, symbol, service, dict(msghandler.last_messages[symbol]))
+            for (symbol, service) in newdatafor
+        ]
+
+    def signal(item):
+        if item[0] == "backfill":
+            signaler.backfill(item[1], ui)
+            return None
+        if item[0] == "config":
+            # Passed on so the execute stage swaps the order manager config
+            # after the quotes already signalled under the old one.
+            item[1].apply_to_signaler(signaler, ui)
+            return [item]
+        _, received, symbol, service, data = item
+        new_signal, newprice = signaler.update(service, data, ui)
+        # Copy so later stages see the cloud as it was for this quote.
+        return [("quote", received, symbol, new_signal, newprice, copy.copy(signaler.cloud))]
+
+    def decide(item):
+        _, received, symbol, new_signal, newprice, cloud = item
+        if ordmngr.needs_update(symbol, new_signal, cloud, newprice):
+            return [item]
+        on_done(received)
+        return [("render", received)]
+
+    def execute(item):
+        if item[0] == "config":
+            item[1].apply_to_order_manager(ordmngr, ui)
+            return None
+        if item[0] == "option":
+            _, received, symbol, data = item
+            ordmngr.update_from_option_quote(symbol, data)
+            on_done(received)
+            return None
+        if item[0] == "reconcile":
+            apply_account_state(ordmngr, item[1], ui)
+            results = None
+        elif item[0] == "activity":
+            _, received, (symbol, msg_type, msg_data) = item
+            ordmngr.update_from_account_activity(symbol, msg_type, msg_data, ui)
+            results = [("render", received)]
+        else:
+            _, received, symbol, new_signal, newprice, cloud = item
+            ordmngr.update_from_quote(
+                client, account_id, cloud, symbol, new_signal, newprice, ui)
+            results = [("render", received)]
+        # The stage may run in a thread: the UI, the option subscriptions
+        # and the snapshot publisher read the copies made here instead.
+        ordmngr.publish_positions()
+        if item[0] != "reconcile":
+            on_done(received)
+        return results
+
+    def render(item):
+        ui.status = pipeline.format_stats()
+        ui.interface_clear()
+        ui.dispatch_display(msghandler, {"SPY": signaler.cloud}, ordmngr.visible_positions())
+
+    # (name, handler, kinds handled)
+    handlers = [
+        ("ingest", ingest, None),
+        ("parse", parse, {"raw"}),
+        ("signal", signal, {"data", "config", "backfill"}),
+        ("decide", decide, {"quote"}),
+        ("execute", execute, {"quote", "activity", "config", "reconcile", "option"}),
+        ("ui", render, {"render"}),
+    ]
+    ordmngr.publish_positions()
+    pipeline = Pipeline([
+        Stage(
+            name, handler, kinds, on_error=ui.messages.append,
+            **(DEFAULT_STAGE_SETTINGS[name] | settings.get(name, {})),
+        )
+        for name, handler, kinds in handlers
+    ])
+    return pipeline
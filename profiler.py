@@ -0,0 +1,207 @@
+"""
+On-demand sampling profiler for a running bot.
+
+Nothing is measured until a profile is asked for, by sending the process
+SIGUSR1 (kill -USR1 <pid>) or calling SamplingProfiler.start. A profile
+then samples the stack of every thread every interval seconds for
+duration seconds. Samples are taken by a SIGALRM interval timer rather
+than a sampling thread: a thread only gets the GIL when the event loop
+lets it go, which is mostly while it's idle, so it would hardly ever see
+the bot working. A blocking call delays the timer's handler until it
+returns, so each sample counts for the intervals that passed since the
+last one. Signal handlers run between two bytecodes of whatever the main
+thread was doing, possibly while it holds a lock, so the timer's handler
+only records stacks (with thread names cached beforehand) and marks the
+profile as due to end. Starting, stopping, logging and writing happen
+on the event loop: SIGUSR1 is handled with loop.add_signal_handler, and
+watch() stops finished profiles. The result is written in the folded stack format (one
+"frame;frame;frame count" line per distinct stack), which flamegraph.pl,
+speedscope and inferno read directly. The share of samples spent in the
+parts of the bot that matter (see SECTIONS) goes to the event log, as the
+fraction of samples in which some thread was running each of them.
+"""
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+from eventlog import log
+
+
+# name: function name prefixes (module:qualname) counted towards it in the summary.
+SECTIONS = {
+    "message_handling": ("main:message_handling", "fanout:StrategyHub.handle", "pipeline:"),
+    "signaler": ("signaler:Signaler.update",),
+    "ordermanager": ("ordermanager:OrderManager.",),
+    "rest": ("botutils:", "ordersubmit:submit_order"),
+    "ui": ("philui:",),
+}
+
+
+def frame_label(frame):
+    """module:qualname for a frame, ie. signaler:Signaler.update."""
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def folded_stack(frame, max_depth=128):
+    """The stack of frame as a tuple of labels, outermost first."""
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return tuple(reversed(labels))
+
+
+def sections_in(stack):
+    """The SECTIONS with a frame in stack."""
+    return {
+        section for section, prefixes in SECTIONS.items()
+        if any(label.startswith(prefixes) for label in stack)
+    }
+
+
+class SamplingProfiler:
+    """
+    Samples every thread's stack while a profile is running.
+
+    Fields:
+    interval
+    duration
+    directory
+    stacks
+    section_samples
+    running
+    """
+
+    def __init__(self, interval=0.005, duration=30, directory="."):
+        """
+        interval: seconds between samples. duration: default profile length
+        in seconds. Profiles are written to directory.
+        """
+        self.interval = interval
+        self.duration = duration
+        self.directory = directory
+        self.stacks = Counter()
+        # section: number of samples it was seen in
+        self.section_samples = Counter()
+        self.samples = 0
+        self.running = False
+        # Set by the timer when the profile's time is up, see watch.
+        self.expired = False
+        self.started = self.last_sample = self.deadline = 0.0
+        self.previous_handler = None
+        # thread id: name, refreshed outside the signal handler.
+        self.thread_names = {}
+        self.main_thread_id = threading.main_thread().ident
+        self.watch_task = None
+
+    def start(self, duration=None):
+        """
+        Start a profile of duration seconds. Returns False if one is already running.
+        Must be called from the main thread, not from a signal handler.
+        """
+        if self.running:
+            return False
+        self.refresh_thread_names()
+        self.running = True
+        self.expired = False
+        self.stacks = Counter()
+        self.section_samples = Counter()
+        self.samples = 0
+        self.started = self.last_sample = time.monotonic()
+        self.deadline = self.started + (duration or self.duration)
+        self.previous_handler = signal.signal(signal.SIGALRM, self._on_timer)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+        log("profile", started=True, duration=duration or self.duration, interval=self.interval)
+        return True
+
+    def stop(self):
+        """End the running profile and write it from a separate thread."""
+        if not self.running:
+            return False
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self.previous_handler or signal.SIG_DFL)
+        self.running = False
+        threading.Thread(
+            target=self.write,
+            args=(self.stacks, self.section_samples, self.samples, time.monotonic() - self.started),
+            name="profiler-writer", daemon=True,
+        ).start()
+        return True
+
+    def toggle(self):
+        """Start a profile, or stop the running one."""
+        if not self.start():
+            self.stop()
+
+    def refresh_thread_names(self):
+        self.thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+    def _on_timer(self, signum, frame):
+        # Runs as a signal handler: record and nothing else (no logging,
+        # no locks, no threads).
+        if self.expired:
+            return
+        now = time.monotonic()
+        if now >= self.deadline:
+            self.expired = True
+            return
+        weight = max(1, round((now - self.last_sample) / self.interval))
+        self.last_sample = now
+        self.sample(frame, weight)
+
+    def sample(self, frame, weight=1):
+        """
+        Add the stack of every thread, frame standing in for the main
+        thread's (where the timer interrupted it).
+        """
+        names = self.thread_names
+        sections = set()
+        for ident, thread_frame in sys._current_frames().items():
+            stack = folded_stack(frame if ident == self.main_thread_id else thread_frame)
+            self.stacks[(names.get(ident, str(ident)),) + stack] += weight
+            sections |= sections_in(stack)
+        for section in sections:
+            self.section_samples[section] += weight
+        self.samples += weight
+
+    def write(self, stacks, section_samples, samples, seconds):
+        """Write the folded stacks and log the summary. Returns the path written."""
+        path = os.path.join(self.directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w") as profile_file:
+            for stack, count in stacks.most_common():
+                profile_file.write(";".join(stack) + f" {count}\n")
+        log("profile", path=path, seconds=round(seconds, 1), samples=samples,
+            sections={
+                section: round(section_samples[section] / max(samples, 1), 3)
+                for section in SECTIONS
+            })
+        return path
+
+    async def watch(self, poll_interval=0.5):
+        """Stop profiles whose time is up and keep the thread names current."""
+        while True:
+            await asyncio.sleep(poll_interval)
+            if self.running and self.expired:
+                self.stop()
+            elif self.running:
+                self.refresh_thread_names()
+
+    def install(self, loop=None, signum=getattr(signal, "SIGUSR1", None)):
+        """
+        Start (or stop) a profile whenever the process receives signum,
+        handled by the event loop (the running one by default), and start
+        watch on it. Does nothing where the signal (or SIGALRM) doesn't
+        exist, ie. on Windows.
+        """
+        if signum is None or not hasattr(signal, "setitimer"):
+            return False
+        loop = loop or asyncio.get_running_loop()
+        loop.add_signal_handler(signum, self.toggle)
+        self.watch_task = loop.create_task(self.watch())
+        return True
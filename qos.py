@@ -0,0 +1,187 @@
+"""
+Picks the stream's quality of service level from how the bot is coping.
+
+TD Ameritrade sends level one updates at most once per QoS interval,
+from every 0.5 s (EXPRESS) to every 5 s (DELAYED). QosController
+measures, over windows of a few seconds, the share of the time spent
+handling messages (the load), the mean time to handle one and the number
+of messages queued but not handled yet. When handling falls behind (too
+much load or too many queued) it steps one level slower straight away.
+When a faster level would still leave headroom (the load scaled up by
+the faster rate stays under target_load, nothing is queued and messages
+are handled within max_latency) for hold windows in a row, it steps one
+level faster. A slow message alone doesn't make it step down, since
+fewer updates don't make each one quicker to handle. Every change is
+written to the event log with the numbers behind it.
+"""
+import asyncio
+
+from tda.streaming import StreamClient
+
+from eventlog import log
+from reconnect import DISCONNECT_ERRORS
+
+
+# Fastest first.
+QOS_LEVELS = [level.name for level in StreamClient.QOSLevel]
+# level: seconds between updates
+QOS_INTERVALS = {
+    "EXPRESS": 0.5, "REAL_TIME": 0.75, "FAST": 1.0, "MODERATE": 1.5, "SLOW": 3.0, "DELAYED": 5.0,
+}
+
+
+class QosController:
+    """
+    Adjusts the QoS level of a stream client to the measured load.
+
+    Fields:
+    level
+    fastest
+    slowest
+    window
+    changes
+    """
+
+    def __init__(
+        self, stream_client, sample=None, initial="FAST", fastest="EXPRESS", slowest="SLOW",
+        window=10.0, max_load=0.7, target_load=0.5, max_latency=0.25, max_depth=50, hold=3,
+    ):
+        """
+        sample() returns ({source: (busy seconds, messages handled)}, queued)
+        with running totals for each source (ie. pipeline stage), see
+        pipeline.Pipeline.load. Without it, the times given to record()
+        are used and nothing is taken to be queued.
+        Handling is behind when, over a window of window seconds, the
+        busiest source was busy more than max_load of the time or more
+        than max_depth messages were queued. A faster level is only
+        tried while it takes less than max_latency seconds per message.
+        """
+        self.stream_client = stream_client
+        self.sample = sample or self._recorded
+        self.level = QOS_LEVELS.index(initial)
+        self.fastest = QOS_LEVELS.index(fastest)
+        self.slowest = QOS_LEVELS.index(slowest)
+        self.window = window
+        self.max_load = max_load
+        self.target_load = target_load
+        self.max_latency = max_latency
+        self.max_depth = max_depth
+        self.hold = hold
+        # Windows in a row with room for a faster level.
+        self.headroom = 0
+        self.changes = 0
+
+        self.busy = 0.0
+        self.handled = 0
+        self.last_sample = None
+        self.last_time = None
+
+    @property
+    def level_name(self):
+        return QOS_LEVELS[self.level]
+
+    def _recorded(self):
+        return {"handler": (self.busy, self.handled)}, 0
+
+    def record(self, seconds):
+        """Count one message that took seconds to handle."""
+        self.busy += seconds
+        self.handled += 1
+
+    def metrics(self, now):
+        """
+        Load, mean handling time and messages per second of the busiest
+        source, the queue depth and the messages handled by every source,
+        since the last call.
+        """
+        totals, depth = self.sample()
+        previous, previous_time = self.last_sample or {}, self.last_time
+        self.last_sample, self.last_time = totals, now
+        elapsed = now - previous_time if previous_time is not None else 0
+        load = latency = rate = 0.0
+        total_handled = 0
+        for source, (busy, handled) in totals.items():
+            busy_before, handled_before = previous.get(source, (0.0, 0))
+            source_busy = busy - busy_before
+            source_handled = handled - handled_before
+            total_handled += source_handled
+            source_load = source_busy / elapsed if elapsed else 0.0
+            if source_load >= load:
+                load = source_load
+                latency = source_busy / source_handled if source_handled else 0.0
+                rate = source_handled / elapsed if elapsed else 0.0
+        return {
+            "load": round(load, 3), "latency": round(latency, 4),
+            "rate": round(rate, 2), "depth": depth, "handled": total_handled,
+        }
+
+    def decide(self, metrics):
+        """(new level, reason) for a window's metrics; the level is unchanged if there's no reason."""
+        behind = []
+        if metrics["load"] > self.max_load:
+            behind.append(f"load {metrics['load']:.2f} > {self.max_load}")
+        if metrics["depth"] > self.max_depth:
+            behind.append(f"{metrics['depth']} queued > {self.max_depth}")
+        if behind:
+            self.headroom = 0
+            if self.level < self.slowest:
+                return self.level + 1, ", ".join(behind)
+            return self.level, None
+
+        if self.level <= self.fastest or not metrics["handled"]:
+            # Nothing to go on in a window without messages.
+            return self.level, None
+        faster = QOS_LEVELS[self.level - 1]
+        expected_load = metrics["load"] * QOS_INTERVALS[self.level_name] / QOS_INTERVALS[faster]
+        if expected_load < self.target_load and not metrics["depth"] \
+                and metrics["latency"] <= self.max_latency:
+            self.headroom += 1
+        else:
+            self.headroom = 0
+        if self.headroom >= self.hold:
+            self.headroom = 0
+            return self.level - 1, \
+                f"load {metrics['load']:.2f} ({expected_load:.2f} at {faster}) for {self.hold} windows"
+        return self.level, None
+
+    async def apply(self):
+        """Ask the stream for the current level, ie. after logging in."""
+        await self.stream_client.quality_of_service(StreamClient.QOSLevel[self.level_name])
+
+    async def evaluate(self, now, ui=None):
+        """Measure the last window and change the level if needed. Returns the change reason or None."""
+        metrics = self.metrics(now)
+        level, reason = self.decide(metrics)
+        if level == self.level:
+            return None
+        previous = self.level_name
+        self.level = level
+        self.changes += 1
+        log("stream_qos", level=self.level_name, previous=previous, reason=reason, **metrics)
+        if ui is not None:
+            ui.messages.append(f"Stream QoS {previous} -> {self.level_name}: {reason}.")
+        try:
+            await self.apply()
+        except DISCONNECT_ERRORS as err:
+            # The level is set again when the session resubscribes.
+            log("stream_qos", "warning", level=self.level_name, error=str(err))
+        return reason
+
+    async def run(self, ui=None):
+        """Evaluate every window seconds."""
+        loop = asyncio.get_running_loop()
+        self.metrics(loop.time())
+        while True:
+            await asyncio.sleep(self.window)
+            await self.evaluate(loop.time(), ui)
+
+
+def qos_from_config(stream_client, stream_config, sample=None):
+    """
+    A QosController from the "qos" entry of the "stream" config section,
+    or None if it's turned off with "qos": {"adaptive": false}.
+    """
+    qos_config = dict(stream_config.get("qos", {}))
+    if not qos_config.pop("adaptive", True):
+        return None
+    return QosController(stream_client, sample, **qos_config)
@@ -0,0 +1,269 @@
+"""
+Detects gaps in the stream and reconciles order state with the account.
+
+If account activity messages are dropped, Position.net_pos and
+associated_orders drift from what the broker has. GapDetector watches
+the seq numbers of stream messages (per service and subscription key)
+and how long it's been since any message arrived. When it sees a gap (or
+the stream goes quiet for longer than a heartbeat should take), Reconciler
+fetches every position and order in one get_account request, in a worker
+thread so quotes keep being handled, and then rebuilds the state of every
+order manager trading the account from it.
+Account activity handled while the request was out makes the snapshot
+stale, so it's dropped and fetched again rather than rolling fills back.
+"""
+import asyncio
+import time
+
+from tda.client import Client
+
+from eventlog import log
+
+
+# TDA order statuses for orders that are still working.
+WORKING_STATUSES = {
+    "AWAITING_PARENT_ORDER", "AWAITING_CONDITION", "AWAITING_MANUAL_REVIEW", "ACCEPTED",
+    "AWAITING_UR_OUT", "PENDING_ACTIVATION", "QUEUED", "WORKING",
+    "PENDING_CANCEL", "PENDING_REPLACE",
+}
+
+
+# Account activity message types and the order status they leave behind.
+ACTIVITY_STATUSES = {
+    "OrderEntryRequest": "OPEN",
+    "OrderCancelReplaceRequest": "OPEN",
+    "OrderCancelRequest": "OPEN",
+    "OrderRoute": "OPEN",
+    "TooLateToCancel": "OPEN",
+    # Set by Position.close for the market sell.
+    "SELL_TO_CLOSE": "OPEN",
+    "OrderFill": "FILLED",
+    "UROUT": "CANCELED",
+    "OrderRejection": "OrderRejection",
+}
+
+
+def order_status(tda_status):
+    """An order status from the account endpoint in the form associated_orders uses."""
+    if tda_status in WORKING_STATUSES:
+        return "OPEN"
+    if tda_status == "REJECTED":
+        return "OrderRejection"
+    return tda_status
+
+
+class GapDetector:
+    """
+    Watches stream messages for skipped seq numbers and silence.
+
+    Fields:
+    last_seq
+    last_message
+    gaps
+    """
+
+    def __init__(self, services=("ACCT_ACTIVITY",), heartbeat_timeout=30):
+        """
+        Seq numbers are checked for services. heartbeat_timeout is how many
+        seconds without any message count as a gap.
+        """
+        self.services = set(services)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.last_seq = {}  # (service, key): last seq seen
+        self.last_message = time.monotonic()
+        self.gaps = 0
+        self.gap_pending = False
+        # So a quiet stream is only reported once until messages resume.
+        self.stale_reported = False
+
+    def observe(self, msg):
+        """Check a message, returns True if it shows a gap."""
+        self.last_message = time.monotonic()
+        self.stale_reported = False
+        service = msg.get("service")
+        if service not in self.services:
+            return False
+        gap = False
+        for content in msg.get("content", []):
+            seq = content.get("seq")
+            if seq is None:
+                continue
+            key = (service, content.get("key"))
+            last = self.last_seq.get(key)
+            if last is not None and seq > last + 1:
+                gap = True
+                log("stream_gap", "warning", service=service, key=key[1],
+                    expected=last + 1, received=seq)
+            self.last_seq[key] = seq if last is None else max(seq, last)
+        if gap:
+            self.gaps += 1
+            self.gap_pending = True
+        return gap
+
+    def reset(self):
+        """Forget the seq numbers seen, for a new stream session."""
+        self.last_seq = {}
+        self.last_message = time.monotonic()
+        self.stale_reported = False
+
+    def stale(self):
+        """True if nothing has arrived for longer than heartbeat_timeout."""
+        return time.monotonic() - self.last_message > self.heartbeat_timeout
+
+    def take_gap(self):
+        """True (once) if a gap was seen or the stream went stale."""
+        if self.gap_pending:
+            self.gap_pending = False
+            return True
+        if self.stale() and not self.stale_reported:
+            self.stale_reported = True
+            log("stream_gap", "warning", silent_for=time.monotonic() - self.last_message)
+            return True
+        return False
+
+
+def local_status(status):
+    """A status from associated_orders in the form order_status returns."""
+    return ACTIVITY_STATUSES.get(status, status)
+
+
+def fetch_account_state(client, account_id):
+    """
+    Every position and order in one request.
+    Returns {"positions": {symbol: net quantity}, "orders": {order_id: status}}.
+    """
+    response = client.get_account(
+        account_id, fields=[Client.Account.Fields.POSITIONS, Client.Account.Fields.ORDERS])
+    response.raise_for_status()
+    account = response.json()["securitiesAccount"]
+    positions = {
+        position["instrument"]["symbol"]:
+            int(position.get("longQuantity", 0) - position.get("shortQuantity", 0))
+        for position in account.get("positions", [])
+    }
+    orders = {
+        int(order["orderId"]): order_status(order["status"])
+        for order in account.get("orderStrategies", [])
+    }
+    return {"positions": positions, "orders": orders}
+
+
+def apply_account_state(ordmngr, state, ui):
+    """
+    Bring every tracked position in line with state (from fetch_account_state).
+    Returns the number of positions changed, or None (and marks state
+    "stale") if account activity was handled since state was fetched.
+    """
+    if state.get("activity_seq", ordmngr.activity_seq) != ordmngr.activity_seq:
+        state["stale"] = True
+        log("reconcile", stale=True, activity_since=ordmngr.activity_seq - state["activity_seq"])
+        return None
+    changed = 0
+    for symbol, position in list(ordmngr.current_positions.items()):
+        net_pos = state["positions"].get(position.contract, 0)
+        orders = {
+            order_id: state["orders"][order_id]
+            for order_id in position.associated_orders if order_id in state["orders"]
+        }
+        drift = {
+            order_id: (position.associated_orders[order_id], status)
+            for order_id, status in orders.items()
+            if local_status(position.associated_orders[order_id]) != status
+        }
+        if net_pos == position.net_pos and not drift:
+            continue
+        changed += 1
+        log("reconcile", "warning", contract=position.contract,
+            net_pos=(position.net_pos, net_pos), orders=drift)
+        ui.messages.append(
+            f"Reconciled {position.contract}: net position {position.net_pos} -> {net_pos}, "
+            f"{len(drift)} order statuses updated.")
+        position.net_pos = net_pos
+        position.associated_orders.update(
+            {order_id: status for order_id, (_, status) in drift.items()})
+        for order_id, (_, status) in drift.items():
+            if status != "OPEN":
+                position.working_buys.pop(order_id, None)
+        ordmngr.track_exposure(position)
+
+    tracked = {position.contract for position in ordmngr.current_positions.values()}
+    untracked = [symbol for symbol, quantity in state["positions"].items()
+                 if quantity and symbol not in tracked and "_" in symbol]
+    if untracked:
+        log("reconcile", "warning", untracked=untracked)
+    return changed
+
+
+class Reconciler:
+    """
+    Reconciles the order managers trading an account with it whenever the
+    detector reports a gap. The account is fetched once for all of them.
+
+    Fields:
+    detector
+    last_run
+    """
+
+    def __init__(self, client, account_id, ordmngrs, ui, detector, check_interval=1.0, min_interval=10.0):
+        """Reconciles at most once every min_interval seconds."""
+        self.client = client
+        self.account_id = account_id
+        self.ordmngrs = list(ordmngrs)
+        self.ui = ui
+        self.detector = detector
+        self.check_interval = check_interval
+        self.min_interval = min_interval
+        self.last_run = 0.0
+        self.requested = False
+        # The last states handed to apply, to fetch again if one was stale.
+        self.applied = []
+
+    def request(self):
+        """Ask for a reconciliation regardless of the detector."""
+        self.requested = True
+
+    def positions_for(self, ordmngr, positions):
+        """
+        The account positions less what the other order managers hold of
+        the same contracts, so each is only given its own share.
+        """
+        positions = dict(positions)
+        for other in self.ordmngrs:
+            if other is ordmngr:
+                continue
+            for position in other.current_positions.values():
+                if position.contract in positions:
+                    positions[position.contract] -= position.net_pos
+        return positions
+
+    async def run(self, apply):
+        """
+        Check for gaps every check_interval seconds. The account request
+        runs in a thread; apply(ordmngr, state) is awaited with the result
+        for each order manager so the caller decides when to change the
+        positions. If that turns out to be after more account activity
+        (see apply_account_state) the account is fetched again.
+        """
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if any(state.get("stale") for state in self.applied):
+                self.applied = []
+                self.requested = True
+            if time.monotonic() - self.last_run < self.min_interval:
+                continue
+            if not (self.detector.take_gap() or self.requested):
+                continue
+            self.requested = False
+            self.last_run = time.monotonic()
+            activity_seqs = [ordmngr.activity_seq for ordmngr in self.ordmngrs]
+            try:
+                state = await asyncio.to_thread(fetch_account_state, self.client, self.account_id)
+            except Exception as e:
+                log("reconcile", "error", error=str(e))
+                self.requested = True
+                continue
+            # One copy per order manager, each marked stale on its own.
+            self.applied = [dict(state, activity_seq=seq) for seq in activity_seqs]
+            for ordmngr, ordmngr_state in zip(self.ordmngrs, self.applied):
+                ordmngr_state["positions"] = self.positions_for(ordmngr, state["positions"])
+                await apply(ordmngr, ordmngr_state)
@@ -0,0 +1,116 @@
+"""
+Keeps the stream connected.
+
+When handle_message fails because the connection dropped, StreamSession
+logs in again after a jittered, exponentially growing delay (so a broker
+outage isn't met by every retry at once), resubscribes every service and
+then calls on_reconnect. The bot uses on_reconnect to backfill the chart
+candles it missed (see Signaler.backfill) and to reconcile orders, so it
+carries on where it left off instead of starting from scratch.
+"""
+import asyncio
+import random
+import time
+
+from tda.streaming import UnexpectedResponse, UnexpectedResponseCode
+from websockets.exceptions import ConnectionClosed
+
+from eventlog import log
+
+
+# Errors that mean the stream connection is gone.
+DISCONNECT_ERRORS = (
+    ConnectionClosed, ConnectionError, OSError, asyncio.TimeoutError,
+    UnexpectedResponse, UnexpectedResponseCode,
+)
+
+
+def backoff_delay(attempt, initial_delay=1.0, max_delay=60.0, rand=random):
+    """
+    Seconds to wait before reconnect attempt number attempt (from 0).
+    Anywhere between 0 and initial_delay * 2**attempt, capped at max_delay.
+    """
+    return rand.uniform(0, min(max_delay, initial_delay * 2 ** attempt))
+
+
+class StreamSession:
+    """
+    A stream connection that reconnects itself.
+
+    Fields:
+    stream_client
+    connected
+    reconnects
+    """
+
+    def __init__(
+        self, stream_client, subscribe, on_reconnect=None, initial_delay=1.0, max_delay=60.0,
+    ):
+        """
+        subscribe() is awaited after every login to subscribe to each
+        service; handlers should be added once, before the first connect.
+        on_reconnect() is awaited after a reconnect has resubscribed.
+        """
+        self.stream_client = stream_client
+        self.subscribe = subscribe
+        self.on_reconnect = on_reconnect
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.connected = False
+        self.reconnects = 0
+
+    async def connect(self, attempt=0):
+        """
+        Log in and subscribe, retrying with backoff until it works.
+        attempt is the number of the first attempt, for the delays after it.
+        """
+        while True:
+            try:
+                await self.stream_client.login()
+                await self.subscribe()
+                break
+            except DISCONNECT_ERRORS as e:
+                delay = backoff_delay(attempt, self.initial_delay, self.max_delay)
+                log("stream_reconnect", "warning", attempt=attempt, error=str(e), retry_in=delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+        self.connected = True
+
+    async def reconnect(self, error):
+        """Connect again after error dropped the connection."""
+        self.connected = False
+        disconnected_at = time.monotonic()
+        log("stream_disconnect", "warning", error=str(error))
+        await asyncio.sleep(backoff_delay(0, self.initial_delay, self.max_delay))
+        # The delay before the first attempt was just waited, so a failure
+        # waits the delay for attempt 1.
+        await self.connect(attempt=1)
+        self.reconnects += 1
+        log("stream_reconnect", reconnects=self.reconnects,
+            down_for=time.monotonic() - disconnected_at)
+        if self.on_reconnect:
+            await self.on_reconnect()
+
+    async def run(self, after_message=None, tasks=()):
+        """
+        Connect (unless already connected) and handle messages forever,
+        reconnecting whenever the connection drops.
+        after_message() is awaited after every message.
+        tasks are background tasks working alongside the stream; they're
+        cancelled and waited for when this returns or fails.
+        """
+        try:
+            if not self.connected:
+                await self.connect()
+            while True:
+                try:
+                    await self.stream_client.handle_message()
+                except DISCONNECT_ERRORS as e:
+                    await self.reconnect(e)
+                    continue
+                if after_message:
+                    await after_message()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -10,9 +10,22 @@ are irrelevant to this module.
 """
 
 from enum import Enum
+import time
 
-from ema import exp_mov_avg, Cloud, CloudColor, CloudPriceLocation
+import numpy as np
+
+from ema import exp_mov_avg, Cloud, CloudColor, CloudPriceLocation, \
+    CLOUD_COLORS, CLOUD_PRICE_LOCATIONS, encode_cloud_status, decode_cloud_status, \
+    determine_cloud_status_array
 from botutils import get_history
+from indicators import combine_candles, timeframe_candles
+from emabank import EmaBank
+from eventlog import log
+
+
+# A day of minute candles, the most kept for reseeding. More than
+# get_history returns at startup, so reseeding sees at least as much.
+MAX_MINUTE_CANDLES = 24 * 60
 
 
 class Signals(Enum):
@@ -20,6 +33,148 @@ class Signals(Enum):
     OPEN, OPEN_OR_INCREASE, CLOSE, EXIT = range(4)
 
 
+def status_change_to_signal(status, new_status):
+    """
+    Takes a change of status (old_status, new_status)
+    and returns a signal from the Signal enum or 0.
+
+    Returns Signals.CLOSE in event of cloud color change.
+    Primarily intended for buy signals, stop losses and
+    take profit levels are handled outside this module.
+    """
+    color, location = status
+    new_color, new_location = new_status
+
+    if color != new_color:
+        # Exit any entered position on color change.
+        return Signals.CLOSE
+
+    if color == CloudColor.GREEN:
+        # Bullish moves up.
+        if (
+            location == CloudPriceLocation.BELOW
+            and new_location == CloudPriceLocation.INSIDE
+        ):
+            return Signals.OPEN
+        if (
+            location == CloudPriceLocation.INSIDE
+            and new_location == CloudPriceLocation.ABOVE
+        ):
+            return Signals.OPEN_OR_INCREASE
+
+        # Bearish moves down.
+        if (
+            location == CloudPriceLocation.ABOVE
+            and new_location == CloudPriceLocation.INSIDE
+        ):
+            return 0
+        if (
+            location == CloudPriceLocation.INSIDE
+            and new_location == CloudPriceLocation.BELOW
+        ):
+            return 0
+
+    if color == CloudColor.RED:
+        # Bullish moves up.
+        if (
+            location == CloudPriceLocation.BELOW
+            and new_location == CloudPriceLocation.INSIDE
+        ):
+            return 0
+        if (
+            location == CloudPriceLocation.INSIDE
+            and new_location == CloudPriceLocation.ABOVE
+        ):
+            return 0
+
+        # Bearish moves down.
+        if (
+            location == CloudPriceLocation.ABOVE
+            and new_location == CloudPriceLocation.INSIDE
+        ):
+            return Signals.OPEN
+        if (
+            location == CloudPriceLocation.INSIDE
+            and new_location == CloudPriceLocation.BELOW
+        ):
+            return Signals.OPEN_OR_INCREASE
+
+    # In case of confusion.
+    return 0
+
+
+# Code used in signal arrays where the scalar path returns 0.
+NO_SIGNAL = -1
+
+
+def _build_transition_table():
+    """
+    Precompute the signal for every possible change of cloud status.
+    Indexed as [color, location, new_color, new_location] with the codes
+    from ema.CLOUD_COLORS and ema.CLOUD_PRICE_LOCATIONS.
+    Filled in from status_change_to_signal so the two can't disagree.
+    """
+    table = np.full(
+        (len(CLOUD_COLORS), len(CLOUD_PRICE_LOCATIONS)) * 2, NO_SIGNAL, dtype=np.int8)
+    for index in np.ndindex(table.shape):
+        color, location, new_color, new_location = index
+        signal = status_change_to_signal(
+            decode_cloud_status(color, location),
+            decode_cloud_status(new_color, new_location),
+        )
+        if signal:
+            table[index] = signal.value
+    return table
+
+
+TRANSITION_TABLE = _build_transition_table()
+
+
+def signals_from_status_arrays(color_codes, location_codes, initial_status=None):
+    """
+    Array version of status_change_to_signal for a whole series.
+    Takes the output of ema.determine_cloud_status_array and returns an
+    int8 array of Signals values, NO_SIGNAL where there is none.
+    Element i is the signal for the change from status i-1 to status i;
+    element 0 compares against initial_status (a (CloudColor, CloudPriceLocation)
+    tuple) if given and is NO_SIGNAL otherwise.
+    """
+    color_codes = np.asarray(color_codes, dtype=np.intp)
+    location_codes = np.asarray(location_codes, dtype=np.intp)
+
+    signal_codes = np.full(color_codes.shape, NO_SIGNAL, dtype=np.int8)
+    if not len(color_codes):
+        return signal_codes
+
+    signal_codes[1:] = TRANSITION_TABLE[
+        color_codes[:-1], location_codes[:-1], color_codes[1:], location_codes[1:]
+    ]
+    if initial_status is not None:
+        color, location = encode_cloud_status(initial_status)
+        signal_codes[0] = TRANSITION_TABLE[
+            color, location, color_codes[0], location_codes[0]]
+    return signal_codes
+
+
+def cloud_signals(prices, short_emas, long_emas, initial_status=None):
+    """
+    Cloud status and signals over a whole series of prices and EMA values.
+    Returns (color_codes, location_codes, signal_codes).
+    """
+    color_codes, location_codes = determine_cloud_status_array(
+        prices, short_emas, long_emas)
+    signal_codes = signals_from_status_arrays(
+        color_codes, location_codes, initial_status)
+    return color_codes, location_codes, signal_codes
+
+
+def decode_signal(signal_code):
+    """Turn a code from a signal array back into a Signals member (or 0)."""
+    if signal_code == NO_SIGNAL:
+        return 0
+    return Signals(int(signal_code))
+
+
 class Signaler:
     """
     A class for sending signals from the Signals enum,
@@ -33,8 +188,16 @@ class Signaler:
         short_ema_length,
         long_ema_length,
         timeframe_minutes,
+        indicators=None,
+        clouds=None,
     ):
         """
+        indicators is a list of indicators.Indicator, updated on every
+        completed timeframe_minutes candle alongside the EMAs.
+        clouds are extra clouds to follow alongside the traded one,
+        {name: (short length, long length, timeframe minutes)}, kept in an
+        emabank.EmaBank. Their status changes are logged but not traded.
+
         Fields:
         short_ema_length
         long_ema_length
@@ -43,9 +206,20 @@ class Signaler:
         symbol
         cloud
         timeframe_minutes
+        minute_candles
+        max_minute_candles
+        last_price
+        last_chart_time
+        backfill_pending
+        held_candles
+        indicators
+        bank
         """
-        history = get_history(client, symbol)[timeframe_minutes-1::timeframe_minutes]
-        closevals = [candle["close"] for candle in history]
+        # Kept so EMAs can be reseeded without fetching the history again,
+        # the oldest dropped past max_minute_candles (see add_candle).
+        self.minute_candles = get_history(client, symbol)
+        self.max_minute_candles = max(MAX_MINUTE_CANDLES, len(self.minute_candles))
+        closevals = [candle["close"] for candle in self.minute_candles][timeframe_minutes-1::timeframe_minutes]
 
         self.short_ema_length = short_ema_length
         self.long_ema_length = long_ema_length
@@ -53,6 +227,7 @@ class Signaler:
         short_ema = exp_mov_avg(closevals.copy(), short_ema_length)
         long_ema = exp_mov_avg(closevals.copy(), long_ema_length)
         currentprice = closevals[-1]
+        self.last_price = currentprice
 
         # From completed candles, only change on new completed candle.
         self.historical = {"short": short_ema, "long": long_ema}
@@ -61,6 +236,17 @@ class Signaler:
         # (ie. the current data which will have already been retrieved from get_history)
         # If not ignored would add redundant data to ema calculations.
         self.first_chart_equity = True
+        # CHART_TIME of the newest candle applied, so candles resent after
+        # resubscribing aren't applied twice and missed ones can be backfilled.
+        # The last history candle is still in progress, the one before it
+        # is the latest completed.
+        self.last_chart_time = None
+        if len(self.minute_candles) > 1:
+            self.last_chart_time = self.minute_candles[-2].get("datetime")
+        # While a backfill is pending streamed candles are held rather than
+        # applied, so last_chart_time stays before the gap until it's filled.
+        self.backfill_pending = False
+        self.held_candles = []
 
         self.symbol = symbol
         self.cloud = Cloud(short_ema, long_ema, currentprice)
@@ -68,6 +254,85 @@ class Signaler:
         self.timeframe_minutes = timeframe_minutes
         self.candle_counter = 0
 
+        # name: Indicator
+        self.indicators = {indicator.name: indicator for indicator in indicators or []}
+        # name: [seconds spent updating, number of updates]
+        self.indicator_costs = {name: [0.0, 0] for name in self.indicators}
+        # Streamed minute candles of the timeframe candle in progress.
+        self.pending_candles = []
+        self.seed_indicators()
+
+        self.bank = EmaBank(self.minute_candles, clouds) if clouds else None
+
+    def seed_indicators(self):
+        """Seed every indicator from the kept minute candles."""
+        candles = timeframe_candles(self.minute_candles, self.timeframe_minutes)
+        for indicator in self.indicators.values():
+            indicator.seed(candles)
+
+    def update_indicators(self, candle):
+        """
+        Update every indicator with a completed timeframe candle, timing
+        each, and log their values (see indicator_report).
+        """
+        if not self.indicators:
+            return
+        for name, indicator in self.indicators.items():
+            start = time.perf_counter()
+            indicator.update(candle)
+            cost = self.indicator_costs[name]
+            cost[0] += time.perf_counter() - start
+            cost[1] += 1
+        log("indicators", symbol=self.symbol, indicators=self.indicator_report())
+
+    def indicator(self, name):
+        """The indicator called name, None if name is None. Raises ValueError if there isn't one."""
+        if name is None:
+            return None
+        if name not in self.indicators:
+            raise ValueError(f"Unknown indicator for {self.symbol}: {name}")
+        return self.indicators[name]
+
+    def indicator_report(self):
+        """{name: {"value":..., "state_size":..., "mean_update_us":...}}"""
+        return {
+            name: {
+                "value": indicator.value,
+                "state_size": indicator.state_size,
+                "mean_update_us": (
+                    self.indicator_costs[name][0] / self.indicator_costs[name][1] * 1e6
+                    if self.indicator_costs[name][1] else 0.0),
+            }
+            for name, indicator in self.indicators.items()
+        }
+
+    def reseed(self, short_ema_length, long_ema_length, timeframe_minutes=None):
+        """
+        Recalculate the EMAs with new lengths (and timeframe) from the
+        locally kept minute candles, without another history request.
+        Indicators are reseeded too if the timeframe changes.
+        The cloud status is updated to the last price seen but no signal
+        is emitted for the change.
+        """
+        timeframe_minutes = timeframe_minutes or self.timeframe_minutes
+        closevals = [candle["close"] for candle in self.minute_candles][timeframe_minutes-1::timeframe_minutes]
+
+        self.short_ema_length = short_ema_length
+        self.long_ema_length = long_ema_length
+        self.historical = {
+            "short": exp_mov_avg(closevals.copy(), short_ema_length),
+            "long": exp_mov_avg(closevals.copy(), long_ema_length),
+        }
+        if timeframe_minutes != self.timeframe_minutes:
+            self.timeframe_minutes = timeframe_minutes
+            # Line the candle count up with the slicing above.
+            self.candle_counter = len(self.minute_candles) % timeframe_minutes
+            self.pending_candles = self.minute_candles[len(self.minute_candles) - self.candle_counter:]
+            self.seed_indicators()
+
+        self.cloud = Cloud(self.historical["short"], self.historical["long"], self.last_price)
+        self.update_cloud(self.last_price)
+
     def update_cloud(self, new_price):
         """
         Update EMAs and cloud based on new data.
@@ -94,70 +359,77 @@ class Signaler:
         Input should come from the update function.
         Takes a change of status (old_status, new_status)
         and returns a signal from the Signal enum or 0.
+        See status_change_to_signal.
+        """
+        return status_change_to_signal(status, new_status)
 
-        Returns Signals.CLOSE in event of cloud color change.
-        Primarily intended for buy signals, stop losses and
-        take profit levels are handled outside this module.
-        """
-        color, location = status
-        new_color, new_location = new_status
-
-        if color != new_color:
-            # Exit any entered position on color change.
-            return Signals.CLOSE
-
-        if color == CloudColor.GREEN:
-            # Bullish moves up.
-            if (
-                location == CloudPriceLocation.BELOW
-                and new_location == CloudPriceLocation.INSIDE
-            ):
-                return Signals.OPEN
-            if (
-                location == CloudPriceLocation.INSIDE
-                and new_location == CloudPriceLocation.ABOVE
-            ):
-                return Signals.OPEN_OR_INCREASE
-
-            # Bearish moves down.
-            if (
-                location == CloudPriceLocation.ABOVE
-                and new_location == CloudPriceLocation.INSIDE
-            ):
-                return 0
-            if (
-                location == CloudPriceLocation.INSIDE
-                and new_location == CloudPriceLocation.BELOW
-            ):
-                return 0
-
-        if color == CloudColor.RED:
-            # Bullish moves up.
-            if (
-                location == CloudPriceLocation.BELOW
-                and new_location == CloudPriceLocation.INSIDE
-            ):
-                return 0
-            if (
-                location == CloudPriceLocation.INSIDE
-                and new_location == CloudPriceLocation.ABOVE
-            ):
-                return 0
-
-            # Bearish moves down.
-            if (
-                location == CloudPriceLocation.ABOVE
-                and new_location == CloudPriceLocation.INSIDE
-            ):
-                return Signals.OPEN
-            if (
-                location == CloudPriceLocation.INSIDE
-                and new_location == CloudPriceLocation.BELOW
-            ):
-                return Signals.OPEN_OR_INCREASE
-
-        # In case of confusion.
-        return 0
+    def add_candle(self, candle):
+        """
+        Add a completed minute candle, updating the historical EMAs
+        and indicators when it completes a timeframe candle.
+        """
+        self.minute_candles.append(candle)
+        excess = len(self.minute_candles) - self.max_minute_candles
+        if excess >= self.timeframe_minutes:
+            # Whole timeframe candles, so reseed's slicing keeps its phase.
+            del self.minute_candles[:excess - excess % self.timeframe_minutes]
+        if "datetime" in candle:
+            self.last_chart_time = candle["datetime"]
+        if self.bank:
+            self.bank.add_candle(candle["close"])
+        self.pending_candles.append(candle)
+        self.candle_counter += 1
+        if self.candle_counter < self.timeframe_minutes:
+            return
+
+        self.candle_counter = 0
+        self.update_indicators(combine_candles(self.pending_candles))
+        self.pending_candles = []
+
+        close_price = candle["close"]
+        self.historical["short"] = exp_mov_avg(
+            [self.historical["short"], close_price], self.short_ema_length)
+        self.historical["long"] = exp_mov_avg(
+            [self.historical["long"], close_price], self.long_ema_length)
+
+    def expect_backfill(self):
+        """Hold streamed candles until backfill is called, ie. after a reconnect."""
+        self.backfill_pending = True
+
+    def backfill(self, candles, ui):
+        """
+        Apply the candles (from get_history) completed after the last one
+        applied, in order, as if they had come from the stream, then any
+        streamed candles held since expect_backfill that are newer still.
+        The last candle of the history is still in progress and is left
+        for the stream. Returns the number of candles applied from the history.
+        No signal is emitted, the cloud status carries on from the next quote.
+        """
+        held, self.held_candles = self.held_candles, []
+        self.backfill_pending = False
+        if self.last_chart_time is None:
+            return 0
+        missed = [
+            candle for candle in candles[:-1]
+            if candle.get("datetime", 0) > self.last_chart_time
+        ]
+        for candle in missed:
+            self.add_candle(candle)
+        for candle in held:
+            if candle.get("datetime", 0) > self.last_chart_time:
+                self.add_candle(candle)
+        if missed:
+            ui.messages.append(f"Backfilled {len(missed)} {self.symbol} candles.")
+        log("backfill", symbol=self.symbol, candles=len(missed), last_chart_time=self.last_chart_time)
+        return len(missed)
+
+    def update_bank(self, new_price):
+        """Update the extra clouds, logging any that would signal."""
+        for name, status, new_status in self.bank.update(new_price):
+            signal = status_change_to_signal(status, new_status)
+            if signal:
+                log("cloud_signal", symbol=self.symbol, cloud=name, signal=str(signal),
+                    price=new_price)
 
     def update(self, service, data, ui):
         """
@@ -176,27 +448,41 @@ class Signaler:
                 new_price = data["LAST_PRICE"]
             except KeyError as _:
                 return 0, None
+            self.last_price = new_price
+            if self.bank:
+                self.update_bank(new_price)
 
         elif service == "CHART_EQUITY":
 
+            chart_time = data.get("CHART_TIME")
+
             # Check if this is the first message from the stream.
             # The first message should be ignored for sensible
             # EMA calculation.
             if self.first_chart_equity:
                 self.first_chart_equity = False
+                if chart_time is not None:
+                    self.last_chart_time = max(chart_time, self.last_chart_time or 0)
                 return 0, None
 
-            self.candle_counter += 1
-            if self.candle_counter < self.timeframe_minutes:
+            if chart_time is not None and self.last_chart_time is not None \
+                    and chart_time <= self.last_chart_time:
+                # Already applied, ie. sent again after resubscribing.
                 return 0, None
 
-            self.candle_counter = 0
-
-            close_price = data["CLOSE_PRICE"]
-            self.historical["short"] = exp_mov_avg(
-                [self.historical["short"], close_price], self.short_ema_length)
-            self.historical["long"] = exp_mov_avg(
-                [self.historical["long"], close_price], self.long_ema_length)
+            candle = {
+                "open": data["OPEN_PRICE"],
+                "high": data["HIGH_PRICE"],
+                "low": data["LOW_PRICE"],
+                "close": data["CLOSE_PRICE"],
+                "volume": data.get("VOLUME", 0),
+            }
+            if chart_time is not None:
+                candle["datetime"] = chart_time
+            if self.backfill_pending:
+                self.held_candles.append(candle)
+                return 0, None
+            self.add_candle(candle)
             return 0, None
 
         status_update = self.update_cloud(new_price)
@@ -204,5 +490,6 @@ class Signaler:
             old_status, new_status = status_update
             signal = self.cloud_status_to_signal(old_status, new_status)
             ui.messages.append(f"New Signal for {self.symbol}: {signal}")
+            log("signal", symbol=self.symbol, signal=str(signal), price=new_price)
             return signal, new_price
         return 0, new_price
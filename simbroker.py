@@ -0,0 +1,752 @@
+"""
+A local stand-in for the TD Ameritrade Client and StreamClient.
+
+Implements the parts of the tda-api interface philbot uses on top of a
+random walk market, so the bot can be load tested or run without network
+access. REST latency, the fill model and the stream's quote rate are
+configurable. Order fills and cancels come back over the account activity
+stream as XML in the same form TDA sends.
+
+Enable with a "broker" section in config.json, for example:
+"broker": {"type": "simulated", "latency": 0.05, "fill_model": "immediate"}
+"""
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import math
+import random
+import threading
+import time
+
+from requests import HTTPError
+from tda.streaming import StreamClient
+
+
+def normal_cdf(x):
+    """Standard normal cumulative distribution function."""
+    return (1 + math.erf(x / math.sqrt(2))) / 2
+
+
+def black_scholes(put_call, price, strike, years, volatility):
+    """Returns (theoretical value, delta) of a European option, rates ignored."""
+    years = max(years, 1 / (365 * 24))
+    spread = volatility * math.sqrt(years)
+    d1 = (math.log(price / strike) + spread ** 2 / 2) / spread
+    d2 = d1 - spread
+    if put_call == "CALL":
+        return price * normal_cdf(d1) - strike * normal_cdf(d2), normal_cdf(d1)
+    return strike * normal_cdf(-d2) - price * normal_cdf(-d1), normal_cdf(d1) - 1
+
+
+def option_symbol(symbol, expiry, put_call, strike):
+    """TDA style option symbol, ie. SPY_102126C450."""
+    strike = f"{strike:g}"
+    return f"{symbol}_{expiry:%m%d%y}{put_call[0]}{strike}"
+
+
+def parse_option_symbol(contract):
+    """Inverse of option_symbol: returns (symbol, expiry date, putCall, strike)."""
+    symbol, rest = contract.split("_")
+    expiry = datetime.datetime.strptime(rest[:6], "%m%d%y").date()
+    put_call = "CALL" if rest[6] == "C" else "PUT"
+    return symbol, expiry, put_call, float(rest[7:])
+
+
+class SimResponse:
+    """Mimics the parts of an httpx/requests response the bot looks at."""
+
+    def __init__(self, status_code=200, data=None, headers=None):
+        self.status_code = status_code
+        self.is_error = status_code >= 400
+        self.headers = headers or {}
+        self._data = data
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        if self.is_error:
+            raise SimHTTPError(f"Simulated HTTP error {self.status_code}")
+
+
+class SimHTTPError(HTTPError):
+    """Raised by SimResponse.raise_for_status, caught like a real HTTPError by botutils."""
+
+
+class SimMarket:
+    """
+    Random walk prices for underlying symbols, minute candles and
+    option quotes priced off them.
+    """
+
+    def __init__(
+        self, symbols=("SPY",), start_price=450.0, volatility=0.2,
+        tick_size=0.01, option_spread=0.02, history_minutes=120, seed=None,
+    ):
+        """volatility is annualized and used for both the walk and option pricing."""
+        self.random = random.Random(seed)
+        self.volatility = volatility
+        self.tick_size = tick_size
+        self.option_spread = option_spread
+        self.prices = {symbol: start_price for symbol in symbols}
+        # Price standard deviation per second of the random walk.
+        self.step_stdev = start_price * volatility / math.sqrt(252 * 6.5 * 3600)
+        self.last_move = time.time()
+
+        self.candles = {symbol: [] for symbol in symbols}  # completed minute candles
+        self.current_candle = {}
+        now = time.time()
+        minute = int(now // 60) * 60
+        for symbol in symbols:
+            for start in range(minute - 60 * history_minutes, minute, 60):
+                self.current_candle[symbol] = self.new_candle(symbol, start)
+                for _ in range(6):
+                    self.move(symbol, 10)
+                self.candles[symbol].append(self.current_candle[symbol])
+            self.current_candle[symbol] = self.new_candle(symbol, minute)
+
+    def new_candle(self, symbol, start):
+        price = self.prices[symbol]
+        return {
+            "open": price, "high": price, "low": price, "close": price,
+            "volume": 0, "datetime": start * 1000,
+        }
+
+    def move(self, symbol, seconds):
+        """Random walk symbol forward by seconds and update the current candle."""
+        price = self.prices[symbol] + self.random.gauss(0, self.step_stdev * math.sqrt(seconds))
+        price = round(max(price, self.tick_size) / self.tick_size) * self.tick_size
+        self.prices[symbol] = round(price, 2)
+        candle = self.current_candle[symbol]
+        candle["high"] = max(candle["high"], self.prices[symbol])
+        candle["low"] = min(candle["low"], self.prices[symbol])
+        candle["close"] = self.prices[symbol]
+        candle["volume"] += self.random.randint(100, 5000)
+
+    def advance(self):
+        """
+        Move every symbol to the present.
+        Returns [(symbol, completed candle),...] for candles completed since the last call.
+        """
+        now = time.time()
+        completed = []
+        for symbol in self.prices:
+            moved_to = self.last_move
+            candle = self.current_candle[symbol]
+            # Every minute passed completes a candle, even if nothing
+            # asked for the market in between.
+            while now >= candle["datetime"] / 1000 + 60:
+                end = candle["datetime"] / 1000 + 60
+                self.move(symbol, max(end - moved_to, 0))
+                moved_to = end
+                self.candles[symbol].append(candle)
+                completed.append((symbol, candle))
+                candle = self.current_candle[symbol] = self.new_candle(symbol, int(end))
+            self.move(symbol, max(now - moved_to, 0))
+        self.last_move = now
+        return completed
+
+    def option_quote(self, contract):
+        """Returns a dict of bid, ask, mark and delta for an option symbol."""
+        symbol, expiry, put_call, strike = parse_option_symbol(contract)
+        # Expiring at the close (16:00 local).
+        close = datetime.datetime.combine(expiry, datetime.time(16))
+        years = max((close - datetime.datetime.now()).total_seconds(), 0) / (365 * 24 * 3600)
+        value, delta = black_scholes(put_call, self.prices[symbol], strike, years, self.volatility)
+        mark = max(round(value, 2), 0.01)
+        bid = max(round(mark - self.option_spread / 2, 2), 0.0)
+        ask = round(bid + self.option_spread, 2)
+        return {"bid": bid, "ask": ask, "mark": mark, "delta": round(delta, 3)}
+
+
+class SimOrder:
+    """An order placed with the SimClient."""
+
+    def __init__(self, order_id, account_id, spec):
+        leg = spec["orderLegCollection"][0]
+        self.order_id = order_id
+        self.account_id = account_id
+        self.spec = spec
+        self.symbol = leg["instrument"]["symbol"]
+        self.instruction = leg["instruction"]
+        self.quantity = leg["quantity"]
+        self.order_type = spec["orderType"]
+        self.price = float(spec["price"]) if "price" in spec else None
+        self.status = "WORKING"
+        self.entered_time = datetime.datetime.now(datetime.timezone.utc)
+        self.fill_price = None
+
+    @property
+    def is_buy(self):
+        return self.instruction.startswith("BUY")
+
+    def to_json(self):
+        """The order in the format returned by TDA's orders endpoints."""
+        data = dict(self.spec)
+        data |= {
+            "orderId": self.order_id,
+            "accountId": self.account_id,
+            "status": self.status,
+            "quantity": self.quantity,
+            "filledQuantity": self.quantity if self.status == "FILLED" else 0,
+            "enteredTime": self.entered_time.strftime("%Y-%m-%dT%H:%M:%S+0000"),
+        }
+        return data
+
+
+def fill_immediate(order, quote, rand):
+    """Fill model: marketable orders fill at the touch, others never."""
+    touch = quote["ask"] if order.is_buy else quote["bid"]
+    if order.order_type == "MARKET":
+        return touch
+    if (order.is_buy and order.price >= touch) or (not order.is_buy and order.price <= touch):
+        return order.price
+    return None
+
+
+def fill_probabilistic(order, quote, rand, fill_probability=0.3):
+    """
+    Fill model: market orders fill at the touch, limits at or better than
+    the mid fill with fill_probability on each check.
+    """
+    if order.order_type == "MARKET":
+        return quote["ask"] if order.is_buy else quote["bid"]
+    if (order.is_buy and order.price >= quote["mark"]) or \
+            (not order.is_buy and order.price <= quote["mark"]):
+        if rand.random() < fill_probability:
+            return order.price
+    return None
+
+
+def fill_never(order, quote, rand):
+    """Fill model: nothing fills, for testing timeouts and cancels."""
+    return None
+
+
+FILL_MODELS = {
+    "immediate": fill_immediate,
+    "probabilistic": fill_probabilistic,
+    "never": fill_never,
+}
+
+
+def account_activity_xml(message_type, order, quote=None):
+    """
+    XML in the form of TDA's account activity MESSAGE_DATA for an order.
+    Only includes the tags botutils.AccountActivityXMLParse looks for.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    instructions = "Buy" if order.is_buy else "Sell"
+    execution = ""
+    if order.fill_price is not None:
+        execution = (
+            "<ExecutionInformation><Type>Bought</Type>"
+            f"<Quantity>{order.quantity}</Quantity>"
+            f"<ExecutionPrice>{order.fill_price:.2f}</ExecutionPrice>"
+            "</ExecutionInformation>"
+        ) if order.is_buy else (
+            "<ExecutionInformation><Type>Sold</Type>"
+            f"<Quantity>{order.quantity}</Quantity>"
+            f"<ExecutionPrice>{order.fill_price:.2f}</ExecutionPrice>"
+            "</ExecutionInformation>"
+        )
+    pricing = f"<Limit>{order.price:.2f}</Limit>" if order.price is not None else ""
+    if quote:
+        pricing += f"<Bid>{quote['bid']:.2f}</Bid><Ask>{quote['ask']:.2f}</Ask>"
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<{message_type}Message xmlns="urn:xmlns:beb.ameritrade.com">'
+        f"<ActivityTimestamp>{now}</ActivityTimestamp>"
+        f"<Order><OrderKey>{order.order_id}</OrderKey>"
+        f"<Security><Symbol>{order.symbol}</Symbol><SecurityType>"
+        f"{'Call' if parse_option_symbol(order.symbol)[2] == 'CALL' else 'Put'} Option"
+        "</SecurityType></Security>"
+        f"<OrderPricing>{pricing}</OrderPricing>"
+        f"<OrderType>{order.order_type.title()}</OrderType>"
+        f"<OrderEnteredDateTime>{order.entered_time.isoformat()}</OrderEnteredDateTime>"
+        f"<OrderInstructions>{instructions}</OrderInstructions>"
+        f"<OriginalQuantity>{order.quantity}</OriginalQuantity>"
+        f"</Order><LastUpdated>{now}</LastUpdated>"
+        f"{execution}"
+        f"</{message_type}Message>"
+    )
+
+
+class SimClient:
+    """
+    Stands in for tda.client.Client.
+    Every call sleeps for latency (plus up to jitter) seconds like a
+    network round trip would.
+    """
+
+    def __init__(
+        self, market, account_id, latency=0.05, jitter=0.0, fill_model="immediate",
+        error_rate=0.0, lost_response_rate=0.0, seed=None,
+    ):
+        """
+        error_rate is the fraction of calls that return a 500 error.
+        lost_response_rate is the fraction of accepted orders whose
+        response is lost anyway (a 504 is returned).
+        """
+        self.market = market
+        self.account_id = int(account_id)
+        self.latency = latency
+        self.jitter = jitter
+        self.fill_model = FILL_MODELS[fill_model]
+        self.error_rate = error_rate
+        self.lost_response_rate = lost_response_rate
+        self.random = random.Random(seed)
+
+        self.lock = threading.RLock()
+        self.orders = {}  # order_id: SimOrder
+        self.positions = {}  # contract: quantity
+        self.order_ids = itertools.count(1000)
+        # Account activity messages waiting to be sent by a SimStreamClient.
+        self.activity = []
+
+    def _round_trip(self):
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        return self.random.random() >= self.error_rate
+
+    def get_price_history(self, symbol, **kwargs):
+        """Today's minute candles, whatever the arguments."""
+        if not self._round_trip():
+            return SimResponse(500)
+        with self.lock:
+            candles = self.market.candles[symbol] + [dict(self.market.current_candle[symbol])]
+        return SimResponse(200, {"candles": candles, "symbol": symbol, "empty": False})
+
+    def get_option_chain(
+        self, symbol, *, contract_type=None, strike_count=None, strike_range=None,
+        from_date=None, to_date=None, **kwargs,
+    ):
+        """
+        A chain with strike_count strikes around the current price
+        for every weekday expiry from from_date to to_date.
+        """
+        if not self._round_trip():
+            return SimResponse(500)
+        today = datetime.date.today()
+        from_date = from_date.date() if from_date else today
+        to_date = to_date.date() if to_date else today + datetime.timedelta(days=7)
+        strike_count = strike_count or 10
+
+        with self.lock:
+            price = self.market.prices[symbol]
+        atm = round(price)
+        strikes = [atm + offset for offset in range(-(strike_count // 2), strike_count - strike_count // 2)]
+        if strike_range is not None:
+            value = getattr(strike_range, "value", strike_range)
+            if value == "ITM":
+                strikes = {"CALL": [s for s in strikes if s < price],
+                           "PUT": [s for s in strikes if s > price]}
+            elif value == "OTM":
+                strikes = {"CALL": [s for s in strikes if s > price],
+                           "PUT": [s for s in strikes if s < price]}
+        if not isinstance(strikes, dict):
+            strikes = {"CALL": strikes, "PUT": strikes}
+
+        put_calls = ["CALL", "PUT"]
+        if contract_type is not None:
+            value = getattr(contract_type, "value", contract_type)
+            if value in put_calls:
+                put_calls = [value]
+
+        chain = {
+            "symbol": symbol, "status": "SUCCESS", "underlyingPrice": price,
+            "callExpDateMap": {}, "putExpDateMap": {},
+        }
+        day = from_date
+        while day <= to_date:
+            if day.weekday() < 5:
+                dte = (day - today).days
+                for put_call in put_calls:
+                    key = "callExpDateMap" if put_call == "CALL" else "putExpDateMap"
+                    expiry_map = chain[key].setdefault(f"{day.isoformat()}:{dte}", {})
+                    for strike in strikes[put_call]:
+                        contract = option_symbol(symbol, day, put_call, strike)
+                        with self.lock:
+                            quote = self.market.option_quote(contract)
+                        expiry_map[f"{float(strike)}"] = [{
+                            "putCall": put_call,
+                            "symbol": contract,
+                            "bid": quote["bid"],
+                            "ask": quote["ask"],
+                            "last": quote["mark"],
+                            "mark": quote["mark"],
+                            "delta": quote["delta"],
+                            "volatility": self.market.volatility * 100,
+                            "strikePrice": float(strike),
+                            "expirationDate": int(datetime.datetime.combine(
+                                day, datetime.time(16)).timestamp() * 1000),
+                            "daysToExpiration": dte,
+                            "multiplier": 100.0,
+                            "openInterest": 0,
+                            "totalVolume": 0,
+                        }]
+            day += datetime.timedelta(days=1)
+        return SimResponse(200, chain)
+
+    def _order_response(self, order):
+        location = f"https://api.tdameritrade.com/v1/accounts/{self.account_id}/orders/{order.order_id}"
+        return SimResponse(201, headers={"Location": location})
+
+    def place_order(self, account_id, order_spec):
+        """Accepts the order and queues an OrderEntryRequest message."""
+        if not self._round_trip():
+            return SimResponse(500)
+        with self.lock:
+            order = SimOrder(next(self.order_ids), account_id, order_spec)
+            self.orders[order.order_id] = order
+            self.activity.append(("OrderEntryRequest", order))
+            self.try_fill(order)
+        if self.random.random() < self.lost_response_rate:
+            return SimResponse(504)
+        return self._order_response(order)
+
+    def cancel_order(self, account_id, order_id):
+        if not self._round_trip():
+            return SimResponse(500)
+        with self.lock:
+            order = self.orders.get(int(order_id))
+            if order is None or order.status != "WORKING":
+                return SimResponse(400)
+            order.status = "CANCELED"
+            self.activity.append(("UROUT", order))
+        return SimResponse(200)
+
+    def replace_order(self, account_id, order_id, order_spec):
+        """Cancels order_id and places order_spec in its place."""
+        if not self._round_trip():
+            return SimResponse(500)
+        with self.lock:
+            old_order = self.orders.get(int(order_id))
+            if old_order is None or old_order.status != "WORKING":
+                return SimResponse(400)
+            old_order.status = "REPLACED"
+            order = SimOrder(next(self.order_ids), account_id, order_spec)
+            self.orders[order.order_id] = order
+            self.activity.append(("OrderCancelReplaceRequest", order))
+            self.try_fill(order)
+        return self._order_response(order)
+
+    def get_order(self, order_id, account_id):
+        if not self._round_trip():
+            return SimResponse(500)
+        with self.lock:
+            order = self.orders.get(int(order_id))
+            if order is None:
+                return SimResponse(404)
+            return SimResponse(200, order.to_json())
+
+    def get_orders_by_path(
+        self, account_id, *, max_results=None, from_entered_datetime=None,
+        to_entered_datetime=None, status=None, statuses=None,
+    ):
+        """Orders for the account, newest first."""
+        if not self._round_trip():
+            return SimResponse(500)
+        wanted = {getattr(s, "value", s) for s in (statuses or [])}
+        if status is not None:
+            wanted.add(getattr(status, "value", status))
+        with self.lock:
+            orders = [
+                order.to_json() for order in sorted(
+                    self.orders.values(), key=lambda order: order.order_id, reverse=True)
+                if (not wanted or order.status in wanted)
+                and (from_entered_datetime is None or order.entered_time >= _aware(from_entered_datetime))
+                and (to_entered_datetime is None or order.entered_time <= _aware(to_entered_datetime))
+            ]
+        return SimResponse(200, orders[:max_results])
+
+    def get_account(self, account_id, *, fields=None):
+        """Account with positions and orders, regardless of fields."""
+        if not self._round_trip():
+            return SimResponse(500)
+        with self.lock:
+            positions = [
+                {
+                    "instrument": {"assetType": "OPTION", "symbol": contract},
+                    "longQuantity": quantity if quantity > 0 else 0,
+                    "shortQuantity": -quantity if quantity < 0 else 0,
+                }
+                for contract, quantity in self.positions.items() if quantity
+            ]
+            orders = [order.to_json() for order in self.orders.values()]
+        return SimResponse(200, {"securitiesAccount": {
+            "accountId": str(self.account_id),
+            "positions": positions,
+            "orderStrategies": orders,
+        }})
+
+    def try_fill(self, order):
+        """Fill order if the fill model says so. Call with self.lock held."""
+        if order.status != "WORKING":
+            return False
+        quote = self.market.option_quote(order.symbol)
+        fill_price = self.fill_model(order, quote, self.random)
+        if fill_price is None:
+            return False
+        order.status = "FILLED"
+        order.fill_price = fill_price
+        self.positions[order.symbol] = self.positions.get(order.symbol, 0) + (
+            order.quantity if order.is_buy else -order.quantity)
+        self.activity.append(("OrderFill", order))
+        return True
+
+    def check_fills(self):
+        """Give every working order another chance to fill."""
+        with self.lock:
+            for order in list(self.orders.values()):
+                self.try_fill(order)
+
+    def pop_activity(self):
+        """Returns and clears the queued (message_type, order) account activity."""
+        with self.lock:
+            activity, self.activity = self.activity, []
+        return activity
+
+
+def _aware(moment):
+    if moment.tzinfo is None:
+        return moment.astimezone(datetime.timezone.utc)
+    return moment
+
+
+class SimStreamClient:
+    """
+    Stands in for tda.streaming.StreamClient.
+    Every quote_interval seconds handle_message sends a QUOTE for each
+    subscribed symbol, OPTION quotes for subscribed contracts, CHART_EQUITY
+    for completed minute candles and any account activity.
+    """
+
+    QOSLevel = StreamClient.QOSLevel
+
+    def __init__(self, client, quote_interval=0.5, drop_activity_rate=0.0, disconnect_rate=0.0):
+        """
+        drop_activity_rate is the fraction of account activity messages lost on the way.
+        disconnect_rate is the fraction of handle_message calls that find the connection dropped.
+        """
+        self.client = client
+        self.drop_activity_rate = drop_activity_rate
+        self.disconnect_rate = disconnect_rate
+        self.market = client.market
+        self.quote_interval = quote_interval
+        self.handlers = {}  # service: [handler,...]
+        self.subscriptions = {}  # service: set of keys
+        self.pending = []  # messages waiting to be handled
+        self.next_tick = time.monotonic()
+        # Stream seq numbers count up per service.
+        self.sequences = collections.defaultdict(itertools.count)
+        self.logged_in = False
+        self.dropped = False
+        self.qos = None
+
+    async def login(self):
+        if self.dropped:
+            # Candles completed while disconnected were never sent.
+            with self.client.lock:
+                self.market.advance()
+            self.dropped = False
+        self.logged_in = True
+        self.next_tick = time.monotonic()
+
+    def drop_connection(self):
+        """
+        Lose the connection like a network failure would: subscriptions
+        and undelivered messages are gone and handle_message raises
+        ConnectionError until the next login.
+        """
+        self.logged_in = False
+        self.dropped = True
+        self.subscriptions = {}
+        self.pending = []
+
+    async def logout(self):
+        self.logged_in = False
+
+    async def quality_of_service(self, qos_level):
+        self.qos = qos_level
+        # Slower QoS levels mean slower updates.
+        level = int(getattr(qos_level, "value", qos_level))
+        self.quote_interval = [0.5, 0.75, 1, 1.5, 3, 5][level]
+
+    def _add_handler(self, service, handler):
+        self.handlers.setdefault(service, []).append(handler)
+
+    def add_chart_equity_handler(self, handler):
+        self._add_handler("CHART_EQUITY", handler)
+
+    def add_level_one_equity_handler(self, handler):
+        self._add_handler("QUOTE", handler)
+
+    def add_account_activity_handler(self, handler):
+        self._add_handler("ACCT_ACTIVITY", handler)
+
+    def add_level_one_option_handler(self, handler):
+        self._add_handler("OPTION", handler)
+
+    async def chart_equity_subs(self, symbols, *, fields=None):
+        self.subscriptions["CHART_EQUITY"] = set(symbols)
+        # TDA sends the latest candle straight away.
+        for symbol in symbols:
+            self.pending.append(self.chart_message(symbol, self.market.candles[symbol][-1]))
+
+    async def level_one_equity_subs(self, symbols, *, fields=None):
+        self.subscriptions["QUOTE"] = set(symbols)
+
+    async def account_activity_sub(self):
+        self.subscriptions["ACCT_ACTIVITY"] = {str(self.client.account_id)}
+
+    async def level_one_option_subs(self, symbols, *, fields=None):
+        self.subscriptions["OPTION"] = set(symbols)
+
+    async def level_one_option_unsubs(self, symbols):
+        self.subscriptions["OPTION"] = self.subscriptions.get("OPTION", set()) - set(symbols)
+
+    def message(self, service, content):
+        return {
+            "service": service,
+            "timestamp": int(time.time() * 1000),
+            "command": "SUBS",
+            "content": content,
+        }
+
+    def chart_message(self, symbol, candle):
+        return self.message("CHART_EQUITY", [{
+            "seq": next(self.sequences["CHART_EQUITY"]),
+            "key": symbol,
+            "OPEN_PRICE": candle["open"],
+            "HIGH_PRICE": candle["high"],
+            "LOW_PRICE": candle["low"],
+            "CLOSE_PRICE": candle["close"],
+            "VOLUME": candle["volume"],
+            "SEQUENCE": next(self.sequences["CHART_SEQUENCE"]),
+            "CHART_TIME": candle["datetime"],
+            "CHART_DAY": int(candle["datetime"] // 86400000),
+        }])
+
+    def tick(self):
+        """Advance the market and queue the resulting messages."""
+        with self.client.lock:
+            completed = self.market.advance()
+            for symbol, candle in completed:
+                if symbol in self.subscriptions.get("CHART_EQUITY", ()):
+                    self.pending.append(self.chart_message(symbol, candle))
+
+            quotes = [
+                {
+                    "key": symbol,
+                    "BID_PRICE": round(self.market.prices[symbol] - 0.01, 2),
+                    "ASK_PRICE": round(self.market.prices[symbol] + 0.01, 2),
+                    "LAST_PRICE": self.market.prices[symbol],
+                }
+                for symbol in self.subscriptions.get("QUOTE", ())
+            ]
+            option_quotes = []
+            for contract in self.subscriptions.get("OPTION", ()):
+                quote = self.market.option_quote(contract)
+                option_quotes.append({
+                    "key": contract,
+                    "BID_PRICE": quote["bid"],
+                    "ASK_PRICE": quote["ask"],
+                    "LAST_PRICE": quote["mark"],
+                    "MARK": quote["mark"],
+                    "DELTA": quote["delta"],
+                })
+        if quotes:
+            self.pending.append(self.message("QUOTE", quotes))
+        if option_quotes:
+            self.pending.append(self.message("OPTION", option_quotes))
+
+        self.client.check_fills()
+        self.queue_activity()
+
+    def queue_activity(self):
+        activity = self.client.pop_activity()
+        if activity and "ACCT_ACTIVITY" in self.subscriptions:
+            with self.client.lock:
+                content = [
+                    {
+                        "seq": next(self.sequences["ACCT_ACTIVITY"]),
+                        "key": str(self.client.account_id),
+                        "ACCOUNT": str(self.client.account_id),
+                        "MESSAGE_TYPE": message_type,
+                        "MESSAGE_DATA": account_activity_xml(
+                            message_type, order, self.market.option_quote(order.symbol)),
+                    }
+                    for message_type, order in activity
+                ]
+                # Lost messages still use up their seq numbers.
+                content = [
+                    item for item in content
+                    if self.client.random.random() >= self.drop_activity_rate
+                ]
+            if content:
+                self.pending.append(self.message("ACCT_ACTIVITY", content))
+
+    async def handle_message(self):
+        """Wait for the next message and pass it to its handlers."""
+        if self.disconnect_rate and self.logged_in \
+                and self.client.random.random() < self.disconnect_rate:
+            self.drop_connection()
+        if self.dropped:
+            raise ConnectionError("Stream connection lost")
+        if not self.logged_in:
+            raise ValueError("Socket not open. Did you forget to call login()?")
+        # Account activity from orders placed since the last tick goes out first.
+        self.queue_activity()
+        if not self.pending:
+            delay = self.next_tick - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_tick = max(self.next_tick + self.quote_interval, time.monotonic())
+            self.tick()
+        if not self.pending:
+            return
+        msg = self.pending.pop(0)
+        for handler in self.handlers.get(msg["service"], []):
+            result = handler(msg)
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+
+
+def make_sim_clients(broker_config, account_id, symbols=("SPY",)):
+    """
+    Returns (SimClient, SimStreamClient) set up from the "broker" config section.
+    Recognized keys: latency, jitter, fill_model, error_rate, lost_response_rate,
+    quote_interval, drop_activity_rate, disconnect_rate, start_price, volatility, option_spread,
+    history_minutes, seed.
+    """
+    market = SimMarket(
+        symbols,
+        start_price=broker_config.get("start_price", 450.0),
+        volatility=broker_config.get("volatility", 0.2),
+        option_spread=broker_config.get("option_spread", 0.02),
+        history_minutes=broker_config.get("history_minutes", 120),
+        seed=broker_config.get("seed"),
+    )
+    client = SimClient(
+        market, account_id,
+        latency=broker_config.get("latency", 0.05),
+        jitter=broker_config.get("jitter", 0.0),
+        fill_model=broker_config.get("fill_model", "immediate"),
+        error_rate=broker_config.get("error_rate", 0.0),
+        lost_response_rate=broker_config.get("lost_response_rate", 0.0),
+        seed=broker_config.get("seed"),
+    )
+    stream_client = SimStreamClient(
+        client, broker_config.get("quote_interval", 0.5), broker_config.get("drop_activity_rate", 0.0),
+        broker_config.get("disconnect_rate", 0.0))
+    return client, stream_client
+
+
+if __name__ == "__main__":
+    # Print a sample chain and message to check the formats.
+    sim_client, sim_stream = make_sim_clients({"latency": 0, "seed": 0}, 123)
+    print(json.dumps(sim_client.get_option_chain("SPY", strike_count=2).json(), indent=2)[:2000])
@@ -0,0 +1,189 @@
+"""
+Runs the terminal UI in its own process.
+
+In headless mode the trading process never writes to the terminal.
+Instead SnapshotPublisher copies what the UI shows (prices, clouds,
+positions and messages) into plain data every interval seconds and sends
+it to a viewer over a local multiprocessing.connection socket from a
+background thread. Only the latest snapshot is kept, so a slow or paused
+viewer only ever misses snapshots and can't hold up trading.
+
+The viewer is this module run on its own:
+python uiprocess.py --port 6001
+"""
+import argparse
+import asyncio
+import os
+import queue
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from types import SimpleNamespace
+
+from dotenv import load_dotenv
+
+from ema import CloudColor, CloudPriceLocation
+
+load_dotenv()
+
+DEFAULT_ADDRESS = ("localhost", 6001)
+
+
+def authkey():
+    """
+    Shared key the viewer and publisher authenticate with, ui_authkey
+    from .env. There's no default: anyone who knows the key can read the
+    bot's positions, so both sides refuse to start without one.
+    """
+    key = os.getenv("ui_authkey")
+    if not key:
+        raise ValueError("ui_authkey must be set in .env to use the headless UI")
+    return key.encode()
+
+
+def take_snapshot(msghandler, clouds, positions, ui, max_messages=50):
+    """Plain data (picklable, no references to live objects) for what the UI shows."""
+    return {
+        "time": time.time(),
+        "prices": {
+            symbol: data.get("LAST_PRICE")
+            for symbol, data in msghandler.last_messages.items() if symbol in clouds
+        },
+        "clouds": {
+            symbol: {
+                "short_ema": cloud.short_ema,
+                "long_ema": cloud.long_ema,
+                "color": cloud.status[0].value,
+                "location": cloud.status[1].value,
+            }
+            for symbol, cloud in clouds.items()
+        },
+        "positions": [
+            {
+                "contract": position.contract,
+                "net_pos": position.net_pos,
+                "stop": str(position.stop),
+                "take_profit": position.take_profit,
+                "state": str(position.state),
+                "associated_orders": [str(order) for order in position.associated_orders],
+            }
+            for position in positions
+        ],
+        "messages": [str(message) for message in ui.messages[-max_messages:]],
+        "status": ui.status,
+    }
+
+
+class SnapshotPublisher:
+    """
+    Sends snapshots to a viewer process.
+
+    Fields:
+    address
+    interval
+    latest
+    """
+
+    def __init__(self, state, ui, address=DEFAULT_ADDRESS, interval=0.25):
+        """
+        state is a function returning (msghandler, clouds, positions)
+        as passed to PhilbotUI.dispatch_display.
+        """
+        self.state = state
+        self.ui = ui
+        self.address = address
+        self.interval = interval
+        # Fails here, before trading starts, if there's no key.
+        self.authkey = authkey()
+        # Holds only the newest snapshot.
+        self.latest = queue.Queue(maxsize=1)
+        self.sender = threading.Thread(target=self._send_loop, name="ui-publisher", daemon=True)
+
+    def publish(self):
+        """Take a snapshot and replace any not yet sent."""
+        snapshot = take_snapshot(*self.state(), self.ui)
+        try:
+            self.latest.get_nowait()
+        except queue.Empty:
+            pass
+        self.latest.put_nowait(snapshot)
+
+    def _send_loop(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            while True:
+                try:
+                    connection = listener.accept()
+                except OSError:
+                    # Failed handshake, wait for the next viewer.
+                    continue
+                with connection:
+                    try:
+                        while True:
+                            connection.send(self.latest.get())
+                    except (OSError, EOFError):
+                        # Viewer went away.
+                        pass
+
+    async def run(self):
+        """
+        Snapshot every self.interval seconds. Runs on the event loop so
+        snapshots are taken between messages, never halfway through one.
+        """
+        self.sender.start()
+        while True:
+            self.publish()
+            await asyncio.sleep(self.interval)
+
+
+def snapshot_to_display(snapshot):
+    """(msg_handler, clouds, positions) stand-ins for PhilbotUI.dispatch_display."""
+    msg_handler = SimpleNamespace(last_messages={
+        symbol: {"LAST_PRICE": price} if price is not None else {}
+        for symbol, price in snapshot["prices"].items()
+    })
+    clouds = {
+        symbol: SimpleNamespace(
+            short_ema=cloud["short_ema"],
+            long_ema=cloud["long_ema"],
+            status=(CloudColor(cloud["color"]), CloudPriceLocation(cloud["location"])),
+        )
+        for symbol, cloud in snapshot["clouds"].items()
+    }
+    positions = [SimpleNamespace(**position) for position in snapshot["positions"]]
+    return msg_handler, clouds, positions
+
+
+def view(address=DEFAULT_ADDRESS, retry_interval=1.0):
+    """Connect to a headless bot and draw every snapshot received."""
+    from blessed import Terminal
+    from philui import PhilbotUI
+
+    key = authkey()
+    ui = PhilbotUI(Terminal())
+    while True:
+        try:
+            connection = Client(address, authkey=key)
+        except OSError:
+            print(f"Waiting for the bot at {address[0]}:{address[1]}...")
+            time.sleep(retry_interval)
+            continue
+        with connection:
+            try:
+                while True:
+                    snapshot = connection.recv()
+                    ui.messages = snapshot["messages"]
+                    ui.status = snapshot["status"]
+                    ui.dispatch_display(*snapshot_to_display(snapshot))
+            except (OSError, EOFError):
+                print("Lost the connection to the bot.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Terminal UI for a bot running in headless mode.")
+    parser.add_argument("--host", default=DEFAULT_ADDRESS[0])
+    parser.add_argument("--port", type=int, default=DEFAULT_ADDRESS[1])
+    args = parser.parse_args()
+    try:
+        view((args.host, args.port))
+    except ValueError as err:
+        parser.exit(1, f"{err}\n")